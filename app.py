@@ -13,6 +13,7 @@ project_root = Path(__file__).resolve().parent
 sys.path.insert(0, str(project_root))
 
 from services.config_service import config_service
+from services.session_service import session_service
 from routes import register_blueprints
 
 # 初始化配置
@@ -33,10 +34,14 @@ app.project_root = project_root
 # 注册蓝图
 if not need_config:
     from services.ttsapi_service import ttsService
+    from services.warmup_service import warmup_service
     app.tts = ttsService()          # 挂到 app 上
+    warmup_service.tts = app.tts    # 切换角色时预热音色
 else:
     app.tts = None
 register_blueprints(app)
+# 按会话Cookie为每个浏览器绑定独立的对话上下文
+session_service.init_app(app)
 # app.py
 
 # MIME 类型
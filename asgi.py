@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+CABM ASGI入口
+/api/chat/stream 与 /api/story/chat/stream（单角色故事）使用原生异步管线：每个流式对话是事件循环上的一个协程，
+模型流式输出（AsyncOpenAI）、选项生成和导演判断都以异步方式调用，不再为每个流占用一个线程；
+记忆检索、历史记录写入等阻塞操作放到线程池执行。回复结束后的记忆写入、导演判断和选项生成并发执行。
+其余请求（页面、静态文件、多角色故事等）交给Flask应用处理（需要安装asgiref）。
+
+用法（在项目根目录执行）：
+    uvicorn asgi:app --host 127.0.0.1 --port 5000
+"""
+import json
+import asyncio
+import traceback
+from http.cookies import SimpleCookie
+from typing import Any, AsyncIterator, Dict, Optional
+
+from app import app as flask_app, need_config
+from services.config_service import config_service
+from services.session_service import session_service
+from utils.stream_parser import ReplyStreamParser
+from utils.sse_utils import SSEFrameCoalescer, sse_frame
+from utils.stream_control import stream_registry, StreamHandle, CANCEL_DISCONNECT
+from utils.post_stream import run_post_stream_tasks_async, get_task_timeout
+
+if not need_config:
+    from services.chat_service import chat_service
+    from services.story_service import story_service
+    from services.option_service import option_service
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    wsgi_app = WsgiToAsgi(flask_app)
+except ImportError:
+    print("未找到asgiref模块，ASGI入口只提供异步流式对话接口，请安装asgiref以访问其他页面")
+    wsgi_app = None
+
+# 交给Flask处理的标记（例如多角色故事）
+_FALLBACK = object()
+
+
+class _ErrorResponse(Exception):
+    """在开始流式输出前返回的JSON错误"""
+
+    def __init__(self, status: int, error: str):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+
+
+# ------------------------------------------------------------------
+# 异步流式对话
+# ------------------------------------------------------------------
+async def chat_stream(data: Dict[str, Any], stream_handle: StreamHandle):
+    """普通聊天流式对话（对应 /api/chat/stream）"""
+    message = data.get('message', '')
+    if not message:
+        raise _ErrorResponse(400, '消息不能为空')
+    user_message = await asyncio.to_thread(chat_service.add_message, "user", message)
+    return _chat_frames(message, user_message, stream_handle)
+
+
+async def _chat_frames(message: str, user_message, stream_handle: StreamHandle) -> AsyncIterator[str]:
+    yield sse_frame({'streamId': stream_handle.stream_id})
+    try:
+        reply_parser = ReplyStreamParser()
+        async for frame in _relay_reply(message, stream_handle, reply_parser):
+            yield frame
+        full_response = reply_parser.text
+
+        # 已取消：不保存回复，跳过记忆写入和选项生成
+        if stream_handle.cancelled:
+            yield sse_frame({'cancelled': True})
+            yield "data: [DONE]\n\n"
+            return
+
+        if full_response:
+            assistant_message = await asyncio.to_thread(chat_service.add_message, "assistant", full_response)
+
+            async def generate_options():
+                return await option_service.generate_options_async(
+                    conversation_history=chat_service.format_messages(),
+                    character_config=chat_service.get_character_config(),
+                    user_query=message
+                )
+
+            # 记忆写入和选项生成并发执行，选项生成完成后立即发送
+            async for name, result in run_post_stream_tasks_async([
+                ("memory", lambda: _remember_chat_turn(message, full_response, user_message, assistant_message), get_task_timeout("memory")),
+                ("options", generate_options, get_task_timeout("options")),
+            ]):
+                if name == "options" and result:
+                    yield sse_frame({'options': result})
+        yield "data: [DONE]\n\n"
+    except Exception as e:
+        yield sse_frame({'error': str(e)})
+        yield "data: [DONE]\n\n"
+
+
+def _remember_chat_turn(message: str, full_response: str, user_message, assistant_message) -> None:
+    assistant_content = assistant_message.get_parsed()["content"]
+    if chat_service.story_mode and chat_service.current_story_id:
+        memory_ids = chat_service.memory_service.add_story_conversation(
+            user_message=message,
+            assistant_message=full_response,
+            story_id=chat_service.current_story_id,
+            assistant_content=assistant_content
+        )
+    else:
+        character_id = config_service.current_character_id or "default"
+        memory_ids = chat_service.memory_service.add_conversation(
+            user_message=message,
+            assistant_message=full_response,
+            character_name=character_id,
+            assistant_content=assistant_content
+        )
+    chat_service.link_memory_ids([user_message, assistant_message], memory_ids)
+
+
+async def story_chat_stream(data: Dict[str, Any], stream_handle: StreamHandle):
+    """单角色故事流式对话（对应 /api/story/chat/stream，多角色故事交给Flask处理）"""
+    message = data.get('message', '')
+    story_id = data.get('story_id', '')
+    if not message:
+        raise _ErrorResponse(400, '消息不能为空')
+    if not story_id:
+        raise _ErrorResponse(400, '故事ID不能为空')
+    if not await asyncio.to_thread(story_service.load_story, story_id):
+        raise _ErrorResponse(404, f'故事 {story_id} 不存在')
+
+    story_data = story_service.get_current_story_data()
+    characters = story_data.get('characters', {}).get('list', [])
+    if isinstance(characters, str):
+        characters = [characters]
+    if len(characters) > 1:
+        return _FALLBACK
+
+    await asyncio.to_thread(chat_service.set_story_mode, story_id)
+    user_message = await asyncio.to_thread(chat_service.add_message, "user", message)
+    return _story_frames(message, story_id, user_message, stream_handle)
+
+
+async def _story_frames(message: str, story_id: str, user_message,
+                        stream_handle: StreamHandle) -> AsyncIterator[str]:
+    yield sse_frame({'streamId': stream_handle.stream_id})
+    try:
+        reply_parser = ReplyStreamParser()
+        async for frame in _relay_reply(message, stream_handle, reply_parser):
+            yield frame
+        full_response = reply_parser.text
+
+        # 已取消：不保存回复，跳过记忆写入、导演判断和选项生成
+        if stream_handle.cancelled:
+            yield sse_frame({'cancelled': True})
+            yield "data: [DONE]\n\n"
+            return
+
+        if full_response:
+            assistant_message = await asyncio.to_thread(chat_service.add_message, "assistant", full_response)
+            assistant_content = assistant_message.get_parsed()["content"]
+
+            def remember():
+                memory_ids = chat_service.memory_service.add_story_conversation(
+                    user_message=message,
+                    assistant_message=full_response,
+                    story_id=story_id,
+                    assistant_content=assistant_content
+                )
+                chat_service.link_memory_ids([user_message, assistant_message], memory_ids)
+
+            async def direct():
+                max_history = config_service.get_app_config()["max_history_length"]
+                character_name = chat_service.get_character_config().get('name', 'AI助手')
+                chat_history_text = ""
+                for msg in chat_service.get_history()[-max_history:]:
+                    if msg.role == "user":
+                        chat_history_text += f"玩家：{msg.content}\n"
+                    elif msg.role == "assistant":
+                        chat_history_text += f"{character_name}：{msg.get_parsed()['content']}\n"
+
+                director_offset = await story_service.call_director_model_async(chat_history_text)
+                if director_offset == 0:
+                    await asyncio.to_thread(story_service.update_progress, advance_chapter=True)
+                    if story_service.is_story_finished():
+                        print("故事已结束")
+                else:
+                    await asyncio.to_thread(story_service.update_progress, offset_increment=director_offset)
+                return story_service.get_progress_update()
+
+            async def generate_options():
+                return await option_service.generate_options_async(
+                    conversation_history=chat_service.format_messages(),
+                    character_config=chat_service.get_character_config(),
+                    user_query=message
+                )
+
+            # 记忆写入、导演判断和选项生成并发执行，哪个先完成先发送
+            player_turn_sent = False
+            async for name, result in run_post_stream_tasks_async([
+                ("memory", remember, get_task_timeout("memory")),
+                ("director", direct, get_task_timeout("director")),
+                ("options", generate_options, get_task_timeout("options")),
+            ]):
+                if name == "director":
+                    yield sse_frame(result)
+                    yield sse_frame({'nextSpeaker': 'player'})
+                    player_turn_sent = True
+                elif name == "options" and result:
+                    yield sse_frame({'options': result})
+            if not player_turn_sent:
+                # 导演判断失败或超时也要通知前端结束本轮，否则界面一直等待
+                yield sse_frame({'nextSpeaker': 'player'})
+        yield "data: [DONE]\n\n"
+    except Exception as e:
+        print(f"流式响应错误: {e}")
+        traceback.print_exc()
+        yield sse_frame({'error': str(e)})
+        yield "data: [DONE]\n\n"
+
+
+async def _relay_reply(message: str, stream_handle: StreamHandle, reply_parser: ReplyStreamParser) -> AsyncIterator[str]:
+    """转发模型回复，逐个产出SSE帧（完整回复由reply_parser.text获取）"""
+    coalescer = SSEFrameCoalescer.from_config()
+    async for chunk in stream_handle.relay_async(chat_service.chat_completion_async(user_query=message)):
+        if chunk is not None:
+            for frame in coalescer.push_events(reply_parser.feed(chunk)):
+                yield frame
+    for frame in coalescer.push_events(reply_parser.close()) + coalescer.flush():
+        yield frame
+
+
+ASYNC_ROUTES = {
+    ("POST", "/api/chat/stream"): ("chat", chat_stream),
+    ("POST", "/api/story/chat/stream"): ("story", story_chat_stream),
+}
+
+
+# ------------------------------------------------------------------
+# ASGI应用
+# ------------------------------------------------------------------
+async def app(scope, receive, send):
+    """ASGI入口：异步流式对话接口直接处理，其余请求交给Flask"""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+
+    route = ASYNC_ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if route is not None and not need_config:
+        await _serve_stream(route, scope, receive, send)
+        return
+
+    if wsgi_app is None:
+        await _send_json(send, 404, {'success': False, 'error': '未安装asgiref，ASGI入口仅支持异步流式对话接口'})
+        return
+    await wsgi_app(scope, receive, send)
+
+
+async def _serve_stream(route, scope, receive, send) -> None:
+    kind, handler = route
+    body = await _read_body(receive)
+    cookies = _parse_cookies(scope)
+    context, created = await asyncio.to_thread(session_service.get_or_create, cookies.get(session_service.cookie_name))
+    session_service.bind(context)
+
+    extra_headers = []
+    if created:
+        extra_headers.append((b"set-cookie", f"{session_service.cookie_name}={context.session_id}; Path=/; HttpOnly; SameSite=Lax".encode()))
+
+    stream_handle = stream_registry.open(kind, context.session_id)
+    try:
+        try:
+            data = json.loads(body or b"{}")
+            frames = await handler(data, stream_handle)
+        except _ErrorResponse as e:
+            await _send_json(send, e.status, {'success': False, 'error': e.error}, extra_headers)
+            return
+        except Exception as e:
+            traceback.print_exc()
+            await _send_json(send, 500, {'success': False, 'error': str(e)}, extra_headers)
+            return
+
+        if frames is _FALLBACK:
+            if wsgi_app is None:
+                await _send_json(send, 404, {'success': False, 'error': '未安装asgiref，ASGI入口仅支持异步流式对话接口'}, extra_headers)
+                return
+            # 请求体已读取，重放给Flask；本次新建的会话通过Cookie交给Flask，避免Flask再建一个会话
+            if created:
+                scope = _with_session_cookie(scope, context.session_id)
+                send = _with_extra_headers(send, extra_headers)
+            await wsgi_app(scope, _replay_receive(body, receive), send)
+            return
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ] + extra_headers,
+        })
+        watcher = asyncio.create_task(_watch_disconnect(receive, stream_handle))
+        try:
+            async for frame in frames:
+                if stream_handle.cancel_reason == CANCEL_DISCONNECT:
+                    break
+                await send({"type": "http.response.body", "body": frame.encode("utf-8"), "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        except OSError:
+            # 客户端断开连接：停止读取上游流
+            stream_handle.cancel(CANCEL_DISCONNECT)
+        finally:
+            watcher.cancel()
+            await frames.aclose()
+    finally:
+        stream_handle.close()
+        await asyncio.to_thread(session_service.save, context)
+
+
+async def _watch_disconnect(receive, stream_handle: StreamHandle) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            stream_handle.cancel(CANCEL_DISCONNECT)
+            return
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+def _replay_receive(body: bytes, receive):
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return replay
+
+
+def _with_session_cookie(scope, session_id: str):
+    """返回带有会话Cookie的请求scope副本（替换请求中已有的同名Cookie）"""
+    cookies = _parse_cookies(scope)
+    cookies[session_service.cookie_name] = session_id
+    cookie_header = "; ".join(f"{name}={value}" for name, value in cookies.items()).encode("latin-1")
+    headers = [(name, value) for name, value in scope.get("headers", []) if name != b"cookie"]
+    return dict(scope, headers=headers + [(b"cookie", cookie_header)])
+
+
+def _with_extra_headers(send, extra_headers: list):
+    """在响应头中追加extra_headers（如新会话的set-cookie）"""
+    async def wrapped(message):
+        if message["type"] == "http.response.start":
+            message = dict(message, headers=list(message.get("headers", [])) + extra_headers)
+        await send(message)
+
+    return wrapped
+
+
+def _parse_cookies(scope) -> Dict[str, str]:
+    cookie = SimpleCookie()
+    for name, value in scope.get("headers", []):
+        if name == b"cookie":
+            cookie.load(value.decode("latin-1"))
+    return {key: morsel.value for key, morsel in cookie.items()}
+
+
+async def _send_json(send, status: int, data: Dict[str, Any], extra_headers: Optional[list] = None) -> None:
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json; charset=utf-8")] + (extra_headers or []),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if not need_config:
+                chat_service.set_system_prompt("character")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
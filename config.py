@@ -22,6 +22,19 @@ CHAT_CONFIG = {
 # 流式输出配置
 STREAM_CONFIG = {
     "enable_streaming": True,     # 启用流式输出
+    # SSE帧合并：content增量累积到一定时间或字符数后再合并成一帧发送（均为0时逐token发送）
+    # mood、选项、进度等事件不受影响，总是立即发送
+    "coalesce_ms": int(get_env_var("STREAM_COALESCE_MS", "40")),        # 最长累积时间（毫秒）
+    "coalesce_chars": int(get_env_var("STREAM_COALESCE_CHARS", "24")),  # 最多累积字符数
+    # 回复结束后的后续任务（记忆写入、导演判断、选项生成）并发执行，各自超时后不再等待
+    "post_task_workers": int(get_env_var("POST_TASK_WORKERS", "8")),   # 共享线程池大小
+    "post_task_timeouts": {                                            # 各任务超时（秒）
+        "memory": 10.0,
+        "director": 15.0,
+        "options": 10.0,
+    },
+    # 流式请求结束时返回用量（包括命中服务端提示词缓存的token数），不支持stream_options的服务可关闭
+    "include_usage": get_env_var("STREAM_INCLUDE_USAGE", "True").lower() == "true",
 }
 
 # 选项生成配置
@@ -39,6 +52,25 @@ MEMORY_CONFIG = {
     "top_k": 5,                   # 记忆检索返回的最相似结果数量
     "timeout": 10,                # 记忆检索超时时间（秒）
     "min_similarity": 0.3,        # 最小相似度阈值
+    # 检索截止时间（毫秒）：记忆和角色详情并发检索，到时未完成的不再等待（后台完成后写入检索结果缓存供下一轮使用），0为一直等待
+    "deadline_ms": int(get_env_var("RETRIEVAL_DEADLINE_MS", "400")),
+    "deadline_workers": 8,        # 检索线程池大小
+    # 检索门控：低信息量的输入（"嗯""好的""哈哈"）跳过记忆和角色详情检索，沿用上一轮的检索结果
+    "query_gate": {
+        "enabled": get_env_var("QUERY_GATE", "True").lower() == "true",
+        "min_chars": 2,               # 去掉语气字后至少需要的字数
+        "max_stopword_ratio": 0.7,    # 语气字占比达到该值时跳过
+        "classifier": get_env_var("QUERY_GATE_CLASSIFIER", ""),  # 可选的本地分类器（"模块:函数"，返回需要检索的概率）
+        "classifier_threshold": 0.5,
+        "reuse_previous": True,       # 跳过时沿用上一轮（同一角色/故事）的检索结果
+    },
+    # 会话级检索结果缓存：查询向量相近且记忆库未明显变化时直接使用上次的检索结果，跳过召回和精排
+    "retrieval_cache": {
+        "enabled": get_env_var("RETRIEVAL_CACHE", "True").lower() == "true",
+        "max_entries": 8,             # 每个会话最多缓存的检索结果数
+        "similarity_threshold": float(get_env_var("RETRIEVAL_CACHE_THRESHOLD", "0.92")),  # 查询向量余弦相似度阈值
+        "max_new_docs": 6,            # 缓存后记忆库最多新增的文档数（约3轮对话）
+    },
 }
 
 RAG_CONFIG = {
@@ -245,7 +277,67 @@ APP_CONFIG = {
     "template_folder": "templates",
     "image_cache_dir": "data/temp_images",
     "max_history_length": 8,  # 最大对话历史长度（发送给AI的上下文长度）
+    "context_budget": {  # 按token预算组装发送给模型的上下文（关闭时按max_history_length条消息截断，记忆和角色详情不限长度）
+        "enabled": get_env_var("CONTEXT_BUDGET", "True").lower() == "true",
+        "max_tokens": int(get_env_var("CONTEXT_TOKEN_BUDGET", "3000")),  # 输入上下文的token预算（不含模型回复）
+        "history_max_ratio": 0.6,  # 最近的对话最多占用系统提示词之外剩余预算的比例
+        "min_history_messages": 2,  # 无论预算如何都保留的最近消息数
+        "max_history_messages": 40,  # 内存中保留的最多消息数（实际发送的条数由预算决定）
+    },
     "history_dir": "data/history",  # 历史记录存储目录
+    "history_rotation": {  # 历史记录分段轮转（旧分段压缩归档，读取时透明合并）
+        "enabled": get_env_var("HISTORY_ROTATION", "True").lower() == "true",
+        "max_segment_bytes": 2 * 1024 * 1024,  # 活跃分段超过该大小时轮转
+        "max_segment_age_days": 30,  # 活跃分段超过该天数时轮转，None表示不按时间轮转
+        "compression": "gzip",  # 归档压缩方式：gzip 或 zstd（需安装zstandard）
+    },
+    "history_durability": {  # 历史记录写入持久化策略
+        "flush_policy": get_env_var("HISTORY_FLUSH_POLICY", "every_message"),  # every_message / interval / shutdown
+        "flush_interval_ms": 200,  # interval策略下的刷盘间隔（毫秒）
+        "fsync": get_env_var("HISTORY_FSYNC", "False").lower() == "true",  # 刷盘后是否fsync
+        "max_open_files": 64,  # 同时保持打开的历史文件句柄上限
+    },
+    "session": {  # 会话上下文（按Cookie区分浏览器，各自独立的历史记录、当前角色和故事）
+        "cookie_name": "cabm_session",
+        "max_sessions": int(get_env_var("SESSION_MAX", "200")),  # 最多保留的会话数，超出时淘汰最久未使用的会话
+        "idle_timeout": int(get_env_var("SESSION_IDLE_TIMEOUT", "3600")),  # 会话空闲超过该秒数后淘汰
+    },
+    "page_cache": {  # /chat 页面渲染输入（背景、最后一句回复、插件脚本）缓存，历史记录或背景变化时失效
+        "enabled": get_env_var("PAGE_CACHE", "True").lower() == "true",
+        "ttl": 300,  # 缓存有效期（秒），兜底其他进程的修改
+    },
+    "warmup": {  # 切换角色/故事时在后台并发预热记忆库、角色详情、历史记录、时间前缀和音色
+        "enabled": get_env_var("WARMUP", "True").lower() == "true",
+        "max_workers": 4,  # 预热线程池大小
+    },
+    "state_store": {  # 会话/故事进度状态存储：memory（进程内，默认）或 remote（多进程/多主机共享，先启动 python -m utils.state_store）
+        "backend": get_env_var("STATE_STORE", "memory"),
+        "url": get_env_var("STATE_STORE_URL", "http://127.0.0.1:6390"),
+        "timeout": 2.0,  # 远程请求超时（秒）
+        "cache_check_interval": 1.0,  # 本地缓存在该秒数内直接命中，超过后向远程校验版本
+    },
+    "storage": {  # 存储后端：file（默认，JSONL/JSON/TOML文件）或 sqlite（WAL模式单库，先运行 python -m utils.sqlite_migrate 迁移）
+        "backend": get_env_var("STORAGE_BACKEND", "file"),
+        "sqlite_path": get_env_var("SQLITE_PATH", "data/cabm.db"),
+    },
+    "http_client": {  # 共享HTTP客户端（导演/故事生成、语音合成、图像下载、精排API）：连接池、退避重试、重试预算和熔断
+        "pool_connections": 10,  # 缓存的主机连接池数
+        "pool_maxsize": int(get_env_var("HTTP_POOL_MAXSIZE", "16")),  # 每个主机保持的最大连接数
+        "max_retries": int(get_env_var("HTTP_MAX_RETRIES", "2")),  # 失败后最多重试次数（不含首次请求）
+        "backoff_base": 0.5,  # 指数退避的基础等待时间（秒），实际等待在 [0, base*2^n] 之间随机
+        "backoff_max": 8.0,  # 单次退避的最长等待时间（秒）
+        "max_retry_after": 30.0,  # 服务端要求的Retry-After超过该秒数时不再重试
+        "retry_budget_ratio": 0.2,  # 重试预算：统计窗口内重试次数不超过请求数的该比例（另有最少重试次数保底）
+        "retry_budget_min": 3,  # 统计窗口内无论请求数多少都允许的重试次数
+        "retry_budget_window": 10.0,  # 重试预算统计窗口（秒）
+        "breaker_failures": int(get_env_var("HTTP_BREAKER_FAILURES", "5")),  # 同一端点连续失败该次数后熔断
+        "breaker_reset": float(get_env_var("HTTP_BREAKER_RESET", "30")),  # 熔断后经过该秒数放行一次试探请求
+    },
+    "history_search": {  # 历史记录全文检索（倒排索引，写入时增量更新）
+        "enabled": get_env_var("HISTORY_SEARCH", "True").lower() == "true",
+        "max_page_size": 50,  # 每页最多返回的检索结果数
+        "snippet_chars": 40,  # 结果摘要在命中词前后保留的字符数
+    },
     "show_scene_name": True,  # 是否在前端显示场景名称
     "show_logo_splash": get_env_var("SHOW_LOGO_SPLASH", "True").lower() == "true",  # 是否显示启动logo动画
     "auto_open_browser": get_env_var("AUTO_OPEN_BROWSER", "True").lower() == "true",  # 是否自动打开浏览器（会自动使用本地IP地址）
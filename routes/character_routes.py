@@ -23,6 +23,7 @@ from services.config_service import config_service
 need_config = not config_service.initialize()
 if not need_config:
     from services.chat_service import chat_service
+    from services.warmup_service import warmup_service
 import rtoml
 
 bp = Blueprint('character', __name__, url_prefix='')
@@ -31,6 +32,7 @@ bp = Blueprint('character', __name__, url_prefix='')
 # 导入文本处理工具
 # ------------------------------------------------------------------
 from utils.text_utils import get_last_assistant_sentence_for_character
+from utils.prompt_cache import prompt_cache
 
 # ------------------------------------------------------------------
 # 页面路由
@@ -133,7 +135,8 @@ def set_character(character_id):
                 return jsonify({
                     'success': True,
                     'character': character_config,
-                    'message': f"角色已切换为 {character_config['name']}"
+                    'message': f"角色已切换为 {character_config['name']}",
+                    'warmup': warmup_service.get_status(character_id)
                 })
             return jsonify({'success': False, 'error': f"未找到角色: {character_id}"}), 404
         except Exception as e:
@@ -452,6 +455,11 @@ def get_character_config():
             with open(character_toml_path, 'w', encoding='utf-8') as f:
                 f.write(rtoml.dumps(character_config))
         
+        # 覆盖已有角色时丢弃旧配置和由其拼接的提示词片段
+        import characters
+        characters._character_configs.pop(character_id, None)
+        prompt_cache.invalidate(character_id=character_id)
+        
         # 处理角色详细信息文件
         if detail_files:
             from services.character_details_service import character_details_service
@@ -514,6 +522,7 @@ def reload_characters():
     try:
         import characters
         characters._character_configs.clear()
+        prompt_cache.invalidate()
         available_characters = config_service.list_available_characters()
         return jsonify({'success': True, 'characters': available_characters})
     except Exception as e:
@@ -756,6 +765,9 @@ def delete_character(character_id):
             character_toml_path.unlink()
         if character_py_path.exists():
             character_py_path.unlink()
+        import characters
+        characters._character_configs.pop(character_id, None)
+        prompt_cache.invalidate(character_id=character_id)
 
         # 删除角色详细信息文件
         detail_file_path = project_root / 'data' / 'details' / f"{character_id}.json"
@@ -776,6 +788,11 @@ def delete_character(character_id):
         app_conf = config_service.get_app_config()
         history_dir = app_conf.get("history_dir", project_root / "data" / "history")
         history_file = Path(history_dir) / f"{character_id}_history.log"
+        # 先通过历史管理器清空（关闭写入句柄、删除归档分段/数据库记录和检索索引）
+        from utils.history_utils import get_history_manager
+        history_manager = get_history_manager()
+        history_manager.clear_history(character_id)
+        history_manager.invalidate(str(history_file))
         if history_file.exists():
             history_file.unlink()
 
@@ -4,7 +4,6 @@
 """
 import os
 import json
-import re
 import traceback
 from pathlib import Path
 from flask import Blueprint, request, render_template, jsonify, Response, send_file
@@ -16,12 +15,14 @@ sys.path.insert(0, str(project_root))
 
 # 只有在非配置模式下才导入服务
 from services.config_service import config_service
+from services.session_service import session_service
 need_config = not config_service.initialize()
 if not need_config:
     from services.chat_service import chat_service
     from services.image_service import image_service
     from services.scene_service import scene_service
     from services.option_service import option_service
+    from services.warmup_service import warmup_service
     from utils.api_utils import APIError
 
 bp = Blueprint('chat', __name__, url_prefix='')
@@ -29,6 +30,17 @@ bp = Blueprint('chat', __name__, url_prefix='')
 # ------------------------------------------------------------------
 # 导入文本处理工具
 from utils.text_utils import get_last_assistant_sentence_for_character
+from utils.stream_parser import ReplyStreamParser
+from utils.sse_utils import SSEFrameCoalescer, sse_frame
+from utils.stream_control import stream_registry, CANCEL_DISCONNECT
+from utils.post_stream import run_post_stream_tasks, get_task_timeout, get_post_stream_stats
+from utils.prompt_cache import prompt_cache
+from utils.page_cache import page_cache
+from utils.usage_stats import get_usage_stats
+from utils.query_gate import get_query_gate
+from utils.retrieval_cache import get_retrieval_cache_stats
+from utils.retrieval_deadline import get_retrieval_deadline_stats
+from utils.http_client import get_http_client
 
 # ------------------------------------------------------------------
 # 页面路由
@@ -41,29 +53,23 @@ def home():
 
 @bp.route('/chat')
 def chat_page():
+    character_id = None
     try:
         if getattr(chat_service, "story_mode", False):
             chat_service.exit_story_mode()
         current_character = chat_service.get_character_config()
         if current_character and "id" in current_character:
-            chat_service.set_character(current_character["id"])
+            character_id = current_character["id"]
+            # 已是当前角色时不重新加载历史记录和记忆
+            chat_service.activate_character(character_id)
     except Exception as e:
         print(f"进入聊天页切换角色失败: {e}")
         traceback.print_exc()
 
-    # 使用新的场景服务获取背景
+    # 背景、最后一句回复和插件脚本只在历史记录或背景变化时重新计算（见utils.page_cache）
     background_url = None
     try:
-        from services.scene_service import scene_service
-        
-        # 获取当前角色ID
-        current_character = chat_service.get_character_config()
-        character_id = current_character.get("id") if current_character else None
-        
-        # 获取最后使用的背景
-        last_background = scene_service.get_last_background(character_id=character_id)
-        if last_background:
-            background_url = scene_service.get_background_url(last_background)
+        background_url = page_cache.get("background_url", lambda: _last_background_url(character_id), character_id)
     except Exception as e:
         print(f"获取背景失败: {e}")
 
@@ -75,20 +81,15 @@ def chat_page():
     show_scene_name = app_config.get("show_scene_name", True)
 
     last_sentence = ""
-    try:
-        current_character = chat_service.get_character_config()
-        if current_character and "id" in current_character:
-            last_sentence = get_last_assistant_sentence_for_character(current_character["id"]) or ""
-    except Exception:
-        pass
+    if character_id:
+        try:
+            last_sentence = page_cache.get(
+                "last_sentence", lambda: get_last_assistant_sentence_for_character(character_id) or "", character_id
+            )
+        except Exception:
+            pass
 
-    from utils.plugin import FRONTEND_HOOKS
-    plugin_inject_scripts = []
-    def collect_inject(route, path):
-        if route.endswith('/inject.js'):
-            plugin_inject_scripts.append(route)
-    for hook in FRONTEND_HOOKS:
-        hook(collect_inject)
+    plugin_inject_scripts = page_cache.get("plugin_scripts", _collect_plugin_inject_scripts)
 
     return render_template(
         'chat.html',
@@ -98,6 +99,26 @@ def chat_page():
         plugin_inject_scripts=plugin_inject_scripts
     )
 
+def _last_background_url(character_id):
+    """获取角色最后使用的背景地址（使用场景服务）"""
+    from services.scene_service import scene_service
+
+    last_background = scene_service.get_last_background(character_id=character_id)
+    if last_background:
+        return scene_service.get_background_url(last_background)
+    return None
+
+def _collect_plugin_inject_scripts():
+    """收集前端插件注入的脚本"""
+    from utils.plugin import FRONTEND_HOOKS
+    plugin_inject_scripts = []
+    def collect_inject(route, path):
+        if route.endswith('/inject.js'):
+            plugin_inject_scripts.append(route)
+    for hook in FRONTEND_HOOKS:
+        hook(collect_inject)
+    return plugin_inject_scripts
+
 # ------------------------------------------------------------------
 # API 路由
 # ------------------------------------------------------------------
@@ -131,113 +152,134 @@ def chat_stream():
         option_generation_enabled = request.json.get('optionGenerationEnabled', True)
         if not message:
             return jsonify({'success': False, 'error': '消息不能为空'}), 400
-        chat_service.add_message("user", message)
+        user_message = chat_service.add_message("user", message)
 
         def generate():
+            stream_handle = stream_registry.open("chat", session_service.current().session_id)
             try:
+                yield sse_frame({'streamId': stream_handle.stream_id})
                 stream_gen = chat_service.chat_completion(stream=True, user_query=message)
                 full_response = ""
-                parsed_mood = None
-                parsed_content = ""
+                reply_parser = ReplyStreamParser()
+                coalescer = SSEFrameCoalescer.from_config()
                 
-                for chunk in stream_gen:
+                for chunk in stream_handle.relay(stream_gen):
                     if chunk is not None:
                         full_response += chunk
                         
-                        # 实时解析JSON内容，即使不完整
-                        try:
-                            # 尝试提取content字段，即使JSON不完整
-                            content_match = re.search(r'"content":\s*"([^"]*)', full_response)
-                            if content_match:
-                                current_content = content_match.group(1)
-                                
-                                # 处理转义字符
-                                current_content = current_content.replace('\\"', '"')
-                                current_content = current_content.replace('\\\\', '\\')
-                                
-                                if current_content != parsed_content:
-                                    # 检查是否是新的响应（内容变短）
-                                    if len(current_content) < len(parsed_content):
-                                        # 新的响应开始，发送完整内容
-                                        yield f"data: {json.dumps({'content': current_content})}\n\n"
-                                        parsed_content = current_content
-                                    else:
-                                        # 同一响应的增量内容
-                                        content_diff = current_content[len(parsed_content):]
-                                        if content_diff:
-                                            yield f"data: {json.dumps({'content': content_diff})}\n\n"
-                                        parsed_content = current_content
-                            
-                            # 同时尝试提取mood字段（支持int和string类型）
-                            mood_match = re.search(r'"mood":\s*("[^"]*"|\d+)', full_response)
-                            if mood_match:
-                                mood_str = mood_match.group(1)
-                                try:
-                                    # 如果是引号包围的字符串
-                                    if mood_str.startswith('"') and mood_str.endswith('"'):
-                                        current_mood = mood_str[1:-1]
-                                    else:
-                                        # 如果是数字
-                                        current_mood = int(mood_str)
-                                    
-                                    if current_mood != parsed_mood:
-                                        yield f"data: {json.dumps({'mood': current_mood})}\n\n"
-                                        parsed_mood = current_mood
-                                except (ValueError, TypeError):
-                                    pass
-                                    
-                        except Exception as e:
-                            # JSON解析失败，尝试作为普通文本发送
-                            yield f"data: {json.dumps({'content': chunk})}\n\n"
+                        # 增量解析JSON回复：mood完整后立即发送，content增量合并成较少的帧发送
+                        for frame in coalescer.push_events(reply_parser.feed(chunk)):
+                            yield frame
+                for frame in coalescer.push_events(reply_parser.close()) + coalescer.flush():
+                    yield frame
+                
+                # 已取消：不保存回复，跳过记忆写入和选项生成
+                if stream_handle.cancelled:
+                    yield sse_frame({'cancelled': True})
+                    yield "data: [DONE]\n\n"
+                    return
                 
                 # 处理完整响应（保持原有逻辑）
                 if full_response:
-                    chat_service.add_message("assistant", full_response)
-                    try:
+                    assistant_message = chat_service.add_message("assistant", full_response)
+                    assistant_content = assistant_message.get_parsed()["content"]
+
+                    def remember():
                         if chat_service.story_mode and chat_service.current_story_id:
-                            chat_service.memory_service.add_story_conversation(
+                            memory_ids = chat_service.memory_service.add_story_conversation(
                                 user_message=message,
                                 assistant_message=full_response,
-                                story_id=chat_service.current_story_id
+                                story_id=chat_service.current_story_id,
+                                assistant_content=assistant_content
                             )
                         else:
                             character_id = chat_service.config_service.current_character_id or "default"
-                            chat_service.memory_service.add_conversation(
+                            memory_ids = chat_service.memory_service.add_conversation(
                                 user_message=message,
                                 assistant_message=full_response,
-                                character_name=character_id
+                                character_name=character_id,
+                                assistant_content=assistant_content
                             )
-                    except Exception as e:
-                        print(f"添加对话到记忆数据库失败: {e}")
-                    try:
-                        conversation_history = chat_service.format_messages()
-                        character_config = chat_service.get_character_config()
-                        options = option_service.generate_options(
-                            conversation_history=conversation_history,
-                            character_config=character_config,
+                        chat_service.link_memory_ids([user_message, assistant_message], memory_ids)
+
+                    def generate_options():
+                        return option_service.generate_options(
+                            conversation_history=chat_service.format_messages(),
+                            character_config=chat_service.get_character_config(),
                             user_query=message
                         )
-                        if options:
-                            yield f"data: {json.dumps({'options': options})}\n\n"
-                    except Exception as e:
-                        print(f"选项生成失败: {e}")
+
+                    # 记忆写入和选项生成并发执行，选项生成完成后立即发送
+                    for name, result in run_post_stream_tasks([
+                        ("memory", remember, get_task_timeout("memory")),
+                        ("options", generate_options, get_task_timeout("options")),
+                    ]):
+                        if name == "options" and result:
+                            yield sse_frame({'options': result})
                 yield "data: [DONE]\n\n"
+            except GeneratorExit:
+                # 客户端断开连接：停止读取上游流
+                stream_handle.cancel(CANCEL_DISCONNECT)
+                raise
             except Exception as e:
                 yield f"data: {json.dumps({'error': str(e)})}\n\n"
                 yield "data: [DONE]\n\n"
+            finally:
+                stream_handle.close()
 
         headers = {
             'Content-Type': 'text/event-stream',
             'Cache-Control': 'no-cache',
             'X-Accel-Buffering': 'no'
         }
-        return Response(generate(), mimetype='text/event-stream', headers=headers)
+        return Response(session_service.bound(generate()), mimetype='text/event-stream', headers=headers)
         
     except APIError as e:
         return jsonify({'success': False, 'error': e.message}), 500
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@bp.route('/api/chat/cancel', methods=['POST'])
+def cancel_chat_stream():
+    """取消当前会话正在进行的流式对话（不传streamId时取消当前会话所有正在进行的流）"""
+    try:
+        data = request.get_json(silent=True) or {}
+        cancelled = stream_registry.cancel(session_service.current().session_id, data.get('streamId'))
+        return jsonify({'success': True, 'cancelled': cancelled, 'stats': stream_registry.get_stats()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@bp.route('/api/chat/prefetch', methods=['POST'])
+def prefetch_chat_context():
+    """预取检索结果（前端在输入停顿和页面加载时调用，不传message时使用最后一条角色回复）"""
+    try:
+        data = request.get_json(silent=True) or {}
+        started = chat_service.prefetch_context(data.get('message', ''))
+        return jsonify({'success': True, 'started': started})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@bp.route('/api/chat/warmup', methods=['GET'])
+def get_warmup_status():
+    """获取当前角色（剧情模式下为当前故事）的预热状态"""
+    try:
+        character_id = config_service.current_character_id
+        story_id = chat_service.current_story_id if chat_service.story_mode else None
+        return jsonify({'success': True, 'characterId': character_id, 'storyId': story_id,
+                        'warmup': warmup_service.get_status(character_id, story_id)})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@bp.route('/api/chat/stream/stats', methods=['GET'])
+def get_stream_stats():
+    """获取流式输出统计（包括被取消的token数、回复结束后的后续任务耗时、提示词缓存命中情况和检索统计）"""
+    return jsonify({'success': True, 'stats': stream_registry.get_stats(), 'postTasks': get_post_stream_stats(),
+                    'promptCache': prompt_cache.get_stats(), 'usage': get_usage_stats(),
+                    'queryGate': get_query_gate().get_stats(), 'retrievalCache': get_retrieval_cache_stats(),
+                    'retrievalDeadline': get_retrieval_deadline_stats(), 'warmup': warmup_service.get_stats(),
+                    'pageCache': page_cache.get_stats(),
+                    'http': get_http_client().get_stats()})
+
 @bp.route('/api/background', methods=['POST'])
 def generate_background():
     try:
@@ -503,4 +545,47 @@ def get_history_paginated():
         return jsonify({
             'success': False,
             'error': str(e)
-        }), 500
\ No newline at end of file
+        }), 500
+
+@bp.route('/api/history/search', methods=['GET'])
+def search_history():
+    """全文检索当前角色的历史记录"""
+    try:
+        query = request.args.get('q', '').strip()
+        page = int(request.args.get('page', 1))
+        page_size = int(request.args.get('page_size', 20))
+        if not query:
+            return jsonify({'success': False, 'error': '查询内容不能为空'}), 400
+        if not chat_service.history_manager.search_index.enabled:
+            return jsonify({'success': False, 'error': '历史记录检索未启用'}), 400
+        
+        # 获取当前角色
+        current_character = chat_service.get_character_config()
+        if not current_character or "id" not in current_character:
+            return jsonify({
+                'success': False,
+                'error': '未选择角色'
+            }), 400
+        
+        result = chat_service.history_manager.search_history(
+            character_id=current_character["id"],
+            query=query,
+            page=page,
+            page_size=page_size
+        )
+        
+        return jsonify({
+            'success': True,
+            'data': result
+        })
+        
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': f'参数错误: {str(e)}'
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
@@ -32,6 +32,11 @@ def load_env_example_defaults():
     
     return defaults
 
+def _invalidate_prompt_cache():
+    """配置保存后清除缓存的提示词片段"""
+    from utils.prompt_cache import prompt_cache
+    prompt_cache.invalidate()
+
 @bp.route('/config/simple', methods=['POST'])
 def save_simple_config():
     """简易配置：使用单个API密钥配置所有服务"""
@@ -65,6 +70,7 @@ def save_simple_config():
     try:
         with open(env_path, 'w', encoding='utf-8') as f:
             f.write(env_content)
+        _invalidate_prompt_cache()
         return '''<div style="padding:2em;text-align:center;font-size:1.2em;color:green;">✅ 简易配置已保存！<br>使用默认推荐设置，API密钥已应用到所有服务。<br><br>请重新打开本程序谢谢!</div>'''
     except Exception as e:
         return f'''<div style="padding:2em;text-align:center;font-size:1.2em;color:red;">❌ 保存配置时出错：{str(e)}</div>'''
@@ -98,6 +104,7 @@ def save_config():
     env_path = project_root / '.env'
     with open(env_path, 'w', encoding='utf-8') as f:
         f.write(env_content)
+    _invalidate_prompt_cache()
     return '''<div style="padding:2em;text-align:center;font-size:1.2em;">配置已保存！<br>请重新打开本程序谢谢!</div>'''
 
 @bp.route('/api/exit', methods=['POST'])
@@ -5,7 +5,6 @@
 """
 import os
 import json
-import re
 import traceback
 from pathlib import Path
 from flask import Blueprint, request, jsonify, Response
@@ -15,15 +14,20 @@ project_root = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(project_root))
 
 from services.config_service import config_service
+from services.session_service import session_service
 need_config = not config_service.initialize()
 if not need_config:
     from services.multi_character_service import multi_character_service
     from services.story_service import story_service
-    from utils.history_utils import HistoryManager
+    from utils.history_utils import get_history_manager
+    from utils.text_utils import get_parsed_message
+    from utils.stream_parser import ReplyStreamParser
+    from utils.sse_utils import SSEFrameCoalescer, sse_frame
+    from utils.stream_control import stream_registry, CANCEL_DISCONNECT
 
 bp = Blueprint('multi_character', __name__, url_prefix='/api/multi-character')
 
-def handle_next_speaker_recursively(story_id, max_history, characters, max_depth, current_depth,isPlayer):
+def handle_next_speaker_recursively(story_id, max_history, characters, max_depth, current_depth,isPlayer, stream_handle):
     """
     递归处理下一个说话者，避免无限循环
     
@@ -33,7 +37,10 @@ def handle_next_speaker_recursively(story_id, max_history, characters, max_depth
         characters: 角色列表
         max_depth: 最大递归深度
         current_depth: 当前递归深度
+        stream_handle: 本次流式输出的控制句柄（被取消时停止递归）
     """
+    if stream_handle.cancelled:
+        return
     if current_depth >= max_depth:
         print(f"达到最大递归深度 {max_depth}，停止角色自动回复")
         yield f"data: {json.dumps({'nextSpeaker': 'player', 'message': '对话轮次过多，请继续'})}\n\n"
@@ -45,11 +52,7 @@ def handle_next_speaker_recursively(story_id, max_history, characters, max_depth
     try:
         # 获取聊天历史用于导演判断
         history_path = story_service.get_story_history_path()
-        app_config = config_service.get_app_config()
-        history_dir = app_config["history_dir"]
-        history_manager = HistoryManager(history_dir)
-        
-        history_messages = history_manager.load_history_from_file(history_path, max_history, max_history * 2)
+        history_messages = get_history_manager().load_history_from_file(history_path, max_history, max_history * 2)
         
         # 构建聊天历史文本
         chat_history_text = ""
@@ -57,12 +60,8 @@ def handle_next_speaker_recursively(story_id, max_history, characters, max_depth
             if msg["role"] == "user":
                 chat_history_text += f"玩家：{msg['content']}\n"
             elif msg["role"] == "assistant" or msg["role"] in [char['id'] for char in characters]:
-                # 解析JSON格式的回复，只取content部分
-                try:
-                    msg_data = json.loads(msg['content'])
-                    content = msg_data.get('content', msg['content'])
-                except:
-                    content = msg['content']
+                # 使用预解析的回复内容
+                content = get_parsed_message(msg)["content"]
                 
                 # 获取角色名
                 speaker_id = msg.get('speaker_character_id') or msg["role"]
@@ -88,22 +87,7 @@ def handle_next_speaker_recursively(story_id, max_history, characters, max_depth
             story_service.update_progress(offset_increment=director_offset)
         
         # 发送故事进度更新
-        current_idx, current_chapter, next_chapter = story_service.get_current_chapter_info()
-        current_offset = story_service.get_offset()
-        
-        progress_update = {
-            'storyProgress': {
-                'current': current_idx,
-                'currentChapter': current_chapter,
-                'nextChapter': next_chapter,
-                'offset': current_offset
-            }
-        }
-        
-        if story_service.is_story_finished():
-            progress_update['storyFinished'] = True
-        
-        yield f"data: {json.dumps(progress_update)}\n\n"
+        yield f"data: {json.dumps(story_service.get_progress_update())}\n\n"
         
         # 处理下次说话角色
         if 0 <= next_speaker < len(characters):
@@ -124,7 +108,7 @@ def handle_next_speaker_recursively(story_id, max_history, characters, max_depth
                 try:
                     # 获取历史消息用于角色回复
                     history_messages_dict = [
-                        {"role": msg["role"], "content": msg["content"]}
+                        {"role": msg["role"], "content": msg["content"], "parsed": get_parsed_message(msg)}
                         for msg in history_messages
                     ]
                     
@@ -135,11 +119,7 @@ def handle_next_speaker_recursively(story_id, max_history, characters, max_depth
                         if last_msg["role"] == "user":
                             last_message = last_msg["content"]
                         elif last_msg["role"] == "assistant" or last_msg["role"] in [char['id'] for char in characters]:
-                            try:
-                                msg_data = json.loads(last_msg["content"])
-                                last_message = msg_data.get('content', last_msg["content"])
-                            except:
-                                last_message = last_msg["content"]
+                            last_message = get_parsed_message(last_msg)["content"]
                     
                     # 调用角色回复API
                     character_stream = multi_character_service.chat_completion_for_character(
@@ -151,58 +131,23 @@ def handle_next_speaker_recursively(story_id, max_history, characters, max_depth
                     
                     # 发送角色回复
                     full_response = ""
-                    parsed_content = ""
-                    parsed_mood = None
+                    reply_parser = ReplyStreamParser()
                     yield f"data: {json.dumps({'characterResponse': True, 'characterID': next_character['id'], 'characterName': next_character['name']})}\n\n"
                     
-                    for chunk in character_stream:
+                    # 增量解析JSON回复，content增量合并成较少的帧，字段名映射为角色回复事件
+                    coalescer = SSEFrameCoalescer.from_config({"content": "characterContent", "mood": "characterMood"})
+                    for chunk in stream_handle.relay(character_stream):
                         if chunk is not None:
                             full_response += chunk
-                            
-                            # 实时解析JSON内容，即使不完整
-                            try:
-                                # 尝试提取content字段，即使JSON不完整
-                                content_match = re.search(r'"content":\s*"([^"]*)', full_response)
-                                if content_match:
-                                    current_content = content_match.group(1)
-                                    
-                                    # 处理转义字符
-                                    current_content = current_content.replace('\\"', '"')
-                                    current_content = current_content.replace('\\\\', '\\')
-                                    
-                                    if current_content != parsed_content:
-                                        # 检查是否是新的响应（内容变短）
-                                        if len(current_content) < len(parsed_content):
-                                            # 新的响应开始，发送完整内容
-                                            yield f"data: {json.dumps({'characterContent': current_content})}\n\n"
-                                            parsed_content = current_content
-                                        else:
-                                            # 同一响应的增量内容
-                                            content_diff = current_content[len(parsed_content):]
-                                            if content_diff:
-                                                yield f"data: {json.dumps({'characterContent': content_diff})}\n\n"
-                                            parsed_content = current_content
-
-                                # 同时尝试提取mood字段（支持int和string类型）
-                                mood_match = re.search(r'"mood":\s*("[^"]*"|\d+)', full_response)
-                                if mood_match:
-                                    mood_str = mood_match.group(1)
-                                    try:
-                                        # 如果是引号包围的字符串
-                                        if mood_str.startswith('"') and mood_str.endswith('"'):
-                                            current_mood = mood_str[1:-1]
-                                        else:
-                                            # 如果是数字
-                                            current_mood = int(mood_str)
-
-                                        if current_mood != parsed_mood:
-                                            yield f"data: {json.dumps({'characterMood': current_mood})}\n\n"
-                                            parsed_mood = current_mood
-                                    except (ValueError, TypeError):
-                                        pass
-                            except Exception as e:
-                                # JSON解析失败，尝试作为普通文本发送
-                                yield f"data: {json.dumps({'characterContent': chunk})}\n\n"
+                            for frame in coalescer.push_events(reply_parser.feed(chunk)):
+                                yield frame
+                    for frame in coalescer.push_events(reply_parser.close()) + coalescer.flush():
+                        yield frame
+                    
+                    # 已取消：不保存回复，不再继续递归和生成选项
+                    if stream_handle.cancelled:
+                        yield sse_frame({'cancelled': True})
+                        return
                     
                     # 保存角色回复到历史记录和记忆
                     if full_response:
@@ -215,7 +160,7 @@ def handle_next_speaker_recursively(story_id, max_history, characters, max_depth
                     yield f"data: {json.dumps({'characterResponseComplete': True})}\n\n"
                     
                     # 递归处理下一个说话者
-                    yield from handle_next_speaker_recursively(story_id, max_history, characters, max_depth, current_depth + 1, False)
+                    yield from handle_next_speaker_recursively(story_id, max_history, characters, max_depth, current_depth + 1, False, stream_handle)
                     
                 except Exception as e:
                     print(f"角色自动回复失败: {e}")
@@ -246,11 +191,9 @@ def generate_options_after_recursion(story_id):
         # 获取聊天历史
         history_path = story_service.get_story_history_path()
         app_config = config_service.get_app_config()
-        history_dir = app_config["history_dir"]
-        history_manager = HistoryManager(history_dir)
         
         # 加载历史消息
-        history_messages = history_manager.load_history_from_file(
+        history_messages = get_history_manager().load_history_from_file(
             history_path, 
             app_config["max_history_length"], 
             app_config["max_history_length"] * 2
@@ -262,12 +205,8 @@ def generate_options_after_recursion(story_id):
             if msg["role"] == "user":
                 conversation_history.append({"role": "user", "content": msg["content"]})
             else:
-                # 尝试解析JSON格式的回复
-                try:
-                    msg_data = json.loads(msg["content"])
-                    content = msg_data.get("content", msg["content"])
-                except:
-                    content = msg["content"]
+                # 使用预解析的回复内容
+                content = get_parsed_message(msg)["content"]
                 conversation_history.append({"role": msg["role"], "content": content})
         
         # 获取最后一个用户消息（如果有）
@@ -324,14 +263,12 @@ def multi_character_chat_stream():
             return jsonify({'success': False, 'error': f'故事 {story_id} 不存在'}), 404
         
         def generate():
+            stream_handle = stream_registry.open("multi_character", session_service.current().session_id)
             try:
+                yield sse_frame({'streamId': stream_handle.stream_id})
                 # 保存用户消息到历史记录
                 history_path = story_service.get_story_history_path()
-                app_config = config_service.get_app_config()
-                history_dir = app_config["history_dir"]
-                history_manager = HistoryManager(history_dir)
-                
-                history_manager.save_message_to_file(
+                get_history_manager().save_message_to_file(
                     history_path, 
                     "user", 
                     message,
@@ -353,14 +290,20 @@ def multi_character_chat_stream():
                 max_history = config_service.get_app_config()["max_history_length"]
                 
                 # 处理下一个说话者（可能触发角色自动回复）
-                yield from handle_next_speaker_recursively(story_id, max_history, characters,5,0,True)
+                yield from handle_next_speaker_recursively(story_id, max_history, characters,5,0,True, stream_handle)
                 
+            except GeneratorExit:
+                # 客户端断开连接：停止读取上游流
+                stream_handle.cancel(CANCEL_DISCONNECT)
+                raise
             except Exception as e:
                 print(f"多角色对话流处理失败: {e}")
                 traceback.print_exc()
                 yield f"data: {json.dumps({'error': f'对话处理失败: {str(e)}'})}\n\n"
+            finally:
+                stream_handle.close()
         
-        return Response(generate(), mimetype='text/event-stream')
+        return Response(session_service.bound(generate()), mimetype='text/event-stream')
         
     except Exception as e:
         traceback.print_exc()
@@ -17,12 +17,18 @@ project_root = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(project_root))
 
 from services.config_service import config_service
+from services.session_service import session_service
+from utils.prompt_cache import prompt_cache
 need_config = not config_service.initialize()
 if not need_config:
     from services.chat_service import chat_service
     from services.image_service import image_service
     from services.story_service import story_service
     from services.option_service import option_service
+    from utils.stream_parser import ReplyStreamParser
+    from utils.sse_utils import SSEFrameCoalescer, sse_frame
+    from utils.stream_control import stream_registry, CANCEL_DISCONNECT
+    from utils.post_stream import run_post_stream_tasks, get_task_timeout
 
 bp = Blueprint('story', __name__, url_prefix='')
 # ------------------------------------------------------------------
@@ -375,6 +381,8 @@ def create_story():
         }
         with open(story_dir / 'story.toml', 'w', encoding='utf-8') as f:
             rtoml.dump(story_toml_data, f)
+        # 同ID的故事目录可能被手动删除后重建，清除旧故事的提示词片段
+        prompt_cache.invalidate(story_id=story_id)
         return jsonify({'success': True, 'message': '故事创建成功', 'story_id': story_id})
     except Exception as e:
         traceback.print_exc()
@@ -435,70 +443,40 @@ def story_chat_stream():
         
         # 单角色故事，继续使用原有逻辑
         chat_service.set_story_mode(story_id)
-        chat_service.add_message("user", message)
+        user_message = chat_service.add_message("user", message)
 
         def generate():
+            stream_handle = stream_registry.open("story", session_service.current().session_id)
             try:
+                yield sse_frame({'streamId': stream_handle.stream_id})
                 stream_gen = chat_service.chat_completion(stream=True, user_query=message)
                 full_response = ""
-                parsed_mood = None
-                parsed_content = ""
+                reply_parser = ReplyStreamParser()
+                coalescer = SSEFrameCoalescer.from_config()
                 
-                for chunk in stream_gen:
+                for chunk in stream_handle.relay(stream_gen):
                     if chunk is not None:
                         full_response += chunk
                         
-                        # 实时解析JSON内容，即使不完整
-                        try:
-                            # 尝试提取content字段，即使JSON不完整
-                            content_match = re.search(r'"content":\s*"([^"]*)', full_response)
-                            if content_match:
-                                current_content = content_match.group(1)
-                                
-                                # 处理转义字符
-                                current_content = current_content.replace('\\"', '"')
-                                current_content = current_content.replace('\\\\', '\\')
-                                
-                                if current_content != parsed_content:
-                                    # 检查是否是新的响应（内容变短）
-                                    if len(current_content) < len(parsed_content):
-                                        # 新的响应开始，发送完整内容
-                                        yield f"data: {json.dumps({'content': current_content})}\n\n"
-                                        parsed_content = current_content
-                                    else:
-                                        # 同一响应的增量内容
-                                        content_diff = current_content[len(parsed_content):]
-                                        if content_diff:
-                                            yield f"data: {json.dumps({'content': content_diff})}\n\n"
-                                        parsed_content = current_content
-                            
-                            # 同时尝试提取mood字段（支持int和string类型）
-                            mood_match = re.search(r'"mood":\s*("[^"]*"|\d+)', full_response)
-                            if mood_match:
-                                mood_str = mood_match.group(1)
-                                try:
-                                    # 如果是引号包围的字符串
-                                    if mood_str.startswith('"') and mood_str.endswith('"'):
-                                        current_mood = mood_str[1:-1]
-                                    else:
-                                        # 如果是数字
-                                        current_mood = int(mood_str)
-
-                                    if current_mood != parsed_mood:
-                                        yield f"data: {json.dumps({'mood': current_mood})}\n\n"
-                                        parsed_mood = current_mood
-                                except (ValueError, TypeError):
-                                    pass
-                                    
-                        except Exception as e:
-                            # JSON解析失败，尝试作为普通文本发送
-                            yield f"data: {json.dumps({'content': chunk})}\n\n"
+                        # 增量解析JSON回复：mood完整后立即发送，content增量合并成较少的帧发送
+                        for frame in coalescer.push_events(reply_parser.feed(chunk)):
+                            yield frame
+                for frame in coalescer.push_events(reply_parser.close()) + coalescer.flush():
+                    yield frame
+                
+                # 已取消：不保存回复，跳过记忆写入、导演判断和选项生成
+                if stream_handle.cancelled:
+                    yield sse_frame({'cancelled': True})
+                    yield "data: [DONE]\n\n"
+                    return
                 
                 # 将完整消息添加到历史记录（存储原始响应内容）
                 if full_response:
-                    chat_service.add_message("assistant", full_response)
-                    # 添加到记忆数据库（存储原始响应内容）
-                    try:
+                    assistant_message = chat_service.add_message("assistant", full_response)
+                    assistant_content = assistant_message.get_parsed()["content"]
+                    
+                    def remember():
+                        # 添加到记忆数据库（存储原始响应内容）
                         # 检查是否为多角色故事
                         story_data = story_service.get_current_story_data()
                         characters = story_data.get('characters', {}).get('list', []) if story_data else []
@@ -508,7 +486,7 @@ def story_chat_stream():
                         
                         if is_multi_character:
                             # 多角色模式：分别添加用户和角色消息
-                            chat_service.memory_service.add_story_message(
+                            user_memory_id = chat_service.memory_service.add_story_message(
                                 speaker_name="玩家",
                                 message=message,
                                 story_id=story_id
@@ -521,24 +499,24 @@ def story_chat_stream():
                             else:
                                 character_name = "角色"
                             
-                            chat_service.memory_service.add_story_message(
+                            assistant_memory_id = chat_service.memory_service.add_story_message(
                                 speaker_name=character_name,
                                 message=full_response,
-                                story_id=story_id
+                                story_id=story_id,
+                                content=assistant_content
                             )
+                            memory_ids = [user_memory_id, assistant_memory_id]
                         else:
                             # 单角色模式：使用原有方法
-                            chat_service.memory_service.add_story_conversation(
+                            memory_ids = chat_service.memory_service.add_story_conversation(
                                 user_message=message,
                                 assistant_message=full_response,
-                                story_id=story_id
+                                story_id=story_id,
+                                assistant_content=assistant_content
                             )
-                    except Exception as e:
-                        print(f"添加对话到记忆数据库失败: {e}")
-                        traceback.print_exc()
+                        chat_service.link_memory_ids([user_message, assistant_message], memory_ids)
                     
-                    # 调用导演模型和生成选项（同步执行以便发送更新给前端）
-                    try:
+                    def direct():
                         # 获取聊天历史用于导演判断
                         app_config = config_service.get_app_config()
                         max_history = app_config["max_history_length"]
@@ -550,12 +528,8 @@ def story_chat_stream():
                             if msg.role == "user":
                                 chat_history_text += f"玩家：{msg.content}\n"
                             elif msg.role == "assistant":
-                                # 解析JSON格式的回复，只取content部分
-                                try:
-                                    msg_data = json.loads(msg.content)
-                                    content = msg_data.get('content', msg.content)
-                                except:
-                                    content = msg.content
+                                # 使用预解析的回复内容
+                                content = msg.get_parsed()["content"]
                                 
                                 # 获取角色名
                                 character_config = chat_service.get_character_config()
@@ -563,9 +537,8 @@ def story_chat_stream():
                                 chat_history_text += f"{character_name}：{content}\n"
                         
                         # 调用导演模型
-                        director_offset= story_service.call_director_model(chat_history_text)
+                        director_offset = story_service.call_director_model(chat_history_text)
                         # 处理导演结果
-                        story_finished = False
                         if director_offset == 0:
                             # 推进到下一章节
                             story_service.update_progress(advance_chapter=True)
@@ -573,48 +546,57 @@ def story_chat_stream():
                             # 检查是否故事结束
                             if story_service.is_story_finished():
                                 print("故事已结束")
-                                story_finished = True
                         else:
                             # 增加偏移值
                             story_service.update_progress(offset_increment=director_offset)
-                        
-                        #下次是玩家说话，正常等待用户输入
-                        yield f"data: {json.dumps({'nextSpeaker': 'player'})}\n\n"
-                        
-                    except Exception as e:
-                        print(f"导演模型处理失败: {e}")
-                        traceback.print_exc()
+                        return story_service.get_progress_update()
                     
-                    # 生成选项
-                    try:
-                        conversation_history = chat_service.format_messages()
-                        character_config = chat_service.get_character_config()
-                        options = option_service.generate_options(
-                            conversation_history=conversation_history,
-                            character_config=character_config,
+                    def generate_options():
+                        return option_service.generate_options(
+                            conversation_history=chat_service.format_messages(),
+                            character_config=chat_service.get_character_config(),
                             user_query=message
                         )
-                        
-                        if options:
-                            yield f"data: {json.dumps({'options': options})}\n\n"
-                    except Exception as e:
-                        print(f"选项生成失败: {e}")
-                        
+                    
+                    # 记忆写入、导演判断和选项生成并发执行，哪个先完成先发送
+                    player_turn_sent = False
+                    for name, result in run_post_stream_tasks([
+                        ("memory", remember, get_task_timeout("memory")),
+                        ("director", direct, get_task_timeout("director")),
+                        ("options", generate_options, get_task_timeout("options")),
+                    ]):
+                        if name == "director":
+                            yield sse_frame(result)
+                            #下次是玩家说话，正常等待用户输入
+                            yield sse_frame({'nextSpeaker': 'player'})
+                            player_turn_sent = True
+                        elif name == "options" and result:
+                            yield sse_frame({'options': result})
+                    if not player_turn_sent:
+                        # 导演判断失败或超时也要通知前端结束本轮，否则界面一直等待
+                        yield sse_frame({'nextSpeaker': 'player'})
+                
                 yield "data: [DONE]\n\n"
                 
+            except GeneratorExit:
+                # 客户端断开连接：停止读取上游流
+                stream_handle.cancel(CANCEL_DISCONNECT)
+                raise
             except Exception as e:
                 error_msg = str(e)
                 print(f"流式响应错误: {error_msg}")
                 traceback.print_exc()
                 yield f"data: {json.dumps({'error': error_msg})}\n\n"
                 yield "data: [DONE]\n\n"
+            finally:
+                stream_handle.close()
         
         headers = {
             'Content-Type': 'text/event-stream',
             'Cache-Control': 'no-cache',
             'X-Accel-Buffering': 'no'
         }
-        return Response(generate(), mimetype='text/event-stream', headers=headers)
+        return Response(session_service.bound(generate()), mimetype='text/event-stream', headers=headers)
     except Exception as e:
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -665,4 +647,47 @@ def get_story_history_paginated():
         return jsonify({
             'success': False,
             'error': str(e)
-        }), 500
\ No newline at end of file
+        }), 500
+
+@bp.route('/api/story/history/search', methods=['GET'])
+def search_story_history():
+    """全文检索当前故事的历史记录"""
+    try:
+        query = request.args.get('q', '').strip()
+        page = int(request.args.get('page', 1))
+        page_size = int(request.args.get('page_size', 20))
+        if not query:
+            return jsonify({'success': False, 'error': '查询内容不能为空'}), 400
+        if not chat_service.history_manager.search_index.enabled:
+            return jsonify({'success': False, 'error': '历史记录检索未启用'}), 400
+        
+        # 获取当前故事的历史记录文件路径
+        history_path = story_service.get_story_history_path()
+        if not history_path:
+            return jsonify({
+                'success': False,
+                'error': '未找到故事历史记录'
+            }), 400
+        
+        result = chat_service.history_manager.search_history_file(
+            file_path=history_path,
+            query=query,
+            page=page,
+            page_size=page_size
+        )
+        
+        return jsonify({
+            'success': True,
+            'data': result
+        })
+        
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': f'参数错误: {str(e)}'
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
@@ -7,6 +7,7 @@ import sys
 import logging
 import json
 import asyncio
+import threading
 from typing import Dict, Optional, List
 from pathlib import Path
 import traceback
@@ -25,6 +26,8 @@ class CharacterDetailsService:
     def __init__(self):
         """初始化角色详细信息服务"""
         self.details_databases: Dict[str, ChatHistoryVectorDB] = {}
+        # 加载锁（切换角色时的后台预热和检索可能同时加载同一个数据库）
+        self._init_lock = threading.Lock()
         self.logger = logging.getLogger("CharacterDetailsService")
         
         # 设置日志格式
@@ -46,15 +49,18 @@ class CharacterDetailsService:
             是否初始化成功
         """
         try:
-            if character_id not in self.details_databases:
-                # 创建新的详细信息数据库
-                details_db = CharacterDetailsVectorDB(
-                    RAG_config=get_RAG_config(), 
-                    character_id=character_id
-                )
-                details_db.initialize_database()
-                self.details_databases[character_id] = details_db
-                self.logger.info(f"初始化角色详细信息数据库: {character_id}")
+            if character_id in self.details_databases:
+                return True
+            with self._init_lock:
+                if character_id not in self.details_databases:
+                    # 创建新的详细信息数据库
+                    details_db = CharacterDetailsVectorDB(
+                        RAG_config=get_RAG_config(), 
+                        character_id=character_id
+                    )
+                    details_db.initialize_database()
+                    self.details_databases[character_id] = details_db
+                    self.logger.info(f"初始化角色详细信息数据库: {character_id}")
             
             return True
             
@@ -153,7 +159,8 @@ class CharacterDetailsService:
                 self.logger.error(f"异步角色详细信息检索失败: {e}")
                 return ""
     
-    def search_character_details(self, character_id: str, query: str, top_k: int = 3, timeout: int = 10) -> str:
+    def search_character_details(self, character_id: str, query: str, top_k: int = 3, timeout: int = 10,
+                                 cache=None) -> str:
         """
         搜索角色详细信息并返回格式化的提示词
         
@@ -162,6 +169,7 @@ class CharacterDetailsService:
             query: 查询文本
             top_k: 返回的最相似结果数量
             timeout: 超时时间（秒）
+            cache: 检索结果缓存（可选，见utils.retrieval_cache）
             
         返回:
             格式化的角色详细信息提示词
@@ -181,7 +189,7 @@ class CharacterDetailsService:
             self.logger.info(f"开始角色详细信息检索: 角色={character_id}, 查询='{query}', top_k={top_k}")
             
             # 搜索相关内容
-            results = details_db.search(query, top_k, timeout)
+            results = details_db.search(query, top_k, timeout, cache=cache)
             
             if not results:
                 self.logger.info(f"角色详细信息检索完成: 未找到相关内容")
@@ -253,6 +261,10 @@ class CharacterDetailsVectorDB(ChatHistoryVectorDB):
             self.logger.addHandler(handler)
             self.logger.setLevel(logging.INFO)
     
+    def _memory_owner(self) -> str:
+        """检索结果缓存中的记忆库标识（与角色记忆库区分）"""
+        return f"details:{self.character_name}"
+    
     def save_to_file(self, file_path: str = None):
         """
         将向量数据库保存到<角色ID>.json文件
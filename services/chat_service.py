@@ -7,32 +7,48 @@ import json
 import time
 import re
 import os
-from typing import List, Dict, Any, Optional, Iterator, Union, Tuple
+import asyncio
+from typing import List, Dict, Any, Optional, Iterator, AsyncIterator, Union, Tuple, Callable
 from pathlib import Path
 
 # 添加项目根目录到系统路径
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
 from utils.api_utils import make_api_request, APIError, handle_api_error, parse_stream_data
-from utils.history_utils import HistoryManager
+from utils.history_utils import get_history_manager
 from utils.prompt_logger import prompt_logger
+from utils.usage_stats import record_usage
+from utils.text_utils import parse_assistant_message
+from utils.prompt_cache import prompt_cache
+from utils.token_budget import ContextAssembler, layout_messages
 from services.config_service import config_service
+from services.session_service import session_service, ConversationContext
+from services.warmup_service import warmup_service
 from config import get_memory_config
-from utils.time_utils import TimeTracker
 # 注意：为了避免循环导入，scene_service和memory_service将在ChatService类中导入
 
 class Message:
     """消息类"""
-    def __init__(self, role: str, content: str):
+    def __init__(self, role: str, content: str, parsed: Optional[Dict[str, Any]] = None):
         """
         初始化消息
         
         Args:
             role: 消息角色（"system", "user", "assistant"）
             content: 消息内容
+            parsed: 预解析的助手回复字段（mood/content/sentences），为None时按需解析
         """
         self.role = role
         self.content = content
+        self.parsed = parsed
+        # 该消息在记忆库中的文档ID（写入记忆后记录，用于检索时排除已在上下文中的记忆）
+        self.memory_id: Optional[int] = None
+    
+    def get_parsed(self) -> Dict[str, Any]:
+        """获取预解析的助手回复字段（首次调用时解析并缓存）"""
+        if self.parsed is None:
+            self.parsed = parse_assistant_message(self.content)
+        return self.parsed
     
     def to_dict(self) -> Dict[str, str]:
         """转换为字典格式"""
@@ -44,13 +60,15 @@ class Message:
     @classmethod
     def from_dict(cls, data: Dict[str, str]) -> 'Message':
         """从字典创建消息"""
-        return cls(data["role"], data["content"])
+        message = cls(data["role"], data["content"], data.get("parsed"))
+        message.memory_id = data.get("memory_id")
+        return message
 
 
 
 
 import logging
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from tenacity import retry, stop_after_attempt, wait_exponential
 
 class ChatService:
@@ -70,13 +88,9 @@ class ChatService:
         if not self.config_service.initialized:
             self.config_service.initialize()
         
-        # 创建历史记录管理器
-        app_config = self.config_service.get_app_config()
-        history_dir = app_config["history_dir"]
-        self.history_manager = HistoryManager(history_dir)
-        
-        # 初始化时间跟踪器
-        self.time_tracker = TimeTracker(history_dir)
+        # 使用进程内共享的历史记录管理器（时间跟踪器由其在写入时更新）
+        self.history_manager = get_history_manager()
+        self.time_tracker = self.history_manager.time_tracker
         
         # 导入记忆服务（避免循环导入）
         from services.memory_service import memory_service
@@ -90,6 +104,7 @@ class ChatService:
         
         # 初始化OpenAI客户端
         self.openai_answer = True
+        self.async_client = None
         try:
             # 获取环境变量
             api_key = os.getenv("CHAT_API_KEY")
@@ -112,6 +127,13 @@ class ChatService:
                 timeout=60.0,  # 60秒超时
                 max_retries=3  # 最多重试3次
             )
+            # 异步客户端（ASGI入口使用）
+            self.async_client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=60.0,
+                max_retries=3
+            )
             self.chat_model = model
             
         except ImportError:
@@ -121,6 +143,42 @@ class ChatService:
             self.openai_answer = False
             self.logger.error(f"OpenAI客户端初始化失败: {e}")
     
+    def _context(self) -> ConversationContext:
+        """获取当前会话的对话上下文（新会话首次访问时加载当前角色的历史记录）"""
+        context = session_service.current()
+        if not context.history_loaded:
+            context.history_loaded = True
+            self._load_history_on_startup()
+            self.set_system_prompt("character")
+        return context
+    
+    @property
+    def history(self) -> List[Message]:
+        """当前会话的对话历史"""
+        return self._context().history
+    
+    @history.setter
+    def history(self, messages: List[Message]):
+        self._context().history = messages
+    
+    @property
+    def story_mode(self) -> bool:
+        """当前会话是否处于剧情模式"""
+        return self._context().story_mode
+    
+    @story_mode.setter
+    def story_mode(self, enabled: bool):
+        self._context().story_mode = enabled
+    
+    @property
+    def current_story_id(self) -> Optional[str]:
+        """当前会话的剧情模式故事ID"""
+        return self._context().current_story_id
+    
+    @current_story_id.setter
+    def current_story_id(self, story_id: Optional[str]):
+        self._context().current_story_id = story_id
+    
     def add_message(self, role: str, content: str, speaker_character_id: str = None) -> Message:
         """
         添加消息到历史记录
@@ -137,7 +195,7 @@ class ChatService:
         message = Message(role, content)
         self.history.append(message)
         # 限制历史记录长度
-        max_history = self.config_service.get_app_config()["max_history_length"]
+        max_history = self._history_limit()
         if len(self.history) > max_history:
             # 保留system消息
             system_messages = [msg for msg in self.history if msg.role == "system"]
@@ -157,7 +215,7 @@ class ChatService:
                 history_path = story_service.get_story_history_path()
                 
                 # 单角色模式下不需要复杂的多角色逻辑
-                self.history_manager.save_message_to_file(
+                record = self.history_manager.save_message_to_file(
                     history_path, role, content, 
                     is_multi_character=False,
                     speaker_character_id=None
@@ -165,10 +223,20 @@ class ChatService:
             else:
                 # 普通模式：保存到角色目录
                 character_id = self.config_service.current_character_id or "default"
-                self.history_manager.save_message(character_id, role, content)
+                record = self.history_manager.save_message(character_id, role, content)
+            # 复用保存时的预解析结果，避免重复解析
+            message.parsed = record.get("parsed")
         
         return message
     
+    def _history_limit(self) -> int:
+        """内存中保留的最多消息数（启用token预算时放宽上限，实际发送的条数由预算决定）"""
+        app_config = self.config_service.get_app_config()
+        budget_config = app_config.get("context_budget") or {}
+        if budget_config.get("enabled"):
+            return max(app_config["max_history_length"], int(budget_config.get("max_history_messages", 40)))
+        return app_config["max_history_length"]
+    
     def clear_history(self, keep_system: bool = True, clear_persistent: bool = False, confirm: bool = False) -> None:
         """
         清空对话历史
@@ -222,63 +290,28 @@ class ChatService:
         self.add_message("system", system_prompt)
         self.logger.info(f"系统提示词已设置: {system_prompt[:50]}...")
     
-    def _build_system_prompt_with_context(self, user_query: str = None) -> str:
+    def _build_base_prompt(self) -> str:
         """
-        构建包含时间前缀、相关记忆和角色详情的系统提示词
+        构建静态系统提示词（角色设定和格式要求，剧情模式下加上故事角色介绍）
+        
+        同一角色/故事下每轮逐字节相同，放在消息最前以命中服务端的提示词前缀缓存；
+        剧情引导、时间前缀和检索内容每轮变化，由_build_context_sections构建并放在最后一条用户消息之前
         
-        Args:
-            user_query: 用户查询，用于检索相关记忆和角色详情
-            
         Returns:
-            完整的系统提示词
+            静态系统提示词
         """
         # 获取基础系统提示词
         if self.story_mode and self.current_story_id:
             base_prompt = self.config_service.get_system_prompt("character")
             
-            # 剧情模式：添加剧情引导内容
+            # 剧情模式：添加故事角色介绍（按角色和故事缓存）
             try:
-                from services.story_service import story_service
-                
-                # 获取故事进度信息
-                offset = story_service.get_offset()
-                _, current_chapter, next_chapter = story_service.get_current_chapter_info()
-                
-                # 根据偏移值添加引导内容
-                guidance = f"当前章节：`{current_chapter}`"
-                if next_chapter:  # 只有在还有下一章节时才添加引导
-                    if offset<10:
-                        guidance += f"。下一章节：`{next_chapter}`。请保持在当前章节，不要进入下一章节"
-                    if 10 <= offset < 30:
-                        guidance += f"。请暗示性地引导用户向`{next_chapter}`方向推进故事"
-                    elif offset >= 30:
-                        guidance += f"。请制造突发事件以引导用户向`{next_chapter}`方向推进故事"
-                
-                # 获取故事角色信息
-                story_data = story_service.get_current_story_data()
-                characters = story_data.get('characters', {}).get('list', [])
-                
-                # 兼容旧格式
-                if isinstance(characters, str):
-                    characters = [characters]
-                
-                # 构建剧情模式提示词
-                if len(characters) > 1:
-                    # 多角色故事
-                    character_names = []
-                    for char_id in characters:
-                        char_config = self.config_service.get_character_config(char_id)
-                        if char_config:
-                            character_names.append(char_config.get('name', char_id))
-                    
-                    story_prompt = f"你是一个视听小说中的多角色故事的主要角色，故事中还有其他角色：{', '.join(character_names[1:])}。你需要为用户制造沉浸式的剧情体验，适时让其他角色参与对话和互动。{guidance}{base_prompt}"
-                else:
-                    # 单角色故事
-                    story_prompt = f"你是一个视听小说中的角色，你需要为用户制造沉浸式的剧情体验。{guidance}{base_prompt}"
-                
-                base_prompt = story_prompt
-                
-                self.logger.info(f"剧情模式提示词已构建，偏移值: {offset}, 当前章节: {current_chapter}")
+                base_prompt = prompt_cache.get(
+                    "story_base",
+                    lambda: self._build_story_base_prompt(base_prompt),
+                    character_id=self.config_service.current_character_id,
+                    story_id=self.current_story_id
+                )
                 
             except Exception as e:
                 self.logger.error(f"构建剧情模式提示词失败: {e}")
@@ -288,62 +321,194 @@ class ChatService:
             # 普通模式
             base_prompt = "你是一个视听小说中的角色，你正在和用户闲聊。"+self.config_service.get_system_prompt("character")
         
+        return base_prompt
+    
+    def _build_story_base_prompt(self, base_prompt: str) -> str:
+        """
+        构建剧情模式的静态系统提示词（故事角色介绍）
+        
+        Args:
+            base_prompt: 角色系统提示词
+            
+        Returns:
+            剧情模式的静态系统提示词
+        """
+        from services.story_service import story_service
+        
+        # 获取故事角色信息
+        story_data = story_service.get_current_story_data()
+        characters = story_data.get('characters', {}).get('list', [])
+        
+        # 兼容旧格式
+        if isinstance(characters, str):
+            characters = [characters]
+        
+        # 构建剧情模式提示词
+        if len(characters) > 1:
+            # 多角色故事
+            character_names = []
+            for char_id in characters:
+                char_config = self.config_service.get_character_config(char_id)
+                if char_config:
+                    character_names.append(char_config.get('name', char_id))
+            
+            story_prompt = f"你是一个视听小说中的多角色故事的主要角色，故事中还有其他角色：{', '.join(character_names[1:])}。你需要为用户制造沉浸式的剧情体验，适时让其他角色参与对话和互动。{base_prompt}"
+        else:
+            # 单角色故事
+            story_prompt = f"你是一个视听小说中的角色，你需要为用户制造沉浸式的剧情体验。{base_prompt}"
+        
+        self.logger.info(f"剧情模式提示词已构建: {self.current_story_id}")
+        return story_prompt
+    
+    def _build_context_sections(self, user_query: str = None,
+                                context_messages: Optional[List[Dict[str, Any]]] = None) -> Dict[str, str]:
+        """
+        构建每轮变化的上下文：剧情引导、时间前缀、相关记忆和角色详情
+        
+        Args:
+            user_query: 用户查询，用于检索相关记忆和角色详情
+            context_messages: 已在上下文中的消息，对应的记忆不再重复唤醒
+            
+        Returns:
+            按上下文消息中顺序排列的各部分 {"guidance", "time", "memory", "details"}
+        """
         # 初始化上下文部分
-        context_parts = []
+        sections = {"guidance": "", "time": "", "memory": "", "details": ""}
+        
+        # 剧情模式：添加当前章节的剧情引导
+        if self.story_mode and self.current_story_id:
+            try:
+                from services.story_service import story_service
+                sections["guidance"] = story_service.get_guidance()
+            except Exception as e:
+                self.logger.error(f"构建剧情引导失败: {e}")
         
         # 添加时间前缀（仅在非故事模式下）
         if not self.story_mode:
             character_id = self.config_service.current_character_id or "default"
-            time_prefix = self.time_tracker.get_time_elapsed_prefix(character_id)
-            if time_prefix:
-                context_parts.append(time_prefix)
+            sections["time"] = self.time_tracker.get_time_elapsed_prefix(character_id) or ""
         
         # 添加记忆和角色详情上下文
-        memory_context = ""
-        details_context = ""
-        
         if user_query:
             try:
-                if self.story_mode and self.current_story_id:
-                    # 剧情模式：使用故事ID进行记忆检索
-                    memory_context = self.memory_service.search_story_memory(
-                        query=user_query,
-                        story_id=self.current_story_id
-                    )
-                    # 剧情模式：尝试获取角色详细信息
-                    character_id = self.config_service.current_character_id
-                    if character_id:
-                        from services.character_details_service import character_details_service
-                        details_context = character_details_service.search_character_details(
-                            character_id=character_id,
-                            query=user_query,
-                            top_k=3
-                        )
-                else:
-                    # 普通模式：同时进行记忆和角色详细信息检索
-                    character_id = self.config_service.current_character_id or "default"
-                    memory_context, details_context = self.memory_service.search_memory_and_details(
-                        query=user_query,
-                        character_name=character_id
-                    )
+                scope, tasks = self._retrieval_tasks(user_query, context_messages)
+                
+                # 低信息量的输入跳过检索，沿用上一轮的检索结果；检索超过截止时间时不再等待
+                memory_context, details_context = self.memory_service.gated_search(user_query, scope, tasks)
                 
                 # 构建完整的上下文
-                if memory_context:
-                    context_parts.append(memory_context)
-                if details_context:
-                    context_parts.append(details_context)
+                sections["memory"] = memory_context or ""
+                sections["details"] = details_context or ""
                     
             except Exception as e:
                 self.logger.error(f"记忆和详细信息检索失败: {e}")
         
-        # 如果有上下文信息，添加到系统提示词
-        if context_parts:
-            context_str = "\n\n".join(context_parts)
-            full_prompt = f"{base_prompt}\n\n{context_str}"
-        else:
-            full_prompt = base_prompt
+        return sections
+    
+    def _retrieval_tasks(self, user_query: str, context_messages: Optional[List[Dict[str, Any]]] = None
+                         ) -> Tuple[Tuple[str, ...], Dict[str, Callable[[], str]]]:
+        """
+        构建当前模式下的记忆和角色详情检索任务
+        
+        Args:
+            user_query: 用户查询
+            context_messages: 已在上下文中的消息，对应的记忆不再重复唤醒
+            
+        Returns:
+            (检索范围, {"memory": 记忆检索, "details": 角色详情检索})
+        """
+        if self.story_mode and self.current_story_id:
+            story_id = self.current_story_id
+            character_id = self.config_service.current_character_id
+            
+            # 剧情模式：使用故事ID进行记忆检索，并尝试获取角色详细信息
+            tasks = {
+                "memory": lambda: self.memory_service.search_story_memory(
+                    query=user_query,
+                    story_id=story_id,
+                    context_messages=context_messages
+                )
+            }
+            if character_id:
+                tasks["details"] = lambda: self.memory_service.search_details(user_query, character_id)
+            
+            return ("story", story_id, character_id or ""), tasks
+        
+        character_id = self.config_service.current_character_id or "default"
+        
+        # 普通模式：同时进行记忆和角色详细信息检索
+        tasks = {
+            "memory": lambda: self.memory_service.search_memory(
+                query=user_query,
+                character_name=character_id,
+                context_messages=context_messages
+            ),
+            "details": lambda: self.memory_service.search_details(user_query, character_id),
+        }
+        return ("chat", character_id), tasks
+    
+    def prefetch_context(self, text: Optional[str] = None) -> bool:
+        """
+        预取检索结果：在用户发送消息之前，用正在输入的内容（或最后一条角色回复）在后台检索记忆和角色详情，
+        加载记忆库并缓存查询向量和检索结果，正式请求时可直接命中缓存
+        
+        Args:
+            text: 正在输入的内容，为空时使用最后一条角色回复
             
-        return full_prompt
+        Returns:
+            是否开始预取
+        """
+        if not text:
+            last_reply = next((msg for msg in reversed(self.history) if msg.role == "assistant"), None)
+            text = last_reply.get_parsed()["content"] if last_reply else ""
+        text = (text or "").strip()
+        if not text:
+            return False
+        
+        messages = [msg for msg in self.format_messages() if msg.get("role") != "system"]
+        _, tasks = self._retrieval_tasks(text, self._context_memory_refs(messages, True))
+        return self.memory_service.prefetch(text, tasks)
+    
+    def _context_memory_refs(self, messages: List[Dict[str, str]], from_history: bool) -> List[Dict[str, Any]]:
+        """
+        获取上下文中对话消息的记忆引用（纯文本和记忆文档ID），记忆检索时据此排除已在上下文中的记忆
+        
+        Args:
+            messages: 将发送给模型的对话消息（不含system消息）
+            from_history: messages是否取自内存中的历史记录（是时可使用消息上记录的记忆文档ID）
+            
+        Returns:
+            [{"content": 纯文本, "memory_id": 记忆文档ID或None}]
+        """
+        if not messages:
+            return []
+        if from_history:
+            turns = [msg for msg in self.history if msg.role != "system"][-len(messages):]
+            return [
+                {
+                    "content": msg.get_parsed()["content"] if msg.role == "assistant" else msg.content,
+                    "memory_id": msg.memory_id
+                }
+                for msg in turns
+            ]
+        return [
+            {
+                "content": parse_assistant_message(msg["content"])["content"] if msg.get("role") == "assistant" else msg.get("content"),
+                "memory_id": None
+            }
+            for msg in messages
+        ]
+    
+    def link_memory_ids(self, messages: List[Message], memory_ids: List[int]) -> None:
+        """
+        记录消息对应的记忆文档ID（之后这些消息仍在上下文中时，检索不再唤醒对应的记忆）
+        
+        Args:
+            messages: 消息对象列表
+            memory_ids: 与messages一一对应的记忆文档ID
+        """
+        for message, memory_id in zip(messages, memory_ids or []):
+            message.memory_id = memory_id
     
     def _load_history_on_startup(self):
         """在启动时加载历史记录到内存"""
@@ -352,18 +517,18 @@ class ChatService:
             from services.story_service import story_service
             history_path = story_service.get_story_history_path()
             
-            app_config = self.config_service.get_app_config()
-            max_history = app_config["max_history_length"]
+            max_history = self._history_limit()
             
             history_messages = self.history_manager.load_history_from_file(history_path, max_history, max_history * 2)
+            self._context().history_source = f"story:{self.current_story_id}"
         else:
             # 普通模式：从角色目录加载
             character_id = self.config_service.current_character_id or "default"
             
-            app_config = self.config_service.get_app_config()
-            max_history = app_config["max_history_length"]
+            max_history = self._history_limit()
             
             history_messages = self.history_manager.load_history(character_id, max_history, max_history * 2)
+            self._context().history_source = f"character:{character_id}"
         
         # 转换为Message对象并添加到内存中
         for msg in history_messages:
@@ -392,29 +557,50 @@ class ChatService:
         """
         # 设置角色
         if self.config_service.set_character(character_id):
+            # 在后台并发预热记忆库、角色详情、时间前缀和音色（已预热的不会重复加载）
+            warmup_service.warm_character(character_id)
+            
             # 清空当前会话历史
             self.history = []
             
             # 设置系统提示词
             self.set_system_prompt("character")
             
-            # 初始化该角色的记忆数据库
-            self.memory_service.set_current_character(character_id)
+            # 记忆数据库由预热加载，检索时未加载完成会等待同一次加载
+            self.memory_service.current_character = character_id
             
-            # 加载该角色的历史记录
-            app_config = self.config_service.get_app_config()
-            max_history = app_config["max_history_length"]
+            # 加载该角色的历史记录（会话需要这些消息，在请求线程中与后台预热同时进行）
+            max_history = self._history_limit()
             history_messages = self.history_manager.load_history(character_id, max_history, max_history * 2)
             
             # 转换为Message对象并添加到内存中
             for msg in history_messages:
                 if msg["role"] != "system":  # 系统消息已通过set_system_prompt设置
                     self.history.append(Message.from_dict(msg))
+            self._context().history_source = f"character:{character_id}"
                     
             return True
         
         return False
     
+    def activate_character(self, character_id: str) -> bool:
+        """
+        切换到角色（已是当前角色且内存中是该角色的历史记录时不做任何操作）
+        
+        Args:
+            character_id: 角色ID
+            
+        Returns:
+            是否设置成功
+        """
+        if (not self.story_mode
+                and self.config_service.current_character_id == character_id
+                and self._context().history_source == f"character:{character_id}"):
+            # 会话的历史记录可能在首次访问时加载，确保预热过（已预热的组件不会重复加载）
+            warmup_service.warm_character(character_id)
+            return True
+        return self.set_character(character_id)
+    
     def set_story_mode(self, story_id: str) -> bool:
         """
         设置剧情模式
@@ -451,6 +637,9 @@ class ChatService:
             if not self.config_service.set_character(character_id):
                 return False
             
+            # 在后台并发预热故事记忆库、角色详情和音色（已预热的不会重复加载）
+            warmup_service.warm_story(story_id, character_id)
+            
             # 启用剧情模式
             self.story_mode = True
             self.current_story_id = story_id
@@ -461,20 +650,19 @@ class ChatService:
             # 设置剧情模式的系统提示词
             self.set_story_system_prompt()
             
-            # 初始化故事记忆数据库
-            self.memory_service.initialize_story_memory(story_id)
+            # 故事记忆数据库由预热加载，检索时未加载完成会等待同一次加载
+            self.memory_service.current_story = story_id
             
-            # 加载故事的历史记录
+            # 加载故事的历史记录（会话需要这些消息，在请求线程中与后台预热同时进行）
             history_path = story_service.get_story_history_path()
-            app_config = self.config_service.get_app_config()
-            max_history = app_config["max_history_length"]
-            
+            max_history = self._history_limit()
             history_messages = self.history_manager.load_history_from_file(history_path, max_history, max_history * 2)
             
             # 转换为Message对象并添加到内存中
             for msg in history_messages:
                 if msg["role"] != "system":
                     self.history.append(Message.from_dict(msg))
+            self._context().history_source = f"story:{story_id}"
             
             self.logger.info(f"成功设置剧情模式: {story_id}")
             return True
@@ -488,7 +676,7 @@ class ChatService:
         # 移除现有的system消息
         self.history = [msg for msg in self.history if msg.role != "system"]
         
-        # 添加空的系统消息占位符，实际内容会在_build_system_prompt_with_context中构建
+        # 添加空的系统消息占位符，实际内容会在_prepare_messages中构建
         self.add_message("system", "")
         self.logger.info("剧情模式系统提示词已触发更新")
     
@@ -560,39 +748,7 @@ class ChatService:
         if stream and not stream_config.get("enable_streaming", True):
             stream = False
         
-        # 准备请求数据
-        if messages is None:
-            # 使用内存中的历史记录（单角色模式简化版）
-            messages = self.format_messages()
-        
-        # 如果有用户查询，构建包含上下文的系统提示词
-        if user_query:
-            # 构建包含记忆、角色详情、时间前缀和剧情引导的系统提示词
-            full_system_prompt = self._build_system_prompt_with_context(user_query)
-            
-            # 移除现有的system消息
-            messages = [msg for msg in messages if msg.get("role") != "system"]
-            
-            # 添加新的系统提示词到消息列表开头
-            messages.insert(0, {"role": "system", "content": full_system_prompt})
-        else:
-            # 如果没有用户查询，检查是否需要添加基础系统提示词
-            has_system_message = any(msg.get("role") == "system" for msg in messages)
-            if not has_system_message:
-                # 使用_build_system_prompt_with_context来构建基础提示词
-                system_prompt = self._build_system_prompt_with_context()
-                messages.insert(0, {"role": "system", "content": system_prompt})
-        
-        # 记录完整提示词到日志
-        try:
-            character_id = self.config_service.current_character_id or "default"
-            prompt_logger.log_prompt(
-                messages=messages,
-                character_name=character_id,
-                user_query=user_query
-            )
-        except Exception as e:
-            self.logger.error(f"记录提示词日志失败: {e}")
+        messages = self._prepare_messages(messages, user_query)
         
         try:
             # 发送API请求
@@ -620,48 +776,165 @@ class ChatService:
                         messages=messages,
                         stream=True,
                         response_format={"type": "json_object"},
+                        **self._usage_options(stream_config),
                         **chat_config
                     )
                     ifreasoning = False
-                    for chunk in stream_ans:
-                        data = chunk.choices[0].delta
-                        x = data.content
-                        if data.content is None:
-                            if ifreasoning is False:
-                                print('思考中...')
-                                ifreasoning = True
-                                # yield '思考中...\n'
-                            x = data.reasoning_content
+                    try:
+                        for chunk in stream_ans:
+                            # 最后一个chunk只带用量（choices为空）
+                            if getattr(chunk, "usage", None):
+                                record_usage("chat", chunk.usage)
+                            if not chunk.choices:
+                                continue
+                            data = chunk.choices[0].delta
+                            x = data.content
+                            if data.content is None:
+                                if ifreasoning is False:
+                                    print('思考中...')
+                                    ifreasoning = True
+                                    # yield '思考中...\n'
+                                x = data.reasoning_content
+                                print(x, end="", flush=True)
+                                continue
+                            else:
+                                if ifreasoning is True:
+                                    print('\n回答中...')
+                                    ifreasoning = False
                             print(x, end="", flush=True)
-                            continue
-                        else:
-                            if ifreasoning is True:
-                                print('\n回答中...')
-                                ifreasoning = False
-                        print(x, end="", flush=True)
-                        yield x
+                            yield x
+                    finally:
+                        # 生成器被关闭（客户端断开或取消）时关闭上游连接，停止消耗token
+                        stream_ans.close()
                 return stream_generator()
         except APIError as e:
             # 处理API错误
             error_info = handle_api_error(e)
             raise APIError(error_info["error"], e.status_code, error_info)
-
-    async def chat_completion_async(self, messages: Optional[List[Dict[str, str]]] = None, 
-                                user_query: str = None) -> Iterator[str]:
+    
+    @staticmethod
+    def _usage_options(stream_config: Dict[str, Any]) -> Dict[str, Any]:
         """
-        异步对话API调用（预留接口）
+        流式请求的用量参数（开启后最后一个chunk返回usage，包括命中提示词缓存的token数）
         
         Args:
-            messages: 消息列表
-            user_query: 用户查询
+            stream_config: 流式输出配置
             
         Returns:
-            Iterator[str]: 流式响应
+            传给 chat.completions.create 的额外参数
+        """
+        if stream_config.get("include_usage", True):
+            return {"stream_options": {"include_usage": True}}
+        return {}
+    
+    def _prepare_messages(self, messages: Optional[List[Dict[str, str]]], user_query: Optional[str]) -> List[Dict[str, str]]:
+        """
+        准备发送给对话API的消息列表（构建包含记忆检索结果的系统提示词并记录日志）
+        
+        Args:
+            messages: 消息列表，如果为None则使用历史记录
+            user_query: 用户查询，用于记忆检索和日志记录
+            
+        Returns:
+            以系统提示词开头的消息列表
+        """
+        # 准备请求数据
+        from_history = messages is None
+        if from_history:
+            # 使用内存中的历史记录（单角色模式简化版）
+            messages = self.format_messages()
+        
+        token_counts = None
+        
+        # 如果有用户查询，构建静态系统提示词和包含检索结果的上下文消息
+        if user_query:
+            # 移除现有的system消息
+            messages = [msg for msg in messages if msg.get("role") != "system"]
+            base_prompt = self._build_base_prompt()
+            
+            budget_config = self.config_service.get_app_config().get("context_budget") or {}
+            if budget_config.get("enabled"):
+                # 按token预算装入系统提示词、最近的对话、剧情引导、记忆、角色详情和时间前缀
+                # 先确定装入的对话，再检索记忆（排除已在这些对话中的记忆）
+                assembler = ContextAssembler.from_config()
+                kept = assembler.select_history(base_prompt, messages)
+                sections = self._build_context_sections(user_query, self._context_memory_refs(kept, from_history))
+                messages, token_counts = assembler.assemble(base_prompt, messages, sections)
+                self.logger.info(f"上下文token估算: {token_counts}")
+            else:
+                sections = self._build_context_sections(user_query, self._context_memory_refs(messages, from_history))
+                context = "\n\n".join(text for text in sections.values() if text)
+                messages = layout_messages(base_prompt, messages, context)
+        else:
+            # 如果没有用户查询，检查是否需要添加基础系统提示词
+            has_system_message = any(msg.get("role") == "system" for msg in messages)
+            if not has_system_message:
+                sections = self._build_context_sections()
+                context = "\n\n".join(text for text in sections.values() if text)
+                messages = layout_messages(self._build_base_prompt(), messages, context)
+        
+        # 记录完整提示词到日志
+        try:
+            character_id = self.config_service.current_character_id or "default"
+            prompt_logger.log_prompt(
+                messages=messages,
+                character_name=character_id,
+                user_query=user_query,
+                token_counts=token_counts
+            )
+        except Exception as e:
+            self.logger.error(f"记录提示词日志失败: {e}")
+        
+        return messages
+
+    async def chat_completion_async(
+        self,
+        messages: Optional[List[Dict[str, str]]] = None,
+        user_query: str = None
+    ) -> AsyncIterator[str]:
+        """
+        异步调用对话API（集成记忆检索，流式返回）
+        
+        流式读取使用AsyncOpenAI，在事件循环上运行而不占用线程；记忆检索等阻塞操作放到线程池执行
+        
+        Args:
+            messages: 消息列表，如果为None则使用历史记录
+            user_query: 用户查询，用于记忆检索和日志记录
             
-        Note:
-            此为预留接口，将在未来实现异步支持
+        Returns:
+            异步迭代器，每次yield一个字符串token
         """
-        raise NotImplementedError("异步支持将在未来版本实现")
+        if self.async_client is None:
+            raise APIError("异步OpenAI客户端未初始化")
+        
+        chat_config = self.config_service.get_chat_config()
+        for key in ['model', 'stream', 'top_k']:
+            chat_config.pop(key, None)
+        
+        # asyncio.to_thread会复制上下文，线程中仍使用当前会话
+        messages = await asyncio.to_thread(self._prepare_messages, messages, user_query)
+        
+        stream_ans = await self.async_client.chat.completions.create(
+            model=os.getenv("CHAT_MODEL"),
+            messages=messages,
+            stream=True,
+            response_format={"type": "json_object"},
+            **self._usage_options(self.config_service.get_stream_config()),
+            **chat_config
+        )
+        try:
+            async for chunk in stream_ans:
+                if getattr(chunk, "usage", None):
+                    record_usage("chat", chunk.usage)
+                if not chunk.choices:
+                    continue
+                data = chunk.choices[0].delta
+                if data.content is None:
+                    continue
+                yield data.content
+        finally:
+            # 协程被取消或生成器被关闭时关闭上游连接，停止消耗token
+            await stream_ans.close()
 
 # 创建全局对话服务实例
 chat_service = ChatService()
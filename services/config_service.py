@@ -13,6 +13,8 @@ sys.path.append(str(Path(__file__).resolve().parent.parent))
 from utils.env_utils import load_env_vars, get_env_var
 import config
 import characters
+from services.session_service import session_service
+from utils.prompt_cache import prompt_cache
 
 class ConfigService:
     """配置服务类"""
@@ -23,6 +25,15 @@ class ConfigService:
         self.config_loaded = False
         self.current_character_id = None
     
+    @property
+    def current_character_id(self) -> Optional[str]:
+        """当前会话的角色ID"""
+        return session_service.current().character_id
+    
+    @current_character_id.setter
+    def current_character_id(self, character_id: Optional[str]):
+        session_service.current().character_id = character_id
+    
     def initialize(self):
         """初始化配置"""
         if self.initialized:
@@ -117,6 +128,23 @@ class ConfigService:
         if not self.config_loaded:
             raise RuntimeError("配置未加载")
         
+        # 拼接结果按 (提示词类型, 角色) 缓存，角色重新加载或配置保存时失效
+        return prompt_cache.get(
+            f"system:{prompt_type}",
+            lambda: self._build_system_prompt(prompt_type),
+            character_id=self.current_character_id
+        )
+    
+    def _build_system_prompt(self, prompt_type: str) -> str:
+        """
+        拼接系统提示词（通用提示词、心情列表和角色提示词）
+        
+        Args:
+            prompt_type: 提示词类型
+            
+        Returns:
+            系统提示词
+        """
         if prompt_type == "character":
             character_config = self.get_character_config()
             general_prompt = config.get_system_prompt("default")
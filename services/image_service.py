@@ -8,7 +8,6 @@ import time
 import random
 import base64
 import shutil
-import requests
 from pathlib import Path
 from typing import Dict, Any, Optional, List, Tuple
 from datetime import datetime, timedelta
@@ -19,6 +18,7 @@ import traceback
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
 from services.config_service import config_service
+from utils.http_client import get_http_client
 
 class ImageConfig:
     """图像配置类"""
@@ -203,7 +203,7 @@ class ImageService:
             image_path = self.cache_dir / filename
             
             # 下载图像
-            response = requests.get(url, stream=True)
+            response = get_http_client().get(url, stream=True, timeout=60)
             if response.status_code == 200:
                 with open(image_path, 'wb') as f:
                     response.raw.decode_content = True
@@ -6,7 +6,8 @@ import os
 import sys
 import logging
 import asyncio
-from typing import Dict, Optional, Tuple
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from pathlib import Path
 import traceback
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -16,6 +17,10 @@ sys.path.append(str(Path(__file__).resolve().parent.parent))
 from utils.memory_utils import ChatHistoryVectorDB
 from services.config_service import config_service
 from services.character_details_service import character_details_service
+from services.session_service import session_service
+from utils.query_gate import get_query_gate
+from utils.retrieval_cache import RetrievalCache
+from utils.retrieval_deadline import run_with_deadline, run_in_background
 from config import get_memory_config,  get_RAG_config
 
 class MemoryService:
@@ -27,6 +32,9 @@ class MemoryService:
         self.story_databases: Dict[str, ChatHistoryVectorDB] = {}
         self.current_character = None
         self.current_story = None
+        # 每个记忆库的加载锁（切换角色时的后台预热和检索可能同时加载同一个记忆库）
+        self._load_locks: Dict[Tuple[bool, str], threading.Lock] = {}
+        self._load_locks_guard = threading.Lock()
         self.logger = logging.getLogger("MemoryService")
         
         # 设置日志格式
@@ -48,13 +56,7 @@ class MemoryService:
             是否初始化成功
         """
         try:
-            if character_name not in self.memory_databases:
-                # 创建新的记忆数据库
-                memory_db = ChatHistoryVectorDB(RAG_config=get_RAG_config() , character_name=character_name)
-                memory_db.initialize_database()
-                self.memory_databases[character_name] = memory_db
-                self.logger.info(f"初始化角色记忆数据库: {character_name}")
-            
+            self._load_database(character_name, is_story=False)
             self.current_character = character_name
             return True
             
@@ -63,6 +65,51 @@ class MemoryService:
             self.logger.error(f"初始化角色记忆数据库失败 {character_name}: {e}")
             return False
     
+    def _load_database(self, name: str, is_story: bool) -> ChatHistoryVectorDB:
+        """
+        加载角色或故事的记忆数据库（已加载时直接返回，同一记忆库只加载一次）
+        
+        参数:
+            name: 角色ID或故事ID
+            is_story: 是否为故事记忆库
+            
+        返回:
+            记忆数据库
+        """
+        databases = self.story_databases if is_story else self.memory_databases
+        if name in databases:
+            return databases[name]
+        
+        with self._load_locks_guard:
+            lock = self._load_locks.setdefault((is_story, name), threading.Lock())
+        with lock:
+            if name not in databases:
+                # 创建新的记忆数据库
+                memory_db = ChatHistoryVectorDB(RAG_config=get_RAG_config(), character_name=name, is_story=is_story)
+                memory_db.initialize_database()
+                databases[name] = memory_db
+                self.logger.info(f"初始化{'故事' if is_story else '角色'}记忆数据库: {name}")
+        return databases[name]
+    
+    def preload_memory(self, name: str, is_story: bool = False) -> bool:
+        """
+        预加载记忆数据库（不切换当前角色/故事，供切换时的后台预热使用）
+        
+        参数:
+            name: 角色ID或故事ID
+            is_story: 是否为故事记忆库
+            
+        返回:
+            是否加载成功
+        """
+        try:
+            self._load_database(name, is_story)
+            return True
+        except Exception as e:
+            traceback.print_exc()
+            self.logger.error(f"预加载记忆数据库失败 {name}: {e}")
+            return False
+    
     def get_current_memory_db(self) -> Optional[ChatHistoryVectorDB]:
         """
         获取当前角色的记忆数据库
@@ -74,7 +121,8 @@ class MemoryService:
             return self.memory_databases[self.current_character]
         return None
     
-    def search_memory(self, query: str, character_name: str = None, top_k: int = None, timeout: int = None) -> str:
+    def search_memory(self, query: str, character_name: str = None, top_k: int = None, timeout: int = None,
+                      context_messages: List[Dict[str, Any]] = None) -> str:
         """
         搜索记忆并返回格式化的提示词
         
@@ -83,6 +131,7 @@ class MemoryService:
             character_name: 角色名称，如果为None则使用当前角色
             top_k: 返回的最相似结果数量，如果为None则使用配置中的值
             timeout: 超时时间（秒），如果为None则使用配置中的值
+            context_messages: 已在上下文中的消息（{"content", "memory_id"}），对应的记忆不再重复唤醒
             
         返回:
             格式化的记忆提示词
@@ -109,7 +158,8 @@ class MemoryService:
             return ""
         
         memory_db = self.memory_databases[character_name]
-        result = memory_db.get_relevant_memory(query, top_k, timeout)
+        result = memory_db.get_relevant_memory(query, top_k, timeout, context_messages=context_messages,
+                                              cache=self._session_retrieval_cache())
         
         if result:
             self.logger.info(f"记忆搜索完成: 生成了 {len(result)} 字符的记忆上下文")
@@ -120,7 +170,8 @@ class MemoryService:
     
     async def search_memory_and_details_async(self, query: str, character_name: str = None, 
                                             memory_top_k: int = None, details_top_k: int = 3, 
-                                            timeout: int = None) -> Tuple[str, str]:
+                                            timeout: int = None,
+                                            context_messages: List[Dict[str, Any]] = None) -> Tuple[str, str]:
         """
         异步同时搜索记忆和角色详细信息
         
@@ -130,6 +181,7 @@ class MemoryService:
             memory_top_k: 记忆检索返回的最相似结果数量
             details_top_k: 详细信息检索返回的最相似结果数量
             timeout: 超时时间（秒）
+            context_messages: 已在上下文中的消息，对应的记忆不再重复唤醒
             
         返回:
             (记忆提示词, 角色详细信息提示词) 的元组
@@ -157,7 +209,7 @@ class MemoryService:
         memory_task = loop.run_in_executor(
             None, 
             self.search_memory, 
-            query, character_name, memory_top_k, timeout
+            query, character_name, memory_top_k, timeout, context_messages
         )
         
         # 角色详细信息检索任务
@@ -192,7 +244,8 @@ class MemoryService:
     
     def search_memory_and_details(self, query: str, character_name: str = None, 
                                 memory_top_k: int = None, details_top_k: int = 3, 
-                                timeout: int = None) -> Tuple[str, str]:
+                                timeout: int = None,
+                                context_messages: List[Dict[str, Any]] = None) -> Tuple[str, str]:
         """
         同步搜索记忆和角色详细信息（使用异步实现）
         
@@ -202,6 +255,7 @@ class MemoryService:
             memory_top_k: 记忆检索返回的最相似结果数量
             details_top_k: 详细信息检索返回的最相似结果数量
             timeout: 超时时间（秒）
+            context_messages: 已在上下文中的消息，对应的记忆不再重复唤醒
             
         返回:
             (记忆提示词, 角色详细信息提示词) 的元组
@@ -217,7 +271,7 @@ class MemoryService:
             # 运行异步函数
             return loop.run_until_complete(
                 self.search_memory_and_details_async(
-                    query, character_name, memory_top_k, details_top_k, timeout
+                    query, character_name, memory_top_k, details_top_k, timeout, context_messages
                 )
             )
         except Exception as e:
@@ -225,7 +279,102 @@ class MemoryService:
             traceback.print_exc()
             return "", ""
     
-    def add_conversation(self, user_message: str, assistant_message: str, character_name: str = None):
+    def _session_retrieval_cache(self) -> Optional[RetrievalCache]:
+        """
+        获取当前会话的检索结果缓存（首次使用时创建）
+        
+        返回:
+            检索结果缓存，未启用时返回None
+        """
+        context = session_service.current()
+        if context.retrieval_cache is None:
+            context.retrieval_cache = RetrievalCache.from_config()
+        return context.retrieval_cache
+    
+    def search_details(self, query: str, character_id: str, top_k: int = 3, timeout: int = None) -> str:
+        """
+        搜索角色详细信息（使用当前会话的检索结果缓存）
+        
+        参数:
+            query: 查询文本
+            character_id: 角色ID
+            top_k: 返回的最相似结果数量
+            timeout: 超时时间（秒），如果为None则使用配置中的值
+            
+        返回:
+            格式化的角色详细信息提示词
+        """
+        if timeout is None:
+            timeout = get_memory_config()['timeout']
+        return character_details_service.search_character_details(
+            character_id, query, top_k, timeout, cache=self._session_retrieval_cache()
+        )
+    
+    def gated_search(self, query: str, scope: Tuple[str, ...],
+                     tasks: Dict[str, Callable[[], str]]) -> Tuple[str, str]:
+        """
+        经过检索门控后并发检索记忆和角色详细信息
+        
+        低信息量的输入跳过检索，沿用本会话中同一检索范围上一轮的检索结果（见utils.query_gate）；
+        检索最多等待 MEMORY_CONFIG["deadline_ms"] 毫秒，超时的检索结果不进入本轮提示词（见utils.retrieval_deadline）
+        
+        参数:
+            query: 用户输入
+            scope: 检索范围，如 ("chat", 角色ID) 或 ("story", 故事ID, 角色ID)
+            tasks: 检索任务，"memory" 返回记忆提示词，"details" 返回角色详细信息提示词
+            
+        返回:
+            (记忆提示词, 角色详细信息提示词) 的元组
+        """
+        gate = get_query_gate()
+        context = session_service.current()
+        retrieve, reason = gate.check(query)
+        if not retrieve:
+            gate_config = get_memory_config().get("query_gate") or {}
+            previous = context.last_retrieval.get(scope)
+            if previous is not None and gate_config.get("reuse_previous", True):
+                gate.record("reused")
+                self.logger.info(f"检索门控: 跳过检索({reason})，沿用上一轮的检索结果")
+                return previous
+            gate.record("skipped")
+            self.logger.info(f"检索门控: 跳过检索({reason})")
+            return "", ""
+        
+        gate.record("retrieved")
+        results = run_with_deadline(tasks)
+        result = (results.get("memory") or "", results.get("details") or "")
+        context.last_retrieval[scope] = result
+        return result
+    
+    def prefetch(self, query: str, tasks: Dict[str, Callable[[], str]]) -> bool:
+        """
+        在后台预取检索结果（加载记忆库、缓存查询向量和检索结果），不等待完成
+        
+        低信息量的输入、与上一次预取相同的查询或上一次预取尚未完成时不预取
+        
+        参数:
+            query: 预取使用的查询文本
+            tasks: 检索任务（同 gated_search）
+            
+        返回:
+            是否开始预取
+        """
+        retrieve, _ = get_query_gate().check(query)
+        if not retrieve:
+            return False
+        
+        context = session_service.current()
+        if context.prefetch is not None:
+            previous_query, futures = context.prefetch
+            if previous_query == query or not all(future.done() for future in futures):
+                return False
+        
+        self.logger.info(f"预取检索结果: '{query}'")
+        context.prefetch = (query, run_in_background(tasks))
+        return True
+    
+    def add_conversation(self, user_message: str, assistant_message: str, character_name: str = None,
+                         assistant_content: str = None):
         """
         添加对话到记忆数据库
         
@@ -233,20 +382,24 @@ class MemoryService:
             user_message: 用户消息
             assistant_message: 助手回复
             character_name: 角色名称，如果为None则使用当前角色
+            assistant_content: 已解析的助手回复纯文本（可选）
+            
+        返回:
+            新增记忆的文档ID列表（玩家消息, 角色回复），未添加时为空列表
         """
         if character_name is None:
             character_name = self.current_character
         
         if not character_name:
             self.logger.warning("没有指定角色，无法添加对话记录")
-            return
+            return []
         
         # 确保角色记忆数据库已初始化
         if not self.initialize_character_memory(character_name):
-            return
+            return []
         
         memory_db = self.memory_databases[character_name]
-        memory_db.add_chat_turn(user_message, assistant_message)
+        doc_ids = memory_db.add_chat_turn(user_message, assistant_message, assistant_content=assistant_content)
         
         # 保存到文件
         try:
@@ -254,6 +407,7 @@ class MemoryService:
         except Exception as e:
             self.logger.error(f"保存记忆数据库失败: {e}")
             traceback.print_exc()
+        return doc_ids
     
     def initialize_story_memory(self, story_id: str) -> bool:
         """
@@ -266,13 +420,7 @@ class MemoryService:
             是否初始化成功
         """
         try:
-            if story_id not in self.story_databases:
-                # 创建新的故事记忆数据库
-                memory_db = ChatHistoryVectorDB(RAG_config=get_RAG_config(), character_name=story_id, is_story=True)
-                memory_db.initialize_database()
-                self.story_databases[story_id] = memory_db
-                self.logger.info(f"初始化故事记忆数据库: {story_id}")
-            
+            self._load_database(story_id, is_story=True)
             self.current_story = story_id
             return True
             
@@ -281,7 +429,8 @@ class MemoryService:
             self.logger.error(f"初始化故事记忆数据库失败 {story_id}: {e}")
             return False
     
-    def search_story_memory(self, query: str, story_id: str = None, top_k: int = None, timeout: int = None) -> str:
+    def search_story_memory(self, query: str, story_id: str = None, top_k: int = None, timeout: int = None,
+                            context_messages: List[Dict[str, Any]] = None) -> str:
         """
         搜索故事记忆并返回格式化的提示词
         
@@ -290,6 +439,7 @@ class MemoryService:
             story_id: 故事ID，如果为None则使用当前故事
             top_k: 返回的最相似结果数量，如果为None则使用配置中的值
             timeout: 超时时间（秒），如果为None则使用配置中的值
+            context_messages: 已在上下文中的消息（{"content", "memory_id"}），对应的记忆不再重复唤醒
             
         返回:
             格式化的记忆提示词
@@ -316,7 +466,8 @@ class MemoryService:
             return ""
         
         memory_db = self.story_databases[story_id]
-        result = memory_db.get_relevant_memory(query, top_k, timeout)
+        result = memory_db.get_relevant_memory(query, top_k, timeout, context_messages=context_messages,
+                                              cache=self._session_retrieval_cache())
         
         if result:
             self.logger.info(f"故事记忆搜索完成: 生成了 {len(result)} 字符的记忆上下文")
@@ -325,7 +476,8 @@ class MemoryService:
         
         return result
     
-    def add_story_conversation(self, user_message: str, assistant_message: str, story_id: str = None):
+    def add_story_conversation(self, user_message: str, assistant_message: str, story_id: str = None,
+                               assistant_content: str = None):
         """
         添加对话到故事记忆数据库
         
@@ -333,20 +485,24 @@ class MemoryService:
             user_message: 用户消息
             assistant_message: 助手回复
             story_id: 故事ID，如果为None则使用当前故事
+            assistant_content: 已解析的助手回复纯文本（可选）
+            
+        返回:
+            新增记忆的文档ID列表（玩家消息, 角色回复），未添加时为空列表
         """
         if story_id is None:
             story_id = self.current_story
         
         if not story_id:
             self.logger.warning("没有指定故事，无法添加对话记录")
-            return
+            return []
         
         # 确保故事记忆数据库已初始化
         if not self.initialize_story_memory(story_id):
-            return
+            return []
         
         memory_db = self.story_databases[story_id]
-        memory_db.add_chat_turn(user_message, assistant_message)
+        doc_ids = memory_db.add_chat_turn(user_message, assistant_message, assistant_content=assistant_content)
         
         # 保存到文件
         try:
@@ -354,8 +510,9 @@ class MemoryService:
         except Exception as e:
             self.logger.error(f"保存故事记忆数据库失败: {e}")
             traceback.print_exc()
+        return doc_ids
     
-    def add_story_message(self, speaker_name: str, message: str, story_id: str = None):
+    def add_story_message(self, speaker_name: str, message: str, story_id: str = None, content: str = None):
         """
         添加单条消息到故事记忆数据库（用于多角色对话）
         
@@ -363,20 +520,24 @@ class MemoryService:
             speaker_name: 说话者名称
             message: 消息内容
             story_id: 故事ID，如果为None则使用当前故事
+            content: 已解析的消息纯文本（可选）
+            
+        返回:
+            新增记忆的文档ID，未添加时为None
         """
         if story_id is None:
             story_id = self.current_story
         
         if not story_id:
             self.logger.warning("没有指定故事，无法添加消息记录")
-            return
+            return None
         
         # 确保故事记忆数据库已初始化
         if not self.initialize_story_memory(story_id):
-            return
+            return None
         
         memory_db = self.story_databases[story_id]
-        memory_db.add_single_message(speaker_name, message)
+        doc_id = memory_db.add_single_message(speaker_name, message, content=content)
         
         # 保存到文件
         try:
@@ -384,6 +545,7 @@ class MemoryService:
         except Exception as e:
             self.logger.error(f"保存故事记忆数据库失败: {e}")
             traceback.print_exc()
+        return doc_id
     
     def set_current_character(self, character_name: str) -> bool:
         """
@@ -11,6 +11,7 @@ from typing import List, Dict, Any, Optional, Iterator, Union, Tuple
 from pathlib import Path
 import logging
 from utils.prompt_logger import prompt_logger
+from utils.usage_stats import record_usage
 from config import get_director_prompts_mult, DIRECTOR_SYSTEM_PROMPTS_MULT, get_story_prompts, get_option_config
 
 # 添加项目根目录到系统路径
@@ -19,7 +20,10 @@ sys.path.append(str(Path(__file__).resolve().parent.parent))
 from services.config_service import config_service
 from services.story_service import story_service
 from services.memory_service import memory_service
-from utils.history_utils import HistoryManager
+from utils.history_utils import get_history_manager
+from utils.text_utils import get_parsed_message
+from utils.prompt_cache import prompt_cache
+from utils.token_budget import layout_messages
 from utils.api_utils import make_api_request, APIError
 from openai import OpenAI
 
@@ -37,10 +41,8 @@ class MultiCharacterService:
         if not self.config_service.initialized:
             self.config_service.initialize()
         
-        # 创建历史记录管理器
-        app_config = self.config_service.get_app_config()
-        history_dir = app_config["history_dir"]
-        self.history_manager = HistoryManager(history_dir)
+        # 使用进程内共享的历史记录管理器
+        self.history_manager = get_history_manager()
         
         # 初始化OpenAI客户端
         self._initialize_openai_client()
@@ -173,7 +175,7 @@ class MultiCharacterService:
                     if current_user_content:
                         formatted_messages.append({"role": "user", "content": current_user_content})
                         current_user_content = ""
-                    formatted_messages.append(msg)
+                    formatted_messages.append({"role": role, "content": content})
                 elif role == "user":
                     # 用户消息：累积到当前用户内容中
                     if current_user_content:
@@ -188,30 +190,18 @@ class MultiCharacterService:
                         current_user_content = ""
                     formatted_messages.append({"role": "assistant", "content": content})
                 elif role in characters:
-                    # 其他角色的消息：提取content并添加到用户内容中
-                    try:
-                        # 解析JSON获取content
-                        msg_data = json.loads(content)
-                        extracted_content = msg_data.get('content', content)
-                        
-                        # 获取角色名
-                        char_config = self.config_service.get_character_config(role)
-                        char_name = char_config.get('name', role) if char_config else role
-                        
-                        # 添加到当前用户内容，而不是创建新的用户消息
-                        if current_user_content:
-                            current_user_content += f"\n{char_name}：{extracted_content}"
-                        else:
-                            current_user_content = f"{char_name}：{extracted_content}"
-                    except (json.JSONDecodeError, KeyError):
-                        # 解析失败，使用原始内容
-                        char_config = self.config_service.get_character_config(role)
-                        char_name = char_config.get('name', role) if char_config else role
-                        
-                        if current_user_content:
-                            current_user_content += f"\n{char_name}：{content}"
-                        else:
-                            current_user_content = f"{char_name}：{content}"
+                    # 其他角色的消息：使用预解析的content添加到用户内容中
+                    extracted_content = get_parsed_message(msg)["content"]
+                    
+                    # 获取角色名
+                    char_config = self.config_service.get_character_config(role)
+                    char_name = char_config.get('name', role) if char_config else role
+                    
+                    # 添加到当前用户内容，而不是创建新的用户消息
+                    if current_user_content:
+                        current_user_content += f"\n{char_name}：{extracted_content}"
+                    else:
+                        current_user_content = f"{char_name}：{extracted_content}"
                 else:
                     # 处理其他可能的消息类型，确保它们使用标准角色
                     if role not in ["system", "user", "assistant", "tool"]:
@@ -226,7 +216,7 @@ class MultiCharacterService:
                         if current_user_content:
                             formatted_messages.append({"role": "user", "content": current_user_content})
                             current_user_content = ""
-                        formatted_messages.append(msg)
+                        formatted_messages.append({"role": role, "content": content})
             
             # 如果还有未处理的用户内容，添加到最后
             if current_user_content:
@@ -255,9 +245,9 @@ class MultiCharacterService:
                     safe_messages.append(msg)
             return safe_messages
     
-    def build_character_system_prompt(self, character_id: str, story_id: str, user_query: str = None) -> str:
+    def build_character_prompt(self, character_id: str, story_id: str, user_query: str = None) -> Tuple[str, str]:
         """
-        构建角色专用的系统提示词，包含剧情引导、记忆和角色详细信息上下文
+        构建角色专用的提示词：静态系统提示词（角色设定和其他角色介绍）与每轮变化的上下文（剧情引导、记忆和角色详细信息）
 
         Args:
             character_id: 角色ID
@@ -265,100 +255,88 @@ class MultiCharacterService:
             user_query: 用户查询，用于记忆和详细信息检索
 
         Returns:
-            完整的系统提示词
+            (静态系统提示词, 上下文)
         """
         try:
-            # 获取基础角色提示词
-            char_config = self.config_service.get_character_config(character_id)
-
-            base_prompt = self.config_service.get_system_prompt("character")
-            # 获取故事信息
-            story_data = self.story_service.get_current_story_data()
-            
-            # 安全地获取角色列表
-            characters = []
-            if 'characters' in story_data:
-                characters_data = story_data['characters']
-                if isinstance(characters_data, dict) and 'list' in characters_data:
-                    characters = characters_data['list']
-                elif isinstance(characters_data, list):
-                    characters = characters_data
+            # 角色设定和其他角色介绍按 (角色, 故事) 缓存，每轮只构建剧情引导并检索记忆和角色详情
+            story_prompt = prompt_cache.get(
+                "multi_story_base",
+                lambda: self._build_character_story_prompt(character_id),
+                character_id=character_id,
+                story_id=story_id
+            )
             
-            # 确保characters是一个列表
-            if isinstance(characters, str):
-                characters = [characters]
+            # 初始化上下文部分（剧情引导在前）
+            context_parts = [self.story_service.get_guidance()]
             
-            # 获取其他角色名称
-            other_character_names = []
-            for char_id in characters:
-                if char_id != character_id:
-                    other_char_config = self.config_service.get_character_config(char_id)
-                    if other_char_config:
-                        other_character_names.append(other_char_config.get('name', char_id))
-            
-            # 获取剧情引导信息
-            offset = self.story_service.get_offset()
-            _, current_chapter, next_chapter = self.story_service.get_current_chapter_info()
-            
-            # 构建剧情引导
-            guidance = f"当前章节：`{current_chapter}`"
-            if next_chapter:
-                if offset < 10:
-                    guidance += f"。下一章节：`{next_chapter}`。请保持在当前章节，不要进入下一章节"
-                elif 10 <= offset < 30:
-                    guidance += f"。请暗示性地引导用户向`{next_chapter}`方向推进故事"
-                elif offset >= 30:
-                    guidance += f"。请制造突发事件以引导用户向`{next_chapter}`方向推进故事"
-            
-            # 构建多角色提示词
-            char_name = char_config.get('name', character_id)
-            if other_character_names:
-                story_prompt = f"你是一个视听小说中的多角色故事的主要角色{char_name}，故事中还有其他角色：{', '.join(other_character_names)}。你需要为用户制造沉浸式的剧情体验，适时让其他角色参与对话和互动。{guidance}\n\n{base_prompt}"
-            else:
-                story_prompt = f"你是一个视听小说中的角色{char_name}，你需要为用户制造沉浸式的剧情体验。{guidance}\n\n{base_prompt}"
-            
-            # 初始化上下文部分
-            context_parts = []
-            
-            # 添加记忆上下文
             if user_query:
-                try:
-                    memory_context = self.memory_service.search_story_memory(
+                tasks = {
+                    "memory": lambda: self.memory_service.search_story_memory(
                         query=user_query,
                         story_id=story_id
-                    )
-                    if memory_context:
-                        context_parts.append(memory_context)
-                except Exception as e:
-                    self.logger.error(f"记忆检索失败: {e}")
+                    ),
+                    "details": lambda: self.memory_service.search_details(user_query, character_id),
+                }
+                
+                # 低信息量的输入跳过检索，沿用该角色上一轮的检索结果；检索超过截止时间时不再等待
+                memory_context, details_context = self.memory_service.gated_search(
+                    user_query, ("story", story_id, character_id), tasks
+                )
+                context_parts.extend(part for part in (memory_context, details_context) if part)
             
-            # 添加角色详细信息上下文
-            if user_query:
-                try:
-                    # 假设有 character_details_service 可用
-                    from services.character_details_service import character_details_service
-                    details_context = character_details_service.search_character_details(
-                        character_id=character_id,
-                        query=user_query,
-                        top_k=3
-                    )
-                    if details_context:
-                        context_parts.append(details_context)
-                except Exception as e:
-                    self.logger.error(f"角色详细信息检索失败: {e}")
-            
-            # 如果有上下文信息，添加到系统提示词
-            if context_parts:
-                context_str = "\n\n".join(context_parts)
-                full_prompt = f"{story_prompt}\n\n{context_str}"
-            else:
-                full_prompt = story_prompt
-            
-            return full_prompt
+            return story_prompt, "\n\n".join(context_parts)
             
         except Exception as e:
             self.logger.error(f"构建角色系统提示词失败: {e}")
-            return "你是一个AI助手."
+            return "你是一个AI助手.", ""
+    
+    def _build_character_story_prompt(self, character_id: str) -> str:
+        """
+        构建角色在多角色故事中的静态系统提示词（角色设定和其他角色介绍，不含剧情引导和检索内容）
+
+        Args:
+            character_id: 角色ID
+
+        Returns:
+            静态系统提示词
+        """
+        # 获取基础角色提示词
+        char_config = self.config_service.get_character_config(character_id)
+
+        base_prompt = self.config_service.get_system_prompt("character")
+        # 获取故事信息
+        story_data = self.story_service.get_current_story_data()
+        
+        # 安全地获取角色列表
+        characters = []
+        if 'characters' in story_data:
+            characters_data = story_data['characters']
+            if isinstance(characters_data, dict) and 'list' in characters_data:
+                characters = characters_data['list']
+            elif isinstance(characters_data, list):
+                characters = characters_data
+        
+        # 确保characters是一个列表
+        if isinstance(characters, str):
+            characters = [characters]
+        
+        # 获取其他角色名称
+        other_character_names = []
+        for char_id in characters:
+            if char_id != character_id:
+                other_char_config = self.config_service.get_character_config(char_id)
+                if other_char_config:
+                    other_character_names.append(other_char_config.get('name', char_id))
+        
+        # 构建多角色提示词
+        char_name = char_config.get('name', character_id)
+        if other_character_names:
+            story_prompt = f"你是一个视听小说中的多角色故事的主要角色{char_name}，故事中还有其他角色：{', '.join(other_character_names)}。你需要为用户制造沉浸式的剧情体验，适时让其他角色参与对话和互动。\n\n{base_prompt}"
+        else:
+            story_prompt = f"你是一个视听小说中的角色{char_name}，你需要为用户制造沉浸式的剧情体验。\n\n{base_prompt}"
+        return story_prompt
+        
+
     
     def chat_completion_for_character(
         self, 
@@ -380,15 +358,15 @@ class MultiCharacterService:
             流式响应迭代器
         """
         try:
-            # 构建角色专用系统提示词
-            system_prompt = self.build_character_system_prompt(character_id, story_id, user_query)
+            # 构建角色专用系统提示词和上下文
+            system_prompt, context = self.build_character_prompt(character_id, story_id, user_query)
             
             # 格式化消息
             formatted_messages = self.format_messages_for_character(messages, character_id, story_id)
             
-            # 移除现有system消息并添加角色专用系统提示词
+            # 移除现有system消息，静态系统提示词在最前，上下文放在最后一条用户消息之前
             formatted_messages = [msg for msg in formatted_messages if msg.get("role") != "system"]
-            formatted_messages.insert(0, {"role": "system", "content": system_prompt})
+            formatted_messages = layout_messages(system_prompt, formatted_messages, context)
             
             # 获取聊天配置
             chat_config = self.config_service.get_chat_config()
@@ -412,35 +390,48 @@ class MultiCharacterService:
                 self.logger.error(f"记录提示词日志失败: {e}")
 
             # 调用API
+            usage_options = {}
+            if self.config_service.get_stream_config().get("include_usage", True):
+                usage_options = {"stream_options": {"include_usage": True}}
             stream_ans = self.client.chat.completions.create(
                 model=os.getenv("CHAT_MODEL"),
                 messages=formatted_messages,
                 stream=True,
                 response_format={"type": "json_object"},
+                **usage_options,
                 **chat_config
             )
             
             # 处理流式响应
             is_reasoning = False
-            for chunk in stream_ans:
-                data = chunk.choices[0].delta
-                content = data.content
+            try:
+                for chunk in stream_ans:
+                    # 最后一个chunk只带用量（choices为空）
+                    if getattr(chunk, "usage", None):
+                        record_usage("multi_character", chunk.usage)
+                    if not chunk.choices:
+                        continue
+                    data = chunk.choices[0].delta
+                    content = data.content
                 
-                if content is None:
-                    if not is_reasoning:
-                        self.logger.info(f"角色 {character_id} 思考中...")
-                        is_reasoning = True
-                    reasoning_content = data.reasoning_content
-                    if reasoning_content:
-                        print(reasoning_content, end="", flush=True)
-                    continue
-                else:
-                    if is_reasoning:
-                        self.logger.info(f"角色 {character_id} 回答中...")
-                        is_reasoning = False
+                    if content is None:
+                        if not is_reasoning:
+                            self.logger.info(f"角色 {character_id} 思考中...")
+                            is_reasoning = True
+                        reasoning_content = data.reasoning_content
+                        if reasoning_content:
+                            print(reasoning_content, end="", flush=True)
+                        continue
+                    else:
+                        if is_reasoning:
+                            self.logger.info(f"角色 {character_id} 回答中...")
+                            is_reasoning = False
                 
-                print(content, end="", flush=True)
-                yield content
+                    print(content, end="", flush=True)
+                    yield content
+            finally:
+                # 生成器被关闭（客户端断开或取消）时关闭上游连接，停止消耗token
+                stream_ans.close()
                 
         except Exception as e:
             self.logger.error(f"角色 {character_id} 对话失败: {e}")
@@ -458,7 +449,7 @@ class MultiCharacterService:
         try:
             # 保存到历史记录
             history_path = self.story_service.get_story_history_path()
-            self.history_manager.save_message_to_file(
+            record = self.history_manager.save_message_to_file(
                 history_path, 
                 "assistant", 
                 message,
@@ -473,7 +464,8 @@ class MultiCharacterService:
             self.memory_service.add_story_message(
                 speaker_name=character_name,
                 message=message,
-                story_id=story_id
+                story_id=story_id,
+                content=get_parsed_message(record)["content"] if record else None
             )
             
             self.logger.info(f"已保存角色 {character_id} 的消息")
@@ -24,16 +24,21 @@ class OptionService:
         if not self.config_service.initialized:
             self.config_service.initialize()
         
-        # 初始化 OpenAI 客户端
+        # 初始化 OpenAI 客户端（同步与异步）
         try:
-            from openai import OpenAI
+            from openai import OpenAI, AsyncOpenAI
             self.client = OpenAI(
                 api_key=os.getenv("OPTION_API_KEY"),
                 base_url=os.getenv("OPTION_API_BASE_URL")
             )
+            self.async_client = AsyncOpenAI(
+                api_key=os.getenv("OPTION_API_KEY"),
+                base_url=os.getenv("OPTION_API_BASE_URL")
+            )
         except ImportError:
             print("未找到openai模块，请安装openai模块")
             self.client = None
+            self.async_client = None
     
     def generate_options(
         self, 
@@ -56,66 +61,111 @@ class OptionService:
         Raises:
             APIError: 当API调用失败时
         """
-        # 检查是否启用选项生成
-        option_config = self.config_service.get_option_config()
-        if not option_config.get("enable_option_generation", True):
-            return []
-        
         # 检查客户端是否可用
         if not self.client:
             print("OpenAI客户端未初始化，跳过选项生成")
             return []
         
-        # 获取系统提示词
-        system_prompt = self.config_service.get_option_system_prompt()
-        
-        # 构建用户提示词
-        user_prompt = self._build_user_prompt(conversation_history, character_config, user_query,isMulti)
+        request_params = self._build_request_params(conversation_history, character_config, user_query, isMulti)
+        if request_params is None:
+            return []
         
         try:
-            # 构建请求参数
-            extra_body_list = [
-                'temperature',
-                'max_tokens',
-                'enable_reasoning'
-            ]
-            extra_body_dict = {
-                k: option_config[k] for k in extra_body_list if k in option_config
-            }
-            request_params = {
-                "model": os.getenv("OPTION_MODEL"),
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                'extra_body': extra_body_dict
-            }
-            
-            # 根据OpenAI库规范，添加禁用思考的参数
-            # 对于支持reasoning的模型（如o1系列），可以通过reasoning参数控制
-            # model_name = os.getenv("OPTION_MODEL", "").lower()
-            # if "o1" in model_name or "reasoning" in model_name:
-            #     request_params["reasoning"] = False
-            
             # 使用 OpenAI 库调用选项生成API
             response = self.client.chat.completions.create(**request_params)
+            return self._parse_options(response)
             
-            # 处理响应
-            if response.choices and len(response.choices) > 0:
-                content = response.choices[0].message.content.strip()
-                
-                # 按换行符分割选项
-                options = [opt.strip() for opt in content.split('\n') if opt.strip()]
-                
-                # 限制最多3个选项
-                return options[:3]
-            
+        except Exception as e:
+            print(f"选项生成失败: {str(e)}")
             return []
+
+    async def generate_options_async(
+        self, 
+        conversation_history: List[Dict[str, str]], 
+        character_config: Dict[str, Any],
+        user_query: str,
+        isMulti:bool =False
+    ) -> List[str]:
+        """
+        异步生成对话选项（参数和返回值同generate_options）
+        """
+        if not self.async_client:
+            print("OpenAI异步客户端未初始化，跳过选项生成")
+            return []
+        
+        request_params = self._build_request_params(conversation_history, character_config, user_query, isMulti)
+        if request_params is None:
+            return []
+        
+        try:
+            response = await self.async_client.chat.completions.create(**request_params)
+            return self._parse_options(response)
             
         except Exception as e:
             print(f"选项生成失败: {str(e)}")
             return []
 
+    def _build_request_params(
+        self, 
+        conversation_history: List[Dict[str, str]], 
+        character_config: Dict[str, Any],
+        user_query: str,
+        isMulti:bool
+    ) -> Optional[Dict[str, Any]]:
+        """
+        构建选项生成请求参数
+        
+        Returns:
+            请求参数，未启用选项生成时返回None
+        """
+        # 检查是否启用选项生成
+        option_config = self.config_service.get_option_config()
+        if not option_config.get("enable_option_generation", True):
+            return None
+        
+        # 获取系统提示词
+        system_prompt = self.config_service.get_option_system_prompt()
+        
+        # 构建用户提示词
+        user_prompt = self._build_user_prompt(conversation_history, character_config, user_query,isMulti)
+        
+        # 构建请求参数
+        extra_body_list = [
+            'temperature',
+            'max_tokens',
+            'enable_reasoning'
+        ]
+        extra_body_dict = {
+            k: option_config[k] for k in extra_body_list if k in option_config
+        }
+        
+        # 根据OpenAI库规范，添加禁用思考的参数
+        # 对于支持reasoning的模型（如o1系列），可以通过reasoning参数控制
+        # model_name = os.getenv("OPTION_MODEL", "").lower()
+        # if "o1" in model_name or "reasoning" in model_name:
+        #     request_params["reasoning"] = False
+        return {
+            "model": os.getenv("OPTION_MODEL"),
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            'extra_body': extra_body_dict
+        }
+
+    def _parse_options(self, response) -> List[str]:
+        """从API响应中解析选项（最多3个）"""
+        if response.choices and len(response.choices) > 0:
+            content = response.choices[0].message.content.strip()
+            
+            # 按换行符分割选项
+            options = [opt.strip() for opt in content.split('\n') if opt.strip()]
+            
+            # 限制最多3个选项
+            return options[:3]
+        
+        return []
+
     def _build_user_prompt(
         self, 
         conversation_history: List[Dict[str, str]], 
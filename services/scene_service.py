@@ -9,6 +9,9 @@ from pathlib import Path
 from typing import Dict, Any, Optional, List
 from datetime import datetime
 
+from utils.sqlite_store import get_sqlite_store, scene_owner
+from utils.page_cache import page_cache
+
 class SceneService:
     """场景服务类"""
     
@@ -55,6 +58,14 @@ class SceneService:
         Returns:
             场景数据字典
         """
+        store = get_sqlite_store()
+        if store is not None:
+            scenes_data = store.load_scenes(scene_owner(character_id, story_id))
+            if scenes_data is None:
+                scenes_data = self._create_default_scenes()
+                self.save_scenes(scenes_data, character_id, story_id)
+            return scenes_data
+        
         scene_file = self.get_scene_file_path(character_id, story_id)
         
         if scene_file.exists():
@@ -79,13 +90,21 @@ class SceneService:
             character_id: 角色ID
             story_id: 故事ID
         """
-        scene_file = self.get_scene_file_path(character_id, story_id)
+        store = get_sqlite_store()
+        if store is not None:
+            store.save_scenes(scene_owner(character_id, story_id), scenes_data)
+        else:
+            scene_file = self.get_scene_file_path(character_id, story_id)
+            
+            try:
+                with open(scene_file, 'w', encoding='utf-8') as f:
+                    json.dump(scenes_data, f, ensure_ascii=False, indent=2)
+            except IOError as e:
+                print(f"保存场景文件失败: {e}")
         
-        try:
-            with open(scene_file, 'w', encoding='utf-8') as f:
-                json.dump(scenes_data, f, ensure_ascii=False, indent=2)
-        except IOError as e:
-            print(f"保存场景文件失败: {e}")
+        # 聊天页面上显示的背景可能已变化
+        if not story_id:
+            page_cache.invalidate(character_id, kind="background_url")
     
     def _create_default_scenes(self) -> Dict[str, Any]:
         """
@@ -146,6 +165,12 @@ class SceneService:
             character_id: 角色ID
             story_id: 故事ID
         """
+        store = get_sqlite_store()
+        if store is not None:
+            # 单条UPSERT，无需读出并重写整份场景数据
+            store.record_background_usage(scene_owner(character_id, story_id), background_filename)
+            return
+        
         scenes_data = self.load_scenes(character_id, story_id)
         
         # 更新last_background
@@ -307,6 +332,11 @@ class SceneService:
             character_id: 角色ID
             story_id: 故事ID
         """
+        store = get_sqlite_store()
+        if store is not None:
+            store.set_background_impression(scene_owner(character_id, story_id), background_filename, impression)
+            return
+        
         scenes_data = self.load_scenes(character_id, story_id)
         
         # 查找背景记录
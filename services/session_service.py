@@ -0,0 +1,351 @@
+"""
+会话服务模块
+按会话Cookie区分浏览器，为每个会话保存独立的对话上下文（历史记录、当前角色、剧情模式和已加载的故事）
+
+会话保存在进程内的LRU表中：超过 max_sessions 时淘汰最久未使用的会话，空闲超过 idle_timeout 秒的会话也会被淘汰。
+每个请求开始时绑定本次请求的会话，chat_service/config_service/story_service 的会话相关状态都从当前绑定的会话读取；
+不在请求中（启动初始化、命令行脚本）时使用进程默认会话。
+
+状态存储配置为共享存储（state_store.backend=remote）时，会话状态在请求开始时按版本从存储同步，
+在请求（或流式响应）结束后写回，多个工作进程/主机之间共享同一会话。
+"""
+import sys
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from config import get_app_config
+from utils.state_store import get_state_store, StateVersionConflict
+
+_current_context: ContextVar[Optional["ConversationContext"]] = ContextVar("cabm_conversation_context", default=None)
+
+
+class ConversationContext:
+    """单个会话的对话上下文"""
+
+    def __init__(self, session_id: str, character_id: Optional[str] = None, history_loaded: bool = False):
+        """
+        初始化会话上下文
+
+        Args:
+            session_id: 会话ID
+            character_id: 初始角色ID
+            history_loaded: 历史记录是否已加载（为False时由chat_service在首次访问时加载）
+        """
+        self.session_id = session_id
+        self.created_at = time.time()
+        self.last_active = self.created_at
+        self.history_loaded = history_loaded
+
+        # 对话状态（chat_service）
+        self.history: List[Any] = []
+        self.story_mode = False
+        self.current_story_id: Optional[str] = None
+
+        # 当前角色（config_service）
+        self.character_id = character_id
+        # 内存中历史记录的来源（"character:角色ID" 或 "story:故事ID"，chat_service）
+        self.history_source: Optional[str] = None
+
+        # 已加载的故事（story_service）
+        self.loaded_story: Optional[str] = None
+        self.story_data: Optional[Dict[str, Any]] = None
+
+        # 每个检索范围上一轮的检索结果（memory_service，不导出到状态存储）
+        self.last_retrieval: Dict[Tuple[str, ...], Tuple[str, str]] = {}
+        # 检索结果缓存（memory_service，见utils.retrieval_cache）
+        self.retrieval_cache: Optional[Any] = None
+        # 进行中的检索预取 (查询, 任务Future列表)（memory_service）
+        self.prefetch: Optional[Tuple[str, List[Any]]] = None
+
+        # 共享存储中的版本号和上次写回的状态
+        self.state_version = 0
+        self.saved_state: Optional[Dict[str, Any]] = None
+
+    def to_state(self) -> Dict[str, Any]:
+        """
+        导出可写入状态存储的会话状态
+
+        Returns:
+            会话状态字典（故事数据不导出，由story_service按故事ID重新加载）
+        """
+        return {
+            "character_id": self.character_id,
+            "story_mode": self.story_mode,
+            "current_story_id": self.current_story_id,
+            "loaded_story": self.loaded_story,
+            "history_loaded": self.history_loaded,
+            "history_source": self.history_source,
+            "history": [
+                {"role": msg.role, "content": msg.content, "parsed": msg.parsed, "memory_id": msg.memory_id}
+                for msg in self.history
+            ],
+        }
+
+    def apply_state(self, state: Dict[str, Any], version: int) -> None:
+        """
+        应用从状态存储读取的会话状态
+
+        Args:
+            state: 会话状态字典
+            version: 状态版本号
+        """
+        from services.chat_service import Message
+
+        self.character_id = state.get("character_id")
+        self.story_mode = state.get("story_mode", False)
+        self.current_story_id = state.get("current_story_id")
+        if state.get("loaded_story") != self.loaded_story:
+            self.loaded_story = state.get("loaded_story")
+            self.story_data = None
+        self.history_loaded = state.get("history_loaded", True)
+        self.history_source = state.get("history_source")
+        self.history = [Message.from_dict(msg) for msg in state.get("history", [])]
+        self.state_version = version
+        self.saved_state = state
+
+
+def _merge_state(base: Dict[str, Any], ours: Dict[str, Any], theirs: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    三方合并会话状态（本次请求的修改与其他进程在此期间的修改）
+
+    Args:
+        base: 本次请求开始时的状态
+        ours: 本次请求结束时的状态
+        theirs: 状态存储中的最新状态
+
+    Returns:
+        合并后的状态，双方修改了同一字段且无法合并时返回None
+    """
+    merged = {}
+    for key, value in ours.items():
+        if key == "history":
+            continue
+        original, other = base.get(key), theirs.get(key)
+        if value == original or value == other:
+            merged[key] = other if value == original else value
+        elif other == original:
+            merged[key] = value
+        else:
+            return None
+
+    # 历史记录：双方都只在原记录后追加消息时按 原记录+对方追加+本次追加 合并
+    original, mine, other = base.get("history", []), ours.get("history", []), theirs.get("history", [])
+    if mine == original:
+        merged["history"] = other
+    elif other == original:
+        merged["history"] = mine
+    elif mine[:len(original)] == original and other[:len(original)] == original:
+        merged["history"] = other + mine[len(original):]
+    else:
+        return None
+    return merged
+
+
+class SessionService:
+    """会话上下文的LRU存储"""
+
+    # 版本冲突时合并重试的最大次数
+    SAVE_ATTEMPTS = 3
+
+    def __init__(self):
+        """初始化会话服务"""
+        session_config = get_app_config().get("session") or {}
+        self.cookie_name = session_config.get("cookie_name", "cabm_session")
+        self.max_sessions = max(1, int(session_config.get("max_sessions", 200)))
+        self.idle_timeout = int(session_config.get("idle_timeout", 3600))
+        self.default_context = ConversationContext("default", history_loaded=True)
+        self._sessions: "OrderedDict[str, ConversationContext]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"created": 0, "evicted_idle": 0, "evicted_lru": 0}
+        self.store = get_state_store()
+
+    def current(self) -> ConversationContext:
+        """
+        获取当前绑定的会话上下文
+
+        Returns:
+            当前请求的会话上下文，不在请求中时为进程默认会话
+        """
+        return _current_context.get() or self.default_context
+
+    def bind(self, context: ConversationContext) -> None:
+        """
+        将会话上下文绑定到当前线程/协程
+
+        Args:
+            context: 会话上下文
+        """
+        _current_context.set(context)
+
+    def bound(self, generator: Iterator[Any]) -> Iterator[Any]:
+        """
+        让流式响应生成器在当前会话中运行（响应体在请求处理结束后才被迭代）
+
+        Args:
+            generator: 流式响应生成器
+
+        Returns:
+            绑定了当前会话的生成器
+        """
+        context = self.current()
+
+        def run():
+            self.bind(context)
+            try:
+                yield from generator
+            finally:
+                self.save(context)
+
+        return run()
+
+    def get_or_create(self, session_id: Optional[str]) -> Tuple[ConversationContext, bool]:
+        """
+        获取会话上下文，不存在（或已被淘汰）时创建
+
+        Args:
+            session_id: Cookie中的会话ID，为空时生成新ID
+
+        Returns:
+            (会话上下文, 是否新建)
+        """
+        now = time.time()
+        created = False
+        with self._lock:
+            self._evict_idle(now)
+            context = self._sessions.get(session_id) if session_id else None
+            if context is not None:
+                self._sessions.move_to_end(session_id)
+                context.last_active = now
+            else:
+                # 新会话从进程默认角色开始，历史记录在首次访问时加载
+                context = ConversationContext(session_id or uuid.uuid4().hex, character_id=self.default_context.character_id)
+                self._sessions[context.session_id] = context
+                self._stats["created"] += 1
+                created = session_id is None
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self._stats["evicted_lru"] += 1
+
+        if self.store.shared and session_id:
+            self._sync_from_store(context)
+        return context, created
+
+    def save(self, context: ConversationContext) -> None:
+        """
+        将会话状态写回共享状态存储（进程内存储或状态未变化时不写入）
+        其他进程已修改同一会话时与最新状态三方合并后重试，无法合并时放弃本次写入并同步为最新状态
+
+        Args:
+            context: 会话上下文
+        """
+        if not self.store.shared or context is self.default_context:
+            return
+        state = context.to_state()
+        if state == context.saved_state:
+            return
+        key = self._store_key(context.session_id)
+        base, version, merged = context.saved_state or {}, context.state_version, False
+        try:
+            for _ in range(self.SAVE_ATTEMPTS):
+                try:
+                    version = self.store.set(key, state, expected_version=version)
+                except StateVersionConflict:
+                    # 其他进程在本次请求期间修改了同一会话：与最新状态合并后重试
+                    theirs, version = self.store.get(key)
+                    theirs = theirs or {}
+                    state, merged = _merge_state(base, state, theirs), True
+                    if state is None:
+                        print(f"会话状态版本冲突且无法合并，放弃本次写入并使用最新状态: {context.session_id} (版本 {version})")
+                        context.apply_state(theirs, version)
+                        return
+                    base = theirs
+                    continue
+                if merged:
+                    # 本地上下文同步为合并后的状态
+                    context.apply_state(state, version)
+                else:
+                    context.state_version = version
+                    context.saved_state = state
+                return
+            print(f"会话状态版本冲突重试{self.SAVE_ATTEMPTS}次仍失败，放弃本次写入: {context.session_id}")
+        except Exception as e:
+            print(f"写入会话状态失败: {e}")
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        获取会话统计
+
+        Returns:
+            当前会话数、累计创建数和淘汰数
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["active"] = len(self._sessions)
+        return stats
+
+    def init_app(self, app) -> None:
+        """
+        注册请求钩子：每个请求按Cookie解析并绑定会话，新会话在响应中写入Cookie
+
+        Args:
+            app: Flask应用
+        """
+        from flask import request, g
+
+        @app.before_request
+        def _bind_session():
+            if request.endpoint == "static":
+                return
+            context, created = self.get_or_create(request.cookies.get(self.cookie_name))
+            self.bind(context)
+            g.conversation_context = context
+            g.conversation_context_created = created
+
+        @app.after_request
+        def _set_session_cookie(response):
+            context = getattr(g, "conversation_context", None)
+            if context is not None and not response.is_streamed:
+                self.save(context)
+            if getattr(g, "conversation_context_created", False):
+                response.set_cookie(
+                    self.cookie_name,
+                    g.conversation_context.session_id,
+                    httponly=True,
+                    samesite="Lax"
+                )
+            return response
+
+    def _sync_from_store(self, context: ConversationContext) -> None:
+        try:
+            changed = self.store.get_if_changed(self._store_key(context.session_id), context.state_version)
+        except Exception as e:
+            print(f"读取会话状态失败，使用本地会话: {e}")
+            return
+        if changed is not None and changed[0] is not None:
+            context.apply_state(*changed)
+
+    def _store_key(self, session_id: str) -> str:
+        return f"session:{session_id}"
+
+    def _evict_idle(self, now: float) -> None:
+        if self.idle_timeout <= 0:
+            return
+        # OrderedDict按最近使用排序，最前面的会话最久未使用
+        while self._sessions:
+            session_id, context = next(iter(self._sessions.items()))
+            if now - context.last_active < self.idle_timeout:
+                break
+            del self._sessions[session_id]
+            self._stats["evicted_idle"] += 1
+
+
+# 创建全局会话服务实例
+session_service = SessionService()
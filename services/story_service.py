@@ -8,6 +8,8 @@ import json
 import time
 import re
 import rtoml
+import asyncio
+import threading
 from pathlib import Path
 from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
@@ -17,23 +19,54 @@ import logging
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
 from services.config_service import config_service
+from services.session_service import session_service
 from utils.api_utils import make_api_request, APIError
+from utils.sqlite_store import get_sqlite_store, history_key
+from utils.state_store import get_state_store, StateVersionConflict
+from utils.prompt_cache import prompt_cache, offset_bucket
 from config import get_director_prompts, DIRECTOR_SYSTEM_PROMPTS, get_story_prompts, get_option_config
 
 class StoryService:
     """剧情服务类"""
     
+    # 共享故事进度版本冲突时重新读取并累加的最大次数
+    PROGRESS_ATTEMPTS = 3
+    
     def __init__(self):
         """初始化剧情服务"""
         self.logger = logging.getLogger(__name__)
         self.config_service = config_service
         self.current_story = None
         self.story_data = None
+        # 每个故事的进度更新锁（多个会话可能同时推进同一个故事）
+        self._progress_locks: Dict[str, threading.Lock] = {}
+        self._progress_locks_guard = threading.Lock()
         
         # 确保配置服务已初始化
         if not self.config_service.initialized:
             self.config_service.initialize()
     
+    @property
+    def current_story(self) -> Optional[str]:
+        """当前会话已加载的故事ID"""
+        return session_service.current().loaded_story
+    
+    @current_story.setter
+    def current_story(self, story_id: Optional[str]):
+        session_service.current().loaded_story = story_id
+    
+    @property
+    def story_data(self) -> Optional[Dict[str, Any]]:
+        """当前会话已加载的故事数据（会话状态从共享存储同步后按故事ID重新加载）"""
+        context = session_service.current()
+        if context.story_data is None and context.loaded_story:
+            self.load_story(context.loaded_story)
+        return context.story_data
+    
+    @story_data.setter
+    def story_data(self, data: Optional[Dict[str, Any]]):
+        session_service.current().story_data = data
+    
     def list_stories(self) -> List[Dict[str, Any]]:
         """
         获取所有可用的故事存档
@@ -81,6 +114,7 @@ class StoryService:
         try:
             with open(story_path, 'r', encoding='utf-8') as f:
                 data = rtoml.load(f)
+            self._apply_stored_progress(story_id, data)
             
             # 获取角色信息（支持多角色）
             characters = []
@@ -114,7 +148,12 @@ class StoryService:
             # 获取最后游玩时间
             history_path = Path("data/saves") / story_id / "history.log"
             last_played = None
-            if history_path.exists():
+            store = get_sqlite_store()
+            if store is not None:
+                last_timestamp = store.last_history_timestamp(history_key(str(history_path)))
+                if last_timestamp:
+                    last_played = last_timestamp[:16]
+            elif history_path.exists():
                 try:
                     stat = history_path.stat()
                     last_played = datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M')
@@ -156,6 +195,7 @@ class StoryService:
         try:
             with open(story_path, 'r', encoding='utf-8') as f:
                 self.story_data = rtoml.load(f)
+            self._apply_stored_progress(story_id, self.story_data)
             
             self.current_story = story_id
             self.logger.info(f"成功加载故事: {story_id}")
@@ -208,7 +248,32 @@ class StoryService:
         if not self.story_data:
             raise ValueError("未加载任何故事")
         return self.story_data.get('progress', {}).get('offset', 0)
-    
+
+    def get_guidance(self) -> str:
+        """
+        获取当前进度的剧情引导（按章节和偏移档位缓存）
+
+        Returns:
+            剧情引导文本
+        """
+        offset = self.get_offset()
+        current, current_chapter, next_chapter = self.get_current_chapter_info()
+
+        def build():
+            # 根据偏移值添加引导内容
+            guidance = f"当前章节：`{current_chapter}`"
+            if next_chapter:  # 只有在还有下一章节时才添加引导
+                if offset < 10:
+                    guidance += f"。下一章节：`{next_chapter}`。请保持在当前章节，不要进入下一章节"
+                elif 10 <= offset < 30:
+                    guidance += f"。请暗示性地引导用户向`{next_chapter}`方向推进故事"
+                elif offset >= 30:
+                    guidance += f"。请制造突发事件以引导用户向`{next_chapter}`方向推进故事"
+            return guidance
+
+        return prompt_cache.get("story_guidance", build, story_id=self.current_story,
+                                chapter=current, bucket=offset_bucket(offset))
+
     def update_progress(self, advance_chapter: bool = False, offset_increment: int = 0):
         """
         更新故事进度
@@ -220,14 +285,27 @@ class StoryService:
         if not self.story_data or not self.current_story:
             raise ValueError("未加载任何故事")
         
-        if advance_chapter:
-            self.story_data['progress']['current'] += 1
-            self.story_data['progress']['offset'] = 0
-        else:
-            self.story_data['progress']['offset'] += offset_increment
-        
-        # 保存到文件
-        self._save_story_data()
+        with self._progress_locks_guard:
+            lock = self._progress_locks.setdefault(self.current_story, threading.Lock())
+        with lock:
+            for _ in range(self.PROGRESS_ATTEMPTS):
+                # 每个会话持有各自的故事数据副本，先读取其他会话/进程已保存的最新进度再累加
+                version = self._reload_progress(self.current_story, self.story_data)
+                if advance_chapter:
+                    self.story_data['progress']['current'] += 1
+                    self.story_data['progress']['offset'] = 0
+                else:
+                    self.story_data['progress']['offset'] += offset_increment
+                
+                # 保存到文件（共享存储按版本写入，其他进程在此期间更新过进度时重新读取后再累加）
+                try:
+                    self._save_story_data(expected_version=version)
+                    break
+                except StateVersionConflict:
+                    self.logger.warning(f"共享故事进度版本冲突，重新读取后重试: {self.current_story}")
+            else:
+                self.logger.error(f"共享故事进度多次版本冲突，放弃本次更新: {self.current_story}")
+                self._reload_progress(self.current_story, self.story_data)
         self.logger.info(f"更新故事进度: 章节={self.story_data['progress']['current']}, 偏移={self.story_data['progress']['offset']}")
         
         # 通知聊天服务更新系统提示词（如果在剧情模式下）
@@ -239,11 +317,93 @@ class StoryService:
         except Exception as e:
             self.logger.error(f"更新系统提示词失败: {e}")
     
-    def _save_story_data(self):
-        """保存故事数据到文件"""
+    def _reload_progress(self, story_id: str, story_data: Dict[str, Any]) -> Optional[int]:
+        """
+        从存储重新读取故事进度（文件存储时读取story.toml中的进度）
+        
+        Args:
+            story_id: 故事ID
+            story_data: 当前会话的故事数据
+            
+        Returns:
+            共享状态存储中进度的版本号（同 _apply_stored_progress）
+        """
+        if get_sqlite_store() is None:
+            story_path = Path("data/saves") / story_id / "story.toml"
+            try:
+                with open(story_path, 'r', encoding='utf-8') as f:
+                    progress = rtoml.load(f).get('progress')
+                if progress:
+                    story_data.setdefault('progress', {}).update(progress)
+            except Exception as e:
+                self.logger.error(f"读取故事进度失败: {e}")
+        return self._apply_stored_progress(story_id, story_data)
+    
+    def _apply_stored_progress(self, story_id: str, story_data: Dict[str, Any]) -> Optional[int]:
+        """
+        使用SQLite或共享状态存储中保存的进度覆盖story.toml中的进度（文件存储时不做处理）
+        
+        Args:
+            story_id: 故事ID
+            story_data: 从story.toml加载的故事数据
+            
+        Returns:
+            共享状态存储中进度的版本号，未使用共享存储或读取失败时返回None
+        """
+        store = get_sqlite_store()
+        if store is not None:
+            progress = store.load_story_progress(story_id)
+            if progress is not None:
+                story_data.setdefault('progress', {}).update(progress)
+        
+        # 多进程部署时以共享状态存储中的进度为准（其他进程可能刚推进了章节）
+        state_store = get_state_store()
+        if state_store.shared:
+            try:
+                progress, version = state_store.get(f"story_progress:{story_id}")
+            except Exception as e:
+                self.logger.error(f"读取共享故事进度失败: {e}")
+                return None
+            if progress is not None:
+                story_data.setdefault('progress', {}).update(progress)
+            return version
+        return None
+    
+    def _save_story_data(self, expected_version: Optional[int] = None):
+        """
+        保存故事数据到文件（SQLite存储时只写入进度）
+        
+        Args:
+            expected_version: 共享状态存储中进度的预期版本号，为None时直接覆盖
+            
+        Raises:
+            StateVersionConflict: 共享存储中的进度已被其他进程更新（此时不写入任何存储）
+        """
         if not self.story_data or not self.current_story:
             return
         
+        state_store = get_state_store()
+        if state_store.shared:
+            progress = self.story_data.get('progress', {})
+            try:
+                state_store.set(f"story_progress:{self.current_story}", {
+                    'current': progress.get('current', 0),
+                    'offset': progress.get('offset', 0)
+                }, expected_version=expected_version)
+            except StateVersionConflict:
+                raise
+            except Exception as e:
+                self.logger.error(f"保存共享故事进度失败: {e}")
+        
+        store = get_sqlite_store()
+        if store is not None:
+            progress = self.story_data.get('progress', {})
+            try:
+                store.save_story_progress(self.current_story, progress.get('current', 0), progress.get('offset', 0))
+            except Exception as e:
+                self.logger.error(f"保存故事进度失败: {e}")
+            return
+        
         story_path = Path("data/saves") / self.current_story / "story.toml"
         
         try:
@@ -261,7 +421,27 @@ class StoryService:
         outline = self.story_data.get('structure', {}).get('outline', [])
         
         return current >= len(outline) - 1
-    
+
+    def get_progress_update(self) -> Dict[str, Any]:
+        """
+        获取发送给前端的故事进度事件
+
+        Returns:
+            {'storyProgress': {...}}，故事结束时包含 storyFinished
+        """
+        current_idx, current_chapter, next_chapter = self.get_current_chapter_info()
+        progress_update = {
+            'storyProgress': {
+                'current': current_idx,
+                'currentChapter': current_chapter,
+                'nextChapter': next_chapter,
+                'offset': self.get_offset()
+            }
+        }
+        if self.is_story_finished():
+            progress_update['storyFinished'] = True
+        return progress_update
+
     def get_story_characters(self) -> List[Dict[str, Any]]:
         """
         获取故事中的角色信息
@@ -310,6 +490,60 @@ class StoryService:
         Returns:
             偏移值
         """
+        request = self._build_director_request(chat_history)
+        if request is None:
+            # 已经是最后一章，返回0表示故事结束
+            return 0
+        url, headers, request_data = request
+        
+        try:
+            self.logger.info(f"调用导演模型判断剧情进度...")
+            response, data = make_api_request(
+                url=url,
+                method="POST",
+                headers=headers,
+                json_data=request_data,
+                stream=False
+            )
+            return self._parse_director_response(data)
+            
+        except Exception as e:
+            self.logger.error(f"调用导演模型失败: {e}")
+            return 1# 出错时返回默认值
+    
+    async def call_director_model_async(self, chat_history: str):
+        """
+        异步调用导演模型判断剧情进度（参数和返回值同call_director_model）
+        """
+        request = self._build_director_request(chat_history)
+        if request is None:
+            return 0
+        url, headers, request_data = request
+        
+        try:
+            self.logger.info(f"调用导演模型判断剧情进度...")
+            # 在线程中通过共享HTTP客户端请求（复用连接池、重试预算和熔断状态）
+            # 与原来一样只请求一次，避免60秒超时被重试放大成数分钟
+            response, data = await asyncio.to_thread(
+                make_api_request, url=url, method="POST", headers=headers, json_data=request_data,
+                timeout=60, max_retries=1
+            )
+            return self._parse_director_response(data)
+            
+        except Exception as e:
+            self.logger.error(f"调用导演模型失败: {e}")
+            return 1# 出错时返回默认值
+    
+    def _build_director_request(self, chat_history: str) -> Optional[Tuple[str, Dict[str, str], Dict[str, Any]]]:
+        """
+        构建导演模型请求
+        
+        Args:
+            chat_history: 聊天历史记录
+            
+        Returns:
+            (请求地址, 请求头, 请求数据)，已经是最后一章时返回None
+        """
         if not self.story_data:
             raise ValueError("未加载任何故事")
         
@@ -317,14 +551,12 @@ class StoryService:
         _, current_chapter, next_chapter = self.get_current_chapter_info()
         
         if next_chapter is None:
-            # 已经是最后一章，返回0表示故事结束
-            return 0
+            return None
         
         # 构建提示词
         user_prompt = get_director_prompts(chat_history, current_chapter, next_chapter)
         
         # 获取API配置
-        option_config = get_option_config()
         url = self.config_service.get_option_api_url()
         api_key = self.config_service.get_option_api_key()
         
@@ -349,37 +581,36 @@ class StoryService:
             },
             "stream": False,
         }
+        return url + "/chat/completions", headers, request_data
+    
+    def _parse_director_response(self, data: Dict[str, Any]):
+        """
+        解析导演模型的回复
         
-        try:
-            self.logger.info(f"调用导演模型判断剧情进度...")
-            response, data = make_api_request(
-                url=url+"/chat/completions",
-                method="POST",
-                headers=headers,
-                json_data=request_data,
-                stream=False
-            )
-            # 提取回复内容
-            if "choices" in data and len(data["choices"]) > 0:
-                message = data["choices"][0].get("message", {})
-                if message and "content" in message:
-                    content = message["content"].strip()
-                    try:
-                        offset=int(content)
-                            # 验证范围
-                        if 0 <= offset <= 9:
-                            self.logger.info(f"导演模型判断结果: offset={offset}")
-                            return offset
-                        else:
-                            self.logger.warning(f"导演模型返回超出范围的结果: offset={offset}")
-                    
-                    except:
-                        self.logger.info(f"解析失败")
-                        return 1
+        Args:
+            data: API响应数据
             
-        except Exception as e:
-            self.logger.error(f"调用导演模型失败: {e}")
-            return 1# 出错时返回默认值
+        Returns:
+            偏移值（0-9），解析失败时返回1，超出范围时返回None
+        """
+        # 提取回复内容
+        if "choices" in data and len(data["choices"]) > 0:
+            message = data["choices"][0].get("message", {})
+            if message and "content" in message:
+                content = message["content"].strip()
+                try:
+                    offset=int(content)
+                        # 验证范围
+                    if 0 <= offset <= 9:
+                        self.logger.info(f"导演模型判断结果: offset={offset}")
+                        return offset
+                    else:
+                        self.logger.warning(f"导演模型返回超出范围的结果: offset={offset}")
+                
+                except:
+                    self.logger.info(f"解析失败")
+                    return 1
+        return None
     
     def create_story(self, story_id: str, title: str, character_ids: List[str], 
                     story_direction: str, background_images: List[str] = None) -> bool:
@@ -454,6 +685,7 @@ class StoryService:
             # 创建空的记忆和历史文件
             (story_dir / "memory.json").touch()
             (story_dir / "history.log").touch()
+            prompt_cache.invalidate(story_id=story_id)
             
             self.logger.info(f"成功创建故事: {story_id}")
             return True
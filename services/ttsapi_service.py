@@ -4,8 +4,10 @@ import json
 import logging
 import re
 import requests
+import threading
 from pathlib import Path
 from utils.env_utils import get_env_var
+from utils.http_client import get_http_client
 from pydub import AudioSegment
 from pydub.silence import detect_leading_silence
 from io import BytesIO
@@ -105,6 +107,7 @@ if get_env_var("TTS_SERVICE_METHOD", "siliconflow").lower() == "siliconflow":
             self.headers = {
                 "Authorization": f"Bearer {self.api_key}"
             }
+            self._voice_lock = threading.Lock()
 
             self._fetch_custom_voices()
 
@@ -142,7 +145,7 @@ if get_env_var("TTS_SERVICE_METHOD", "siliconflow").lower() == "siliconflow":
         def _fetch_custom_voices(self):
             try:
                 url = f"{self.base_url}/audio/voice/list"
-                response = requests.get(url, headers=self.headers)
+                response = get_http_client().get(url, headers=self.headers)
                 if response.status_code == 200:
                     result = response.json()
                     for voice in result.get("results", []):
@@ -288,10 +291,12 @@ if get_env_var("TTS_SERVICE_METHOD", "siliconflow").lower() == "siliconflow":
                 }
 
                 try:
-                    response = requests.post(
+                    # 上传会在服务端创建新音色，失败不重试以免重复创建
+                    response = get_http_client().post(
                         f"{self.base_url}/uploads/audio/voice",
                         files=files,
-                        headers=self.headers
+                        headers=self.headers,
+                        retries=0
                     )
                     if response.status_code == 200:
                         result = response.json()
@@ -382,7 +387,7 @@ if get_env_var("TTS_SERVICE_METHOD", "siliconflow").lower() == "siliconflow":
                 params["sample_rate"] = 48000
 
             try:
-                response = requests.post(url, json=params, headers=self.headers)
+                response = get_http_client().post(url, json=params, headers=self.headers)
                 if response.status_code == 200:
                     # 对音频进行静音处理
                     raw_audio = response.content
@@ -395,6 +400,18 @@ if get_env_var("TTS_SERVICE_METHOD", "siliconflow").lower() == "siliconflow":
                 logger.error(f"获取 TTS 音频失败: {e}")
                 raise
 
+        def warm_voice(self, role):
+            """
+            确保角色的音色映射可用（有本地参考音频但尚未上传时上传），切换角色时预热使用
+            """
+            wav_path = Path(".") / "data" / "ref_audio" / role / "1.wav"
+            if role not in self.role_name and wav_path.exists():
+                with self._voice_lock:
+                    if role not in self.role_name:
+                        self._upload_local_voices()
+            # 没有本地参考音频的角色使用预置音色
+            return role in self.role_name or not wav_path.exists()
+
         def running(self):
             return True
 else:
@@ -445,7 +462,7 @@ else:
                 "role": role,                   # str.(required) role
                 "temperature": 1,             # float. temperature for sampling
             }
-            response = requests.post(url, json=params)
+            response = get_http_client().post(url, json=params)
 
             if response.status_code == 200:
                 # 对音频进行静音处理
@@ -454,9 +471,14 @@ else:
                 return processed_audio
             else:
                 response.raise_for_status()
+        def warm_voice(self, role):
+            """
+            确认语音合成服务可用（GPT-SoVITS由服务端按角色名选择参考音频），切换角色时预热使用
+            """
+            return self.running()
         def running(self):
             try:
-                response = requests.get(f"{self.base_url}/running")
+                response = get_http_client().get(f"{self.base_url}/running", retries=0, timeout=5)
                 return response.status_code == 200
             except requests.RequestException:
                 return False
@@ -0,0 +1,197 @@
+"""
+预热服务模块
+切换角色或进入故事时，在后台线程池中并发加载该角色/故事的记忆数据库、角色详细信息数据库、
+最后消息时间（时间前缀）和语音合成音色，切换请求不再依次等待这些加载完成
+（历史记录尾部是会话本身需要的数据，由切换请求直接加载，与这些预热同时进行）。
+
+每个组件按 (组件, 对象) 只提交一次：已预热或正在预热的组件不会重复加载，加载失败的组件在下次切换时重试。
+加载结果由各服务自己缓存，这里只记录每个组件是否加载成功，不持有加载的数据。
+前端通过切换接口返回的状态或 /api/chat/warmup 查询各组件是否就绪。
+"""
+import sys
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from config import get_app_config
+
+
+class WarmupService:
+    """角色/故事切换时的并发预热"""
+
+    def __init__(self):
+        """初始化预热服务"""
+        warmup_config = get_app_config().get("warmup") or {}
+        self.enabled = bool(warmup_config.get("enabled", True))
+        self.max_workers = max(1, int(warmup_config.get("max_workers", 4)))
+        self.logger = logging.getLogger("WarmupService")
+        # 语音合成服务（由app.py在创建后设置，未启用时为None）
+        self.tts = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # (组件, 对象) -> 预热任务，任务结果只是是否加载成功
+        self._tasks: Dict[Tuple[str, str], Future] = {}
+        self._lock = threading.Lock()
+        self._stats = {"started": 0, "reused": 0, "failed": 0}
+        self._durations: Dict[str, List[float]] = {}
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="warmup")
+        return self._executor
+
+    def warm_character(self, character_id: str) -> Dict[str, Any]:
+        """
+        预热角色：记忆数据库、角色详细信息、时间前缀和音色
+
+        Args:
+            character_id: 角色ID
+
+        Returns:
+            预热状态（同 get_status）
+        """
+        from services.memory_service import memory_service
+        from services.character_details_service import character_details_service
+        from utils.history_utils import get_history_manager
+
+        history_manager = get_history_manager()
+        components = {
+            "memory": (f"character:{character_id}", lambda: memory_service.preload_memory(character_id)),
+            "details": (character_id, lambda: character_details_service.initialize_character_details(character_id)),
+            "time": (character_id, lambda: history_manager.time_tracker.get_last_message_time(character_id)),
+        }
+        self._add_voice(components, character_id)
+        return self._start(components)
+
+    def warm_story(self, story_id: str, character_id: str) -> Dict[str, Any]:
+        """
+        预热故事：故事记忆数据库、主角色的详细信息和音色
+
+        Args:
+            story_id: 故事ID
+            character_id: 故事的主角色ID
+
+        Returns:
+            预热状态（同 get_status）
+        """
+        from services.memory_service import memory_service
+        from services.character_details_service import character_details_service
+
+        components = {
+            "memory": (f"story:{story_id}", lambda: memory_service.preload_memory(story_id, is_story=True)),
+            "details": (character_id, lambda: character_details_service.initialize_character_details(character_id)),
+        }
+        self._add_voice(components, character_id)
+        return self._start(components)
+
+    def _add_voice(self, components: Dict[str, Tuple[str, Callable[[], Any]]], character_id: str) -> None:
+        tts = self.tts
+        if tts is not None and hasattr(tts, "warm_voice"):
+            components["voice"] = (character_id, lambda: tts.warm_voice(character_id))
+
+    def _start(self, components: Dict[str, Tuple[str, Callable[[], Any]]]) -> Dict[str, Any]:
+        """提交尚未预热的组件，返回这些组件的状态"""
+        targets = {name: (name, key) for name, (key, _) in components.items()}
+        if not self.enabled:
+            return self._describe(targets)
+
+        executor = self._get_executor()
+        for name, (key, loader) in components.items():
+            task_key = (name, key)
+            with self._lock:
+                future = self._tasks.get(task_key)
+                if future is not None and not self._failed(future):
+                    self._stats["reused"] += 1
+                    continue
+                self._stats["started"] += 1
+                self._tasks[task_key] = executor.submit(self._run, name, key, loader)
+        return self._describe(targets)
+
+    def _run(self, name: str, key: str, loader: Callable[[], Any]) -> bool:
+        """执行加载，只返回是否成功（加载的数据由各服务缓存，任务表不持有）"""
+        started = time.monotonic()
+        try:
+            result = loader()
+        except Exception as e:
+            self.logger.error(f"预热失败 {name}({key}): {e}")
+            with self._lock:
+                self._stats["failed"] += 1
+            return False
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._lock:
+            durations = self._durations.setdefault(name, [])
+            durations.append(elapsed_ms)
+            del durations[:-50]
+            if result is False:
+                self._stats["failed"] += 1
+        if result is False:
+            self.logger.warning(f"预热未完成 {name}({key})，耗时 {elapsed_ms:.0f}ms")
+        else:
+            self.logger.info(f"预热完成 {name}({key})，耗时 {elapsed_ms:.0f}ms")
+        return result is not False
+
+    @staticmethod
+    def _failed(future: Future) -> bool:
+        return future.done() and (future.cancelled() or future.result() is False)
+
+    def _describe(self, targets: Dict[str, Tuple[str, str]]) -> Dict[str, Any]:
+        components = {}
+        with self._lock:
+            for name, task_key in targets.items():
+                future = self._tasks.get(task_key)
+                if future is None:
+                    components[name] = "pending"
+                elif not future.done():
+                    components[name] = "loading"
+                else:
+                    components[name] = "failed" if self._failed(future) else "ready"
+        # 失败的组件在检索时会再次按需加载，不阻塞就绪状态
+        ready = all(state in ("ready", "failed") for state in components.values())
+        return {"ready": ready, "components": components}
+
+    def get_status(self, character_id: Optional[str] = None, story_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        获取角色或故事的预热状态（不提交新的预热任务）
+
+        Args:
+            character_id: 角色ID（故事模式下为主角色ID）
+            story_id: 故事ID，为空时查询角色的预热状态
+
+        Returns:
+            {"ready": 是否全部就绪, "components": {组件: pending/loading/ready/failed}}
+        """
+        if story_id:
+            targets = {"memory": ("memory", f"story:{story_id}")}
+        else:
+            targets = {"memory": ("memory", f"character:{character_id}"), "time": ("time", character_id)}
+        if character_id:
+            targets["details"] = ("details", character_id)
+            if self.tts is not None:
+                targets["voice"] = ("voice", character_id)
+        return self._describe(targets)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取预热统计
+
+        Returns:
+            提交/复用（已预热或正在预热）/失败的次数和各组件最近的平均加载耗时（毫秒）
+        """
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["avg_ms"] = {
+                name: round(sum(durations) / len(durations), 1)
+                for name, durations in self._durations.items() if durations
+            }
+        return stats
+
+
+# 创建全局预热服务实例
+warmup_service = WarmupService()
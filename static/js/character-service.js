@@ -269,6 +269,9 @@ export async function selectCharacter(characterId) {
         currentCharacter = data.character;
         console.log('切换后的角色信息:', currentCharacter);
 
+        // 记忆库、角色详情、历史记录和音色在后台预热，就绪后再通知页面
+        watchWarmup(data.warmup);
+
         updateCharacterImage();
         renderCharacterList();
 
@@ -291,6 +294,48 @@ export async function selectCharacter(characterId) {
     }
 }
 
+// 预热状态轮询间隔（毫秒）和最多轮询次数
+const WARMUP_POLL_MS = 500;
+const WARMUP_MAX_POLLS = 40;
+let warmupTimer = null;
+
+// 跟踪切换角色后的预热状态：document.body.dataset.warmup 为 loading/ready，就绪时派发 warmup-ready 事件
+export function watchWarmup(status = null) {
+    clearTimeout(warmupTimer);
+    let polls = 0;
+
+    const update = (warmup) => {
+        if (warmup && warmup.ready) {
+            document.body.dataset.warmup = 'ready';
+            console.log('角色预热完成:', warmup.components);
+            window.dispatchEvent(new CustomEvent('warmup-ready', { detail: warmup }));
+            return;
+        }
+        document.body.dataset.warmup = 'loading';
+        if (++polls > WARMUP_MAX_POLLS) {
+            console.warn('角色预热超时:', warmup && warmup.components);
+            return;
+        }
+        warmupTimer = setTimeout(poll, WARMUP_POLL_MS);
+    };
+
+    const poll = async () => {
+        try {
+            const response = await fetch('/api/chat/warmup');
+            const data = await response.json();
+            update(data.success ? data.warmup : null);
+        } catch (error) {
+            console.warn('获取预热状态失败:', error);
+        }
+    };
+
+    if (status) {
+        update(status);
+    } else {
+        poll();
+    }
+}
+
 // 加载角色图片列表
 async function loadCharacterImages(characterId) {
     if (!characterId) {
@@ -3,13 +3,16 @@ import {
     sendMessage, 
     changeBackground, 
     continueOutput, 
-    skipTyping 
+    skipTyping,
+    prefetchContext,
+    schedulePrefetch
 } from './chat-service.js';
 
 import {
     loadCharacters,
     toggleCharacterModal,
-    getCurrentCharacter
+    getCurrentCharacter,
+    watchWarmup
 } from './character-service.js';
 
 import { 
@@ -37,6 +40,9 @@ document.addEventListener('DOMContentLoaded', () => {
         window.isMultiCharacterStory = false;
         // 加载角色数据
         loadCharacters();
+
+        // 进入页面时后台预热当前角色，跟踪就绪状态
+        watchWarmup();
         
         // 加载初始背景
         if (window.getBackgroundService) {
@@ -69,6 +75,10 @@ document.addEventListener('DOMContentLoaded', () => {
         micButton?.addEventListener('click', () => toggleRecording(messageInput, micButton, showError));
         errorCloseButton?.addEventListener('click', hideError);
 
+        // 预取检索结果：页面加载时使用最后一条角色回复，输入停顿后使用正在输入的内容
+        prefetchContext();
+        messageInput?.addEventListener('input', schedulePrefetch);
+
         // 绑定确认对话框事件
         const confirmYesButton = document.getElementById('confirmYesButton');
         const confirmNoButton = document.getElementById('confirmNoButton');
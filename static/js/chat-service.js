@@ -24,6 +24,11 @@ import { setStreamProcessor, resetAudioQueue } from './audio-service.js';
 // 流式处理器实例
 let streamProcessor = null;
 
+// 输入停顿多久后预取检索结果（毫秒）
+const PREFETCH_DEBOUNCE_MS = 600;
+let prefetchTimer = null;
+let lastPrefetchText = null;
+
 // 发送消息
 export async function sendMessage() {
     const message = messageInput.value.trim();
@@ -113,6 +118,9 @@ export async function sendMessage() {
         window.hideOptionButtons();
     }
 
+    // 取消尚未发出的预取
+    clearTimeout(prefetchTimer);
+
     // 清空输入框并更新状态
     messageInput.value = '';
     
@@ -222,6 +230,32 @@ export async function sendMessage() {
     }
 }
 
+// 预取检索结果（不传文本时服务端使用最后一条角色回复），正式发送时记忆检索可直接命中缓存
+export function prefetchContext(text = '') {
+    if (text === lastPrefetchText) {
+        return;
+    }
+    lastPrefetchText = text;
+    fetch('/api/chat/prefetch', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ message: text })
+    }).catch(error => console.warn('预取检索结果失败:', error));
+}
+
+// 输入停顿后用正在输入的内容预取检索结果
+export function schedulePrefetch() {
+    clearTimeout(prefetchTimer);
+    prefetchTimer = setTimeout(() => {
+        const text = messageInput.value.trim();
+        if (text.length >= 2 && !getIsProcessing()) {
+            prefetchContext(text);
+        }
+    }, PREFETCH_DEBOUNCE_MS);
+}
+
 // 更换背景
 export async function changeBackground() {
     if (getIsProcessing()) {
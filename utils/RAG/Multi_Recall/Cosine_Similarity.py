@@ -1,5 +1,7 @@
 from .Retriever import *
 from typing import List, Literal, Dict, Union
+from collections import OrderedDict
+import threading
 import traceback
 import os
 try:
@@ -115,6 +117,8 @@ embed_dict = {
     'Model': Embedding_Model,
     'API': Embedding_API
 }
+
+QUERY_EMBED_CACHE_SIZE = 64  # 缓存最近查询的向量数
 '''
 TODO
 由Annoy重构为使用list的存储模式.
@@ -133,6 +137,22 @@ class Cosine_Similarity(Retriever):
         if self.embedClass is None:
             raise ValueError("当前选择的嵌入方法不可用!")
         self.embed = self.embedClass(**embed_kwds)
+        self._query_embeds = OrderedDict()  # 查询文本 -> 归一化的查询向量（LRU）
+        self._query_lock = threading.Lock()
+
+    def embed_query(self, query: str) -> np.ndarray:
+        # 计算归一化的查询向量；最近的查询带缓存，检索结果缓存比较查询相似度和随后的召回共用同一次嵌入
+        with self._query_lock:
+            if query in self._query_embeds:
+                self._query_embeds.move_to_end(query)
+                return self._query_embeds[query]
+        query_embed = np.array(self.embed(query)[0])
+        query_embed = query_embed / np.linalg.norm(query_embed)
+        with self._query_lock:
+            self._query_embeds[query] = query_embed
+            while len(self._query_embeds) > QUERY_EMBED_CACHE_SIZE:
+                self._query_embeds.popitem(last=False)
+        return query_embed
 
     def save_to_file(self, file_path: str):
         logger.info('保存向量数据库')
@@ -168,9 +188,7 @@ class Cosine_Similarity(Retriever):
                   top_k: int = 10
                   ):
         # 1. 计算query向量，归一化
-        query_embed = self.embed(query)[0]
-        query_embed = np.array(query_embed)
-        query_embed = query_embed / np.linalg.norm(query_embed)
+        query_embed = self.embed_query(query)
 
         # 2. 计算余弦相似度（向量点积，因为归一化了，所以点积=余弦相似度）
         sims = []
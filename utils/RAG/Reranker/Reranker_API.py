@@ -1,4 +1,5 @@
-import requests
+from utils.http_client import get_http_client
+
 class Reranker_API:
     def __init__(self, base_url, api_key, model):
         self.api_key = api_key
@@ -25,7 +26,7 @@ class Reranker_API:
             "top_n": k,
             "return_documents": False
         }
-        response = requests.post(url, headers=headers, json=data)
+        response = get_http_client().post(url, headers=headers, json=data)
         response.raise_for_status()
         results = response.json()["results"]
         # 按得分排序并返回文档索引
@@ -72,6 +72,13 @@ class Retriever:
             self.id_to_doc[starId] = doc
             starId += 1
         return self
+    def embed_query(self, query):
+        # 查询向量（有向量召回模块时），没有时返回None
+        for recall_module in self.recall_dict.values():
+            if hasattr(recall_module, 'embed_query'):
+                return recall_module.embed_query(query)
+        return None
+
     def retrieval(self, query, 
                   methods = None,
                   top_k = 10
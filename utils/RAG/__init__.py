@@ -2,6 +2,10 @@ import os
 from typing import List, Union
 from .Retriever_all import Retriever
 from importlib import import_module
+
+RECALL_TOP_K = 10  # 精排前的召回数量
+MAX_BACKFILL_HITS = 4  # 排除文档后最多加深召回的命中数（每个命中约带来3个候选：命中文档及其前后文）
+
 class RAG:
     def __init__(self, config: dict):
         # 初始化函数
@@ -27,9 +31,19 @@ class RAG:
         self.retriever.add(corpus)
         return self
         
-    def req(self, query, top_k=5) -> List[str]:
-        # 查询函数
-        retrieval_res = self.retriever.retrieval(query)  # 获得初步查询
+    def embed_query(self, query):
+        # 查询向量（归一化，带缓存），没有向量召回模块时返回None
+        return self.retriever.embed_query(query)
+
+    def req(self, query, top_k=5, exclude_docs=None, backfill=None) -> List[str]:
+        # 查询函数（exclude_docs中的文档在精排前排除，并加深召回补足被排除的候选）
+        # backfill: 按多少个被排除的文档加深召回，默认为exclude_docs的数量（调用方自行排除时单独指定）
+        if backfill is None:
+            backfill = len(exclude_docs) if exclude_docs else 0
+        recall_k = RECALL_TOP_K + 3 * min(backfill, MAX_BACKFILL_HITS)
+        retrieval_res = self.retriever.retrieval(query, top_k=recall_k)  # 获得初步查询
+        if retrieval_res and exclude_docs:
+            retrieval_res = [doc for doc in retrieval_res if doc not in exclude_docs]
         if retrieval_res is None or len(retrieval_res) == 0:
             return []
         rerank_res = self.reranker.rerank(retrieval_res, query, k=top_k)  # 后处理, 精排
@@ -3,10 +3,11 @@ API工具模块
 用于处理API请求和错误
 """
 import json
-import time
 import requests
 from typing import Dict, Any, Optional, Tuple, List
 
+from utils.http_client import get_http_client
+
 class APIError(Exception):
     """API错误类"""
     def __init__(self, message: str, status_code: Optional[int] = None, response: Optional[Any] = None):
@@ -24,10 +25,10 @@ def make_api_request(
     stream: bool = False,
     timeout: int = 30,
     max_retries: int = 3,
-    retry_delay: int = 1
+    retry_delay: float = 1
 ) -> Tuple[requests.Response, Any]:
     """
-    发送API请求并处理错误
+    发送API请求并处理错误（通过共享HTTP客户端，复用连接并按退避策略重试）
     
     Args:
         url: API端点URL
@@ -37,8 +38,8 @@ def make_api_request(
         json_data: JSON数据
         stream: 是否使用流式响应
         timeout: 超时时间（秒）
-        max_retries: 最大重试次数
-        retry_delay: 重试延迟（秒）
+        max_retries: 最多尝试次数（含首次请求）；只有连接错误、超时和429/5xx会重试
+        retry_delay: 指数退避的基础等待时间（秒）
         
     Returns:
         元组 (response, data)，其中response是请求响应对象，data是响应数据
@@ -53,64 +54,44 @@ def make_api_request(
     if json_data is not None and "Content-Type" not in headers:
         headers["Content-Type"] = "application/json"
     
-    retries = 0
-    last_error = None
+    try:
+        response = get_http_client().request(
+            method,
+            url,
+            retries=max(0, max_retries - 1),
+            backoff_base=retry_delay,
+            headers=headers,
+            data=data,
+            json=json_data,
+            stream=stream,
+            timeout=timeout
+        )
+    except requests.RequestException as e:
+        raise APIError(f"API请求失败: {str(e)}")
     
-    while retries < max_retries:
+    # 检查HTTP状态码
+    if response.status_code >= 400:
+        error_msg = f"API请求失败: HTTP {response.status_code}"
         try:
-            response = requests.request(
-                method=method,
-                url=url,
-                headers=headers,
-                data=data,
-                json=json_data,
-                stream=stream,
-                timeout=timeout
-            )
-            
-            # 检查HTTP状态码
-            if response.status_code >= 400:
-                error_msg = f"API请求失败: HTTP {response.status_code}"
-                try:
-                    error_data = response.json()
-                    if isinstance(error_data, dict) and "error" in error_data:
-                        error_msg += f" - {error_data['error']}"
-                except:
-                    pass
-                
-                raise APIError(error_msg, response.status_code, response)
-            
-            # 如果是流式响应，直接返回响应对象
-            if stream:
-                return response, None
-            
-            # 解析JSON响应
-            try:
-                response_data = response.json()
-                return response, response_data
-            except json.JSONDecodeError:
-                # 如果不是JSON响应，返回文本内容
-                return response, response.text
-                
-        except (requests.RequestException, APIError) as e:
-            last_error = e
-            retries += 1
-            
-            # 如果是最后一次重试，或者是认证错误（不需要重试），则抛出异常
-            if retries >= max_retries or (
-                isinstance(e, APIError) and e.status_code in (401, 403)
-            ):
-                if isinstance(e, requests.RequestException):
-                    raise APIError(f"API请求失败: {str(e)}")
-                raise e
-            
-            # 等待一段时间后重试
-            time.sleep(retry_delay)
+            error_data = response.json()
+            if isinstance(error_data, dict) and "error" in error_data:
+                error_msg += f" - {error_data['error']}"
+        except:
+            pass
+        
+        raise APIError(error_msg, response.status_code, response)
     
-    # 如果所有重试都失败，抛出最后一个错误
-    if isinstance(last_error, APIError):
-        raise last_error
-    raise APIError(f"API请求失败，已重试{max_retries}次: {str(last_error)}")
+    # 如果是流式响应，直接返回响应对象
+    if stream:
+        return response, None
+    
+    # 解析JSON响应
+    try:
+        response_data = response.json()
+        return response, response_data
+    except json.JSONDecodeError:
+        # 如果不是JSON响应，返回文本内容
+        return response, response.text
 
 def handle_api_error(error: APIError) -> Dict[str, Any]:
     """
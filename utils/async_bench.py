@@ -0,0 +1,148 @@
+"""
+流式对话并发基准测试
+启动一个本地的OpenAI兼容流式接口（按固定间隔逐token输出），分别用线程池+同步OpenAI客户端（Flask/WSGI的方式）
+和单事件循环+AsyncOpenAI（ASGI入口的方式）并发读取N个流，对比总耗时、首token延迟和占用的线程数
+
+用法（在项目根目录执行）：
+    python -m utils.async_bench [--streams 300] [--tokens 50] [--interval-ms 20] [--threads 32]
+"""
+import json
+import time
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from openai import OpenAI, AsyncOpenAI
+
+
+class FakeChatServer:
+    """OpenAI兼容的本地流式对话接口（只实现 POST /v1/chat/completions 的流式输出）"""
+
+    def __init__(self, tokens: int, interval: float):
+        self.tokens = tokens
+        self.interval = interval
+        self.port = None
+        self._loop = None
+        self._ready = threading.Event()
+
+    def start(self) -> "FakeChatServer":
+        threading.Thread(target=self._run, daemon=True).start()
+        self._ready.wait()
+        return self
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def _run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        server = self._loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", 0, backlog=4096))
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                # 读取请求头和请求体（支持keep-alive连接上的多个请求）
+                header = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in header.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                if length:
+                    await reader.readexactly(length)
+
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+                for i in range(self.tokens):
+                    await asyncio.sleep(self.interval)
+                    chunk = {
+                        "id": "bench", "object": "chat.completion.chunk", "created": 0, "model": "bench",
+                        "choices": [{"index": 0, "delta": {"content": f"t{i} "}, "finish_reason": None}]
+                    }
+                    self._write_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode())
+                    await writer.drain()
+                self._write_chunk(writer, b"data: [DONE]\n\n")
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _write_chunk(writer: asyncio.StreamWriter, data: bytes) -> None:
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+
+def _percentile(values: List[float], ratio: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))] if ordered else 0.0
+
+
+def run_threaded(base_url: str, streams: int, threads: int) -> Tuple[float, List[float], int]:
+    """线程池中用同步客户端读取（每个流占用一个线程直到结束）"""
+    client = OpenAI(api_key="bench", base_url=base_url, max_retries=0)
+    peak_threads = threading.active_count()
+
+    def one_stream() -> float:
+        nonlocal peak_threads
+        first = None
+        for chunk in client.chat.completions.create(model="bench", messages=[{"role": "user", "content": "hi"}], stream=True):
+            if first is None and chunk.choices and chunk.choices[0].delta.content:
+                first = time.perf_counter() - start
+                peak_threads = max(peak_threads, threading.active_count())
+        return first or 0.0
+
+    # 首token延迟从整批请求开始计时，包含在线程池中排队的时间
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        first_tokens = list(executor.map(lambda _: one_stream(), range(streams)))
+    return time.perf_counter() - start, first_tokens, peak_threads
+
+
+def run_async(base_url: str, streams: int) -> Tuple[float, List[float], int]:
+    """单个事件循环中用异步客户端并发读取"""
+    peak_threads = threading.active_count()
+
+    async def main() -> List[float]:
+        nonlocal peak_threads
+        client = AsyncOpenAI(api_key="bench", base_url=base_url, max_retries=0)
+
+        async def one_stream() -> float:
+            nonlocal peak_threads
+            first = None
+            response = await client.chat.completions.create(model="bench", messages=[{"role": "user", "content": "hi"}], stream=True)
+            async for chunk in response:
+                if first is None and chunk.choices and chunk.choices[0].delta.content:
+                    first = time.perf_counter() - start
+                    peak_threads = max(peak_threads, threading.active_count())
+            return first or 0.0
+
+        return await asyncio.gather(*(one_stream() for _ in range(streams)))
+
+    start = time.perf_counter()
+    first_tokens = asyncio.run(main())
+    return time.perf_counter() - start, first_tokens, peak_threads
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="流式对话并发基准测试（线程池 vs 异步）")
+    parser.add_argument("--streams", type=int, default=300, help="并发流数量")
+    parser.add_argument("--tokens", type=int, default=50, help="每个流的token数")
+    parser.add_argument("--interval-ms", type=float, default=20, help="token间隔（毫秒）")
+    parser.add_argument("--threads", type=int, default=32, help="线程池大小（模拟WSGI工作线程数）")
+    args = parser.parse_args()
+
+    server = FakeChatServer(args.tokens, args.interval_ms / 1000.0).start()
+    ideal = args.tokens * args.interval_ms / 1000.0
+    print(f"{args.streams} 个并发流，每个 {args.tokens} 个token，间隔 {args.interval_ms}ms（单个流理想耗时 {ideal:.2f}s）")
+
+    for label, (elapsed, first_tokens, peak_threads) in (
+        (f"线程池({args.threads}线程)", run_threaded(server.base_url, args.streams, args.threads)),
+        ("异步", run_async(server.base_url, args.streams)),
+    ):
+        print(f"{label}: 总耗时={elapsed:.2f}s 首token p50={_percentile(first_tokens, 0.5) * 1000:.0f}ms "
+              f"p95={_percentile(first_tokens, 0.95) * 1000:.0f}ms 峰值线程数={peak_threads}")
@@ -0,0 +1,407 @@
+"""
+历史记录全文检索模块
+为每个历史记录文件（角色历史、故事历史）维护一个增量倒排索引
+
+- 中文使用jieba分词（未安装时退化为单字+二元组），英文按空白和标点切分
+- 文档编号即消息在完整历史（含归档分段）中的全局下标，与分页接口一致
+- 写入新消息时增量更新已加载的索引；未加载的索引在首次检索时从磁盘补齐
+- 索引快照保存在日志旁的 <log>.index.json.gz，进程退出时写回
+"""
+import os
+import re
+import json
+import gzip
+import math
+import time
+import atexit
+import heapq
+import base64
+from array import array
+from bisect import bisect_left
+import logging
+import threading
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+from utils import history_segments
+from utils.text_utils import get_parsed_message
+
+try:
+    import jieba
+    jieba.setLogLevel(logging.WARNING)
+except ImportError:
+    jieba = None
+
+INDEX_VERSION = 1
+TOKENIZER_NAME = "jieba" if jieba is not None else "cjk-bigram"
+
+# 连续的中日韩字符 / 连续的字母数字
+_TOKEN_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[0-9a-z_]+(?:'[a-z]+)?")
+_CJK_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+_PHRASE_PATTERN = re.compile(r'"([^"]+)"|“([^”]+)”|(\S+)')
+
+# BM25参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 补齐的消息达到该数量时立即写回快照，否则等进程退出时再写
+SNAPSHOT_MIN_NEW = 1000
+
+
+def _split_cjk(run: str, for_query: bool) -> List[str]:
+    """切分一段连续的中文"""
+    if jieba is not None:
+        if for_query:
+            return [word for word in jieba.lcut(run) if word.strip()]
+        return [word for word in jieba.lcut_for_search(run) if word.strip()]
+    # 未安装jieba：索引同时写入单字和二元组，查询时优先使用二元组
+    if len(run) == 1:
+        return [run]
+    bigrams = [run[i:i + 2] for i in range(len(run) - 1)]
+    if for_query:
+        return bigrams
+    return list(run) + bigrams
+
+
+def tokenize(text: str, for_query: bool = False) -> List[str]:
+    """
+    将文本切分为检索词
+
+    Args:
+        text: 原始文本
+        for_query: 是否为查询切分（查询使用更少、更长的词）
+
+    Returns:
+        检索词列表（已转小写，可能重复）
+    """
+    tokens: List[str] = []
+    for match in _TOKEN_PATTERN.finditer(text.lower()):
+        run = match.group(0)
+        if _CJK_PATTERN.match(run):
+            tokens.extend(_split_cjk(run, for_query))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def parse_query(query: str) -> List[Tuple[str, bool]]:
+    """
+    解析查询语句，引号包围的部分作为短语
+
+    Args:
+        query: 查询语句，如 `猫 "晚安 明天见"`
+
+    Returns:
+        [(文本, 是否为短语)] 列表
+    """
+    parts = []
+    for match in _PHRASE_PATTERN.finditer(query):
+        phrase = match.group(1) or match.group(2)
+        if phrase is not None:
+            if phrase.strip():
+                parts.append((phrase.strip(), True))
+        else:
+            parts.append((match.group(3), False))
+    return parts
+
+
+def _record_text(record: Dict[str, Any]) -> str:
+    """取出用于检索的纯文本（角色回复使用预解析的content）"""
+    if record.get("role") in ("user", "system"):
+        return str(record.get("content", ""))
+    return get_parsed_message(record)["content"]
+
+
+class _FileIndex:
+    """单个历史记录文件的倒排索引（倒排表为按文档编号升序的紧凑数组）"""
+
+    def __init__(self):
+        self.postings: Dict[str, array] = {}
+        self.frequencies: Dict[str, array] = {}
+        self.timestamps: List[str] = []
+        self.roles: List[str] = []
+        self.texts: List[str] = []
+        self.lengths: List[int] = []
+        self.total_length = 0
+        self.unsaved = 0
+        self.synced = False
+
+    @property
+    def count(self) -> int:
+        return len(self.texts)
+
+    def add(self, record: Dict[str, Any]) -> None:
+        """追加一条消息（文档编号为当前文档数）"""
+        doc_id = len(self.texts)
+        text = _record_text(record)
+        tokens = tokenize(text)
+        counts: Dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            docs = self.postings.get(token)
+            if docs is None:
+                docs = self.postings[token] = array("I")
+                self.frequencies[token] = array("H")
+            docs.append(doc_id)
+            self.frequencies[token].append(min(tf, 0xFFFF))
+        self.timestamps.append(record.get("timestamp", ""))
+        self.roles.append(record.get("role", ""))
+        self.texts.append(text)
+        self.lengths.append(len(tokens))
+        self.total_length += len(tokens)
+        self.unsaved += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": INDEX_VERSION,
+            "tokenizer": TOKENIZER_NAME,
+            "timestamps": self.timestamps,
+            "roles": self.roles,
+            "texts": self.texts,
+            "lengths": self.lengths,
+            "postings": {
+                term: [
+                    base64.b64encode(docs.tobytes()).decode("ascii"),
+                    base64.b64encode(self.frequencies[term].tobytes()).decode("ascii"),
+                ]
+                for term, docs in self.postings.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> Optional["_FileIndex"]:
+        if data.get("version") != INDEX_VERSION or data.get("tokenizer") != TOKENIZER_NAME:
+            return None
+        index = cls()
+        index.timestamps = data["timestamps"]
+        index.roles = data["roles"]
+        index.texts = data["texts"]
+        index.lengths = data["lengths"]
+        index.total_length = sum(index.lengths)
+        for term, (docs_b64, tfs_b64) in data["postings"].items():
+            docs = array("I")
+            docs.frombytes(base64.b64decode(docs_b64))
+            tfs = array("H")
+            tfs.frombytes(base64.b64decode(tfs_b64))
+            index.postings[term] = docs
+            index.frequencies[term] = tfs
+        return index
+
+
+class HistorySearchIndex:
+    """历史记录检索索引管理器（按文件绝对路径管理各自的倒排索引）"""
+
+    def __init__(self, read_range: Callable[[str, int], Tuple[List[Dict[str, Any]], int]],
+                 message_count: Callable[[str], Optional[int]],
+                 search_config: Optional[Dict[str, Any]] = None):
+        """
+        初始化索引管理器
+
+        Args:
+            read_range: 读取消息的函数，read_range(file_path, start) 返回 (start之后的消息, 消息总数)
+            message_count: 不读磁盘获取消息总数的函数，未知时返回None
+            search_config: 检索配置，包含enabled、max_page_size、snippet_chars
+        """
+        search_config = search_config or {}
+        self.enabled = search_config.get("enabled", True)
+        self.max_page_size = search_config.get("max_page_size", 50)
+        self.snippet_chars = search_config.get("snippet_chars", 40)
+        self._read_range = read_range
+        self._message_count = message_count
+        self._indexes: Dict[str, _FileIndex] = {}
+        atexit.register(self.save_all)
+
+    @staticmethod
+    def get_index_path(log_path: str) -> str:
+        """获取索引快照路径"""
+        return f"{log_path}.index.json.gz"
+
+    def _load_snapshot(self, log_path: str) -> _FileIndex:
+        index_path = self.get_index_path(log_path)
+        if os.path.exists(index_path):
+            try:
+                with gzip.open(index_path, "rt", encoding="utf-8") as f:
+                    index = _FileIndex.from_dict(json.load(f))
+                if index is not None:
+                    return index
+            except Exception as e:
+                print(f"加载历史检索索引失败 {index_path}: {e}")
+        return _FileIndex()
+
+    def _save(self, log_path: str, index: _FileIndex) -> None:
+        """原子地写入索引快照"""
+        index_path = self.get_index_path(log_path)
+        tmp_path = index_path + ".tmp"
+        try:
+            with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=3) as f:
+                json.dump(index.to_dict(), f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, index_path)
+            index.unsaved = 0
+        except Exception as e:
+            print(f"保存历史检索索引失败 {index_path}: {e}")
+
+    def _get_index(self, log_path: str) -> _FileIndex:
+        """获取文件的索引并补齐尚未索引的消息，调用方需持有该文件的锁"""
+        key = os.path.abspath(log_path)
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._load_snapshot(log_path)
+            self._indexes[key] = index
+        elif index.synced:
+            # 补齐后的写入都经过add增量更新，消息数一致时无需再读磁盘
+            known_total = self._message_count(log_path)
+            if known_total is None or known_total == index.count:
+                return index
+
+        messages, total = self._read_range(log_path, index.count)
+        if total < index.count:
+            # 历史被清空或重建，索引作废
+            print(f"历史记录已变化，重建检索索引: {log_path}")
+            index = _FileIndex()
+            self._indexes[key] = index
+            messages, total = self._read_range(log_path, 0)
+        if messages:
+            started = time.time()
+            for record in messages:
+                index.add(record)
+            print(f"历史检索索引补齐 {len(messages)} 条，耗时 {time.time() - started:.2f} 秒: {log_path}")
+            if len(messages) >= SNAPSHOT_MIN_NEW:
+                self._save(log_path, index)
+        index.synced = True
+        return index
+
+    def add(self, log_path: str, record: Dict[str, Any]) -> None:
+        """
+        新消息写入后增量更新索引（仅更新已加载的索引，未加载的在检索时补齐）
+
+        Args:
+            log_path: 历史记录文件路径
+            record: 刚写入的消息记录
+        """
+        if not self.enabled:
+            return
+        index = self._indexes.get(os.path.abspath(log_path))
+        if index is not None:
+            index.add(record)
+
+    def drop(self, log_path: str) -> None:
+        """
+        删除文件的索引（历史被清空或删除时调用）
+
+        Args:
+            log_path: 历史记录文件路径
+        """
+        with history_segments.get_path_lock(log_path):
+            self._indexes.pop(os.path.abspath(log_path), None)
+            index_path = self.get_index_path(log_path)
+            if os.path.exists(index_path):
+                try:
+                    os.remove(index_path)
+                except OSError as e:
+                    print(f"删除历史检索索引失败 {index_path}: {e}")
+
+    def save_all(self) -> None:
+        """写回所有有未保存变更的索引（进程退出时调用）"""
+        for key, index in list(self._indexes.items()):
+            if index.unsaved:
+                with history_segments.get_path_lock(key):
+                    self._save(key, index)
+
+    def _build_snippet(self, text: str, terms: List[str]) -> str:
+        """截取第一个命中词附近的文本"""
+        lowered = text.lower()
+        positions = [pos for pos in (lowered.find(term) for term in terms) if pos >= 0]
+        if not positions:
+            return text[:self.snippet_chars * 2]
+        pos = min(positions)
+        start = max(0, pos - self.snippet_chars)
+        end = min(len(text), pos + self.snippet_chars)
+        return ("..." if start > 0 else "") + text[start:end] + ("..." if end < len(text) else "")
+
+    def search(self, log_path: str, query: str, page: int = 1, page_size: int = 20) -> Dict[str, Any]:
+        """
+        检索历史记录（所有关键词和短语都需命中，按BM25得分排序）
+
+        Args:
+            log_path: 历史记录文件路径
+            query: 查询语句，双引号包围的部分按短语匹配
+            page: 页码（从1开始）
+            page_size: 每页结果数量
+
+        Returns:
+            包含检索结果和分页信息的字典
+        """
+        started = time.time()
+        page = max(1, page)
+        page_size = max(1, min(page_size, self.max_page_size))
+
+        terms: List[str] = []
+        phrases: List[str] = []
+        for text, is_phrase in parse_query(query):
+            terms.extend(tokenize(text, for_query=True))
+            if is_phrase:
+                phrases.append(text.lower())
+        terms = list(dict.fromkeys(terms))
+
+        with history_segments.get_path_lock(log_path):
+            index = self._get_index(log_path)
+            total_docs = index.count
+            hits: List[Tuple[float, int]] = []
+            if terms and total_docs and all(term in index.postings for term in terms):
+                term_lists = [(index.postings[term], index.frequencies[term]) for term in terms]
+                # 从最短的倒排表开始，逐个在其余倒排表中二分查找求交集
+                term_lists.sort(key=lambda item: len(item[0]))
+                avg_length = index.total_length / total_docs or 1.0
+                idfs = [
+                    math.log(1 + (total_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for docs, _ in term_lists
+                ]
+                first_docs, first_tfs = term_lists[0]
+                for doc_id, first_tf in zip(first_docs, first_tfs):
+                    tf_values = [first_tf]
+                    for docs, tfs in term_lists[1:]:
+                        pos = bisect_left(docs, doc_id)
+                        if pos == len(docs) or docs[pos] != doc_id:
+                            break
+                        tf_values.append(tfs[pos])
+                    else:
+                        if phrases:
+                            lowered = index.texts[doc_id].lower()
+                            if not all(phrase in lowered for phrase in phrases):
+                                continue
+                        norm = BM25_K1 * (1 - BM25_B + BM25_B * index.lengths[doc_id] / avg_length)
+                        score = 0.0
+                        for tf, idf in zip(tf_values, idfs):
+                            score += idf * tf * (BM25_K1 + 1) / (tf + norm)
+                        hits.append((score, doc_id))
+
+            total_hits = len(hits)
+            # 得分相同时较新的消息优先
+            top = heapq.nlargest(page * page_size, hits)[(page - 1) * page_size:]
+            results = [
+                {
+                    "index": doc_id,
+                    "role": index.roles[doc_id],
+                    "timestamp": index.timestamps[doc_id],
+                    "content": index.texts[doc_id],
+                    "snippet": self._build_snippet(index.texts[doc_id], phrases + terms),
+                    "score": round(score, 4),
+                }
+                for score, doc_id in top
+            ]
+
+        total_pages = (total_hits + page_size - 1) // page_size if total_hits > 0 else 0
+        return {
+            "query": query,
+            "terms": terms,
+            "results": results,
+            "total_messages": total_docs,
+            "took_ms": round((time.time() - started) * 1000, 2),
+            "pagination": {
+                "current_page": page,
+                "page_size": page_size,
+                "total_results": total_hits,
+                "total_pages": total_pages,
+                "has_more": page < total_pages
+            }
+        }
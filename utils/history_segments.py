@@ -0,0 +1,319 @@
+"""
+历史记录分段工具模块
+负责历史记录日志的分段轮转、压缩归档和清单维护
+
+活跃分段始终保留在原路径（如 data/history/<id>_history.log），
+轮转出的旧分段压缩后存放在同名的 .segments 目录中：
+
+    <id>_history.log
+    <id>_history.log.segments/
+        manifest.json
+        000001.jsonl.gz
+        000002.jsonl.gz
+"""
+import os
+import json
+import gzip
+import shutil
+import threading
+from datetime import datetime
+from typing import Dict, Any, List, Iterator, Optional, Callable
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MANIFEST_NAME = "manifest.json"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# 清单缓存与每个日志文件的锁
+_manifest_cache: Dict[str, Dict[str, Any]] = {}
+_path_locks: Dict[str, threading.RLock] = {}
+_locks_guard = threading.Lock()
+
+
+def get_path_lock(log_path: str) -> threading.RLock:
+    """
+    获取日志文件对应的锁（同一路径在进程内共享同一把锁）
+
+    Args:
+        log_path: 活跃分段路径
+
+    Returns:
+        可重入锁
+    """
+    key = os.path.abspath(log_path)
+    with _locks_guard:
+        lock = _path_locks.get(key)
+        if lock is None:
+            lock = threading.RLock()
+            _path_locks[key] = lock
+        return lock
+
+
+def get_segments_dir(log_path: str) -> str:
+    """获取归档分段目录路径"""
+    return f"{log_path}.segments"
+
+
+def _empty_manifest() -> Dict[str, Any]:
+    return {"version": 1, "active_since": None, "segments": []}
+
+
+def load_manifest(log_path: str) -> Dict[str, Any]:
+    """
+    加载分段清单（带内存缓存）
+
+    Args:
+        log_path: 活跃分段路径
+
+    Returns:
+        清单字典，包含 active_since 和 segments 列表
+    """
+    key = os.path.abspath(log_path)
+    cached = _manifest_cache.get(key)
+    if cached is not None:
+        return cached
+
+    manifest_path = os.path.join(get_segments_dir(log_path), MANIFEST_NAME)
+    manifest = _empty_manifest()
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest.update(json.load(f))
+        except Exception as e:
+            print(f"加载历史分段清单失败: {e}")
+    _manifest_cache[key] = manifest
+    return manifest
+
+
+def _save_manifest(log_path: str, manifest: Dict[str, Any]) -> None:
+    """原子地写入分段清单"""
+    segments_dir = get_segments_dir(log_path)
+    os.makedirs(segments_dir, exist_ok=True)
+    manifest_path = os.path.join(segments_dir, MANIFEST_NAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+    _manifest_cache[os.path.abspath(log_path)] = manifest
+
+
+def _open_segment_for_read(segment_path: str):
+    """按扩展名以文本模式打开压缩分段"""
+    if segment_path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"读取 {segment_path} 需要安装 zstandard")
+        import io
+        raw = open(segment_path, "rb")
+        reader = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+        return io.TextIOWrapper(reader, encoding="utf-8")
+    return gzip.open(segment_path, "rt", encoding="utf-8")
+
+
+def _write_segment(segment_path: str, data: bytes, compression: str) -> None:
+    """将数据压缩写入分段文件"""
+    tmp_path = segment_path + ".tmp"
+    if compression == "zstd":
+        with open(tmp_path, "wb") as f:
+            f.write(zstandard.ZstdCompressor(level=10).compress(data))
+    else:
+        with gzip.open(tmp_path, "wb", compresslevel=6) as f:
+            f.write(data)
+    os.replace(tmp_path, segment_path)
+
+
+def _read_first_timestamp(log_path: str) -> Optional[str]:
+    """读取活跃分段第一条消息的时间戳"""
+    try:
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    return json.loads(line).get("timestamp")
+    except Exception:
+        pass
+    return None
+
+
+def _should_rotate(log_path: str, manifest: Dict[str, Any], rotation_config: Dict[str, Any],
+                   size: Optional[int] = None) -> bool:
+    """判断活跃分段是否达到轮转条件（大小或时间），size为None时读取磁盘上的文件大小"""
+    if size is None:
+        try:
+            size = os.path.getsize(log_path)
+        except OSError:
+            return False
+    if size == 0:
+        return False
+
+    max_bytes = rotation_config.get("max_segment_bytes")
+    if max_bytes and size >= max_bytes:
+        return True
+
+    max_age_days = rotation_config.get("max_segment_age_days")
+    if max_age_days:
+        if not manifest.get("active_since"):
+            manifest["active_since"] = _read_first_timestamp(log_path)
+        active_since = manifest.get("active_since")
+        if active_since:
+            try:
+                started = datetime.strptime(active_since, TIMESTAMP_FORMAT)
+                if (datetime.now() - started).total_seconds() >= max_age_days * 86400:
+                    return True
+            except ValueError:
+                pass
+    return False
+
+
+def rotate(log_path: str, rotation_config: Dict[str, Any]) -> bool:
+    """
+    将活跃分段压缩归档并清空活跃分段
+
+    Args:
+        log_path: 活跃分段路径
+        rotation_config: 轮转配置
+
+    Returns:
+        是否完成了轮转
+    """
+    with get_path_lock(log_path):
+        if not os.path.exists(log_path) or os.path.getsize(log_path) == 0:
+            return False
+
+        compression = rotation_config.get("compression", "gzip")
+        if compression == "zstd" and zstandard is None:
+            print("未安装zstandard，历史分段改用gzip压缩")
+            compression = "gzip"
+        extension = ".jsonl.zst" if compression == "zstd" else ".jsonl.gz"
+
+        # 只归档有效的JSON行，保证清单中的行数与可读消息数一致
+        valid_lines: List[str] = []
+        first_timestamp = None
+        last_timestamp = None
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    message = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                valid_lines.append(line)
+                timestamp = message.get("timestamp")
+                if timestamp:
+                    first_timestamp = first_timestamp or timestamp
+                    last_timestamp = timestamp
+
+        manifest = load_manifest(log_path)
+        if valid_lines:
+            segment_index = len(manifest["segments"]) + 1
+            segment_file = f"{segment_index:06d}{extension}"
+            segments_dir = get_segments_dir(log_path)
+            os.makedirs(segments_dir, exist_ok=True)
+            data = ("\n".join(valid_lines) + "\n").encode("utf-8")
+            _write_segment(os.path.join(segments_dir, segment_file), data, compression)
+            manifest["segments"].append({
+                "file": segment_file,
+                "lines": len(valid_lines),
+                "bytes": len(data),
+                "first_timestamp": first_timestamp,
+                "last_timestamp": last_timestamp,
+            })
+        manifest["active_since"] = datetime.now().strftime(TIMESTAMP_FORMAT)
+        _save_manifest(log_path, manifest)
+
+        # 清空活跃分段
+        with open(log_path, "w", encoding="utf-8"):
+            pass
+        print(f"历史记录已轮转: {log_path} -> 第 {len(manifest['segments'])} 个分段")
+        return True
+
+
+def maybe_rotate(log_path: str, rotation_config: Optional[Dict[str, Any]],
+                 before_rotate: Optional[Callable[[], None]] = None,
+                 size_hint: Optional[int] = None) -> bool:
+    """
+    在追加写入后检查并按需轮转
+
+    Args:
+        log_path: 活跃分段路径
+        rotation_config: 轮转配置，为None或未启用时不做任何处理
+        before_rotate: 轮转前的回调（如刷盘并关闭写入句柄）
+        size_hint: 活跃分段的当前大小（包含写入句柄中尚未刷盘的记录），为None时读取磁盘上的文件大小
+
+    Returns:
+        是否发生了轮转
+    """
+    if not rotation_config or not rotation_config.get("enabled", False):
+        return False
+    with get_path_lock(log_path):
+        manifest = load_manifest(log_path)
+        if not _should_rotate(log_path, manifest, rotation_config, size_hint):
+            return False
+        try:
+            if before_rotate is not None:
+                before_rotate()
+            return rotate(log_path, rotation_config)
+        except Exception as e:
+            print(f"历史记录轮转失败: {e}")
+            return False
+
+
+def list_segments(log_path: str) -> List[Dict[str, Any]]:
+    """获取归档分段列表（按时间从旧到新）"""
+    return list(load_manifest(log_path)["segments"])
+
+
+def archived_message_count(log_path: str) -> int:
+    """获取所有归档分段中的消息总数"""
+    return sum(segment.get("lines", 0) for segment in load_manifest(log_path)["segments"])
+
+
+def read_segment_messages(log_path: str, segment: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    读取单个归档分段中的全部消息
+
+    Args:
+        log_path: 活跃分段路径
+        segment: 清单中的分段条目
+
+    Returns:
+        消息列表，按时间从旧到新排序
+    """
+    segment_path = os.path.join(get_segments_dir(log_path), segment["file"])
+    messages = []
+    try:
+        with _open_segment_for_read(segment_path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        messages.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+    except Exception as e:
+        print(f"读取历史分段失败 {segment_path}: {e}")
+    return messages
+
+
+def iter_archived_messages(log_path: str) -> Iterator[Dict[str, Any]]:
+    """按时间从旧到新遍历所有归档分段中的消息"""
+    for segment in list_segments(log_path):
+        yield from read_segment_messages(log_path, segment)
+
+
+def remove_segments(log_path: str) -> None:
+    """
+    删除日志文件的所有归档分段和清单
+
+    Args:
+        log_path: 活跃分段路径
+    """
+    with get_path_lock(log_path):
+        segments_dir = get_segments_dir(log_path)
+        if os.path.isdir(segments_dir):
+            shutil.rmtree(segments_dir, ignore_errors=True)
+        _manifest_cache.pop(os.path.abspath(log_path), None)
@@ -7,25 +7,107 @@ import json
 import time
 import collections
 import re
+import threading
 from datetime import datetime
-from typing import List, Dict, Any, Optional, Deque
+from typing import List, Dict, Any, Optional, Deque, Iterator, Tuple
 from pathlib import Path
 from config import get_app_config
+from utils import history_segments
+from utils.history_writer import get_history_writer
+from utils.history_search import HistorySearchIndex
+from utils.page_cache import page_cache
+from utils.sqlite_store import get_sqlite_store, history_key
+from utils.text_utils import format_message_content_for_display, parse_assistant_message, get_parsed_message
+
+
+def iter_lines_reversed(file_path: str, block_size: int = 8192):
+    """
+    从文件末尾开始逐行倒序读取（用于只需要尾部数据的场景）
+    
+    Args:
+        file_path: 文件路径
+        block_size: 每次向前读取的字节数
+        
+    Yields:
+        去除首尾空白后的非空行，按从新到旧的顺序
+    """
+    with open(file_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b""
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            block = f.read(read_size) + remainder
+            lines = block.split(b"\n")
+            # 第一段可能是不完整的行，留到下一轮拼接
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                line = line.strip()
+                if line:
+                    yield line.decode("utf-8", errors="replace")
+        remainder = remainder.strip()
+        if remainder:
+            yield remainder.decode("utf-8", errors="replace")
+
+
+def _normalize_range(start: int, end: Optional[int], total: int) -> Tuple[int, int]:
+    """将可能为负数或None的[start, end)下标换算为[0, total]内的绝对下标"""
+    if start < 0:
+        start = max(0, total + start)
+    if end is None:
+        end = total
+    elif end < 0:
+        end = max(0, total + end)
+    return start, min(end, total)
+
+
+class _CachedHistory:
+    """单个历史记录文件的内存环形缓冲（与追加写入保持一致）"""
+    
+    def __init__(self, messages: List[Dict[str, Any]], max_size: int, total: int):
+        """
+        Args:
+            messages: 最近的消息，按时间从旧到新排序
+            max_size: 缓冲的最大消息数量
+            total: 文件（含归档分段）中的消息总数
+        """
+        self.messages: Deque[Dict[str, Any]] = collections.deque(messages, maxlen=max_size)
+        self.total = total
+    
+    @property
+    def complete(self) -> bool:
+        """缓冲是否包含了全部历史记录"""
+        return len(self.messages) >= self.total
+
 
 class HistoryManager:
     """历史记录管理器"""
     
-    def __init__(self, history_dir: str):
+    def __init__(self, history_dir: str, time_tracker=None):
         """
         初始化历史记录管理器
         
         Args:
             history_dir: 历史记录存储目录
+            time_tracker: 可选的时间跟踪器，写入消息时同步更新其最后消息时间
         """
         self.history_dir = history_dir
         self._ensure_history_dir()
-        # 缓存各角色的历史记录
-        self.history_cache: Dict[str, Deque[Dict[str, Any]]] = {}
+        # 历史记录缓存，按文件绝对路径索引（角色和故事共用）
+        self.history_cache: Dict[str, _CachedHistory] = {}
+        self.time_tracker = time_tracker
+        # 历史记录分段轮转配置
+        self.rotation_config = get_app_config().get("history_rotation")
+        # 共享的追加写入器（句柄常开，按持久化策略刷盘）
+        self.writer = get_history_writer()
+        # 全文检索倒排索引（写入时增量更新）
+        self.search_index = HistorySearchIndex(
+            lambda file_path, start: self._read_range(file_path, start),
+            self._cached_total,
+            get_app_config().get("history_search")
+        )
     
     def _ensure_history_dir(self):
         """确保历史记录目录存在"""
@@ -43,49 +125,268 @@ class HistoryManager:
         """
         return os.path.join(self.history_dir, f"{character_id}_history.log")
     
-    def _initialize_cache(self, character_id: str, max_size: int) -> None:
+    def _read_active_messages(self, file_path: str) -> List[Dict[str, Any]]:
         """
-        初始化角色历史记录缓存
+        读取活跃分段中的全部消息
         
         Args:
-            character_id: 角色ID
-            max_size: 缓存的最大消息数量
-        """
-        if character_id in self.history_cache:
-            return
+            file_path: 历史记录文件路径
             
-        # 获取历史记录文件路径
-        history_file = self._get_character_history_file(character_id)
+        Returns:
+            消息列表，按时间从旧到新排序
+        """
+        if not os.path.exists(file_path):
+            return []
         
-        # 如果文件不存在，创建空缓存
-        if not os.path.exists(history_file):
-            self.history_cache[character_id] = collections.deque(maxlen=max_size)
-            return
+        # 先刷盘尚未写入的数据
+        self.writer.flush(file_path)
         
-        # 读取历史记录
         messages = []
-        try:
-            with open(history_file, "r", encoding="utf-8") as f:
-                for line in f:
-                    line = line.strip()
-                    if line:
-                        try:
-                            message = json.loads(line)
-                            # 保留完整消息记录
-                            messages.append(message)
-                        except json.JSONDecodeError:
-                            # 忽略无效的JSON行
-                            continue
-        except Exception as e:
-            print(f"加载历史记录失败: {e}")
-            messages = []
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        messages.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # 忽略无效的JSON行
+                        continue
+        return messages
+    
+    def _read_archived_tail(self, file_path: str, count: int) -> List[Dict[str, Any]]:
+        """
+        从最新的归档分段开始向前读取最近的count条消息
         
-        # 创建缓存，只保留最近的max_size条消息
-        self.history_cache[character_id] = collections.deque(
-            messages[-max_size:] if max_size > 0 and len(messages) > max_size else messages,
-            maxlen=max_size
-        )
-        print(f"已加载 {len(self.history_cache[character_id])} 条 {character_id} 的历史记录到内存")
+        Args:
+            file_path: 历史记录文件路径
+            count: 消息数量，小于等于0表示全部
+            
+        Returns:
+            消息列表，按时间从旧到新排序
+        """
+        messages = []
+        for segment in reversed(history_segments.list_segments(file_path)):
+            segment_messages = history_segments.read_segment_messages(file_path, segment)
+            if count > 0:
+                segment_messages = segment_messages[-(count - len(messages)):]
+            messages = segment_messages + messages
+            if 0 < count <= len(messages):
+                break
+        return messages
+    
+    def _read_tail(self, file_path: str, count: int) -> List[Dict[str, Any]]:
+        """
+        读取最近的count条消息，优先只读活跃分段，不足时再向前读取归档分段
+        
+        Args:
+            file_path: 历史记录文件路径
+            count: 消息数量，小于等于0表示全部
+            
+        Returns:
+            消息列表，按时间从旧到新排序
+        """
+        messages = []
+        if os.path.exists(file_path):
+            self.writer.flush(file_path)
+            for line in iter_lines_reversed(file_path):
+                try:
+                    messages.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+                if 0 < count <= len(messages):
+                    break
+        messages.reverse()
+        
+        if count > 0 and len(messages) >= count:
+            return messages
+        
+        # 活跃分段不够，从最新的归档分段开始向前补齐
+        older = self._read_archived_tail(file_path, count - len(messages) if count > 0 else 0)
+        return older + messages
+    
+    def _read_range(self, file_path: str, start: int, end: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        按全局下标读取[start, end)范围内的消息，只打开与范围重叠的归档分段
+        
+        Args:
+            file_path: 历史记录文件路径
+            start: 起始下标（负数表示从末尾倒数）
+            end: 结束下标（负数表示从末尾倒数，None表示到末尾）
+            
+        Returns:
+            (消息列表, 消息总数)
+        """
+        active_messages = self._read_active_messages(file_path)
+        archived_count = history_segments.archived_message_count(file_path)
+        total = archived_count + len(active_messages)
+        
+        start, end = _normalize_range(start, end, total)
+        if start >= end:
+            return [], total
+        
+        result = []
+        if start < archived_count:
+            offset = 0
+            for segment in history_segments.list_segments(file_path):
+                lines = segment.get("lines", 0)
+                seg_start, seg_end = offset, offset + lines
+                offset = seg_end
+                if seg_end <= start or seg_start >= end:
+                    continue
+                segment_messages = history_segments.read_segment_messages(file_path, segment)
+                result.extend(segment_messages[max(0, start - seg_start):end - seg_start])
+        if end > archived_count:
+            result.extend(active_messages[max(0, start - archived_count):end - archived_count])
+        return result, total
+    
+    def _empty_page(self, page_size: int) -> Dict[str, Any]:
+        """构建空的分页结果"""
+        return {
+            "messages": [],
+            "pagination": {
+                "current_page": 1,
+                "page_size": page_size,
+                "total_messages": 0,
+                "total_pages": 0,
+                "has_more": False
+            }
+        }
+    
+    def _build_page(self, file_path: str, page: int, page_size: int) -> Dict[str, Any]:
+        """
+        构建分页结果（页码从最新的消息开始计算）
+        
+        Args:
+            file_path: 历史记录文件路径
+            page: 页码（从1开始）
+            page_size: 每页消息数量
+            
+        Returns:
+            包含历史记录和分页信息的字典
+        """
+        page_messages = None
+        entry = self.history_cache.get(self._cache_key(file_path))
+        if entry is not None:
+            with history_segments.get_path_lock(file_path):
+                cached_messages = list(entry.messages)
+                total_messages = entry.total
+            # 请求的页完全落在内存缓冲内时直接切片
+            if page * page_size <= len(cached_messages) or len(cached_messages) >= total_messages:
+                offset = total_messages - len(cached_messages)
+                start_index = max(0, total_messages - page * page_size) - offset
+                end_index = max(0, total_messages - (page - 1) * page_size) - offset
+                page_messages = cached_messages[max(0, start_index):max(0, end_index)]
+        
+        if page_messages is None:
+            # 总数由分段清单和活跃分段得到，靠前的页通常只需要读取活跃分段
+            page_messages, total_messages = self._read_range(
+                file_path, -page * page_size, -(page - 1) * page_size if page > 1 else None
+            )
+        
+        total_pages = (total_messages + page_size - 1) // page_size if total_messages > 0 else 1
+        
+        # 转换为API需要的格式
+        api_messages = []
+        for message in page_messages:
+            # 格式化消息内容（助手消息使用保存时预解析的分句结果）
+            if message["role"] == "assistant":
+                sentences = get_parsed_message(message)["sentences"]
+            else:
+                sentences = format_message_content_for_display(message["content"], message["role"])
+            
+            api_messages.append({
+                "role": message["role"],
+                "content": message["content"],  # 保留原始内容
+                "sentences": sentences,  # 添加分割后的句子
+                "timestamp": message.get("timestamp", "")
+            })
+        
+        return {
+            "messages": api_messages,
+            "pagination": {
+                "current_page": page,
+                "page_size": page_size,
+                "total_messages": total_messages,
+                "total_pages": total_pages,
+                "has_more": page < total_pages
+            }
+        }
+    
+    def _cache_key(self, file_path: str) -> str:
+        """获取缓存键（文件绝对路径）"""
+        return os.path.abspath(file_path)
+    
+    def _get_cache(self, file_path: str, max_size: int) -> _CachedHistory:
+        """
+        获取历史记录文件的内存缓冲，不存在或容量不足时从文件加载
+        
+        Args:
+            file_path: 历史记录文件路径
+            max_size: 缓冲的最大消息数量
+            
+        Returns:
+            内存缓冲
+        """
+        key = self._cache_key(file_path)
+        with history_segments.get_path_lock(file_path):
+            entry = self.history_cache.get(key)
+            if entry is not None:
+                if entry.messages.maxlen >= max_size:
+                    return entry
+                if entry.complete:
+                    # 已包含全部历史，只需扩大容量
+                    entry.messages = collections.deque(entry.messages, maxlen=max_size)
+                    return entry
+            
+            try:
+                messages, total = self._load_tail_with_total(file_path, max_size)
+            except Exception as e:
+                print(f"加载历史记录失败: {e}")
+                messages, total = [], 0
+            
+            # 旧记录没有预解析字段，加载进缓冲时回填一次
+            for message in messages:
+                if message.get("role") not in ("user", "system") and "parsed" not in message:
+                    get_parsed_message(message)
+            
+            entry = _CachedHistory(messages, max_size, total)
+            self.history_cache[key] = entry
+            print(f"已加载 {len(entry.messages)} 条历史记录到内存: {file_path}")
+            return entry
+    
+    def _load_tail_with_total(self, file_path: str, count: int) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        读取最近的count条消息和消息总数（用于加载内存缓冲）
+        
+        Args:
+            file_path: 历史记录文件路径
+            count: 消息数量
+            
+        Returns:
+            (消息列表, 消息总数)
+        """
+        active_messages = self._read_active_messages(file_path)
+        archived_count = history_segments.archived_message_count(file_path)
+        messages = active_messages[-count:]
+        if len(messages) < count and archived_count:
+            messages = self._read_archived_tail(file_path, count - len(messages)) + messages
+        return messages, archived_count + len(active_messages)
+    
+    def _cached_total(self, file_path: str) -> Optional[int]:
+        """从内存缓冲获取消息总数，未缓冲时返回None"""
+        entry = self.history_cache.get(self._cache_key(file_path))
+        return entry.total if entry is not None else None
+    
+    def invalidate(self, file_path: str) -> None:
+        """
+        丢弃历史记录文件的内存缓冲（文件在管理器之外被修改或删除时调用）
+        
+        Args:
+            file_path: 历史记录文件路径
+        """
+        with history_segments.get_path_lock(file_path):
+            self.history_cache.pop(self._cache_key(file_path), None)
+        page_cache.invalidate(kind="last_sentence")
     
     def _clean_assistant_content(self, content: str) -> str:
         """
@@ -102,7 +403,76 @@ class HistoryManager:
         cleaned_content = re.sub(r'【[^】]*】', '', content)
         return cleaned_content
     
-    def save_message(self, character_id: str, role: str, content: str, is_multi_character: bool = False, speaker_character_id: str = None) -> None:
+    def _build_record(self, timestamp: str, role: str, content: str) -> Dict[str, Any]:
+        """
+        创建消息记录，角色回复附带预解析的表情、纯文本和分句结果
+        
+        Args:
+            timestamp: 时间戳
+            role: 消息角色（assistant或多角色模式下的角色ID）
+            content: 原始消息内容
+            
+        Returns:
+            消息记录
+        """
+        message_record = {
+            "timestamp": timestamp,
+            "role": role,
+            "content": content
+        }
+        if role not in ("user", "system"):
+            message_record["parsed"] = parse_assistant_message(content)
+        return message_record
+    
+    def _write_record(self, file_path: str, message_record: Dict[str, Any]) -> None:
+        """
+        将消息记录写入存储（追加到活跃分段并按需轮转），调用方需持有该文件的锁
+        
+        Args:
+            file_path: 历史记录文件路径
+            message_record: 消息记录
+        """
+        self.writer.write(file_path, json.dumps(message_record, ensure_ascii=False) + "\n")
+        history_segments.maybe_rotate(
+            file_path, self.rotation_config,
+            before_rotate=lambda: self.writer.close(file_path),
+            size_hint=self.writer.size(file_path)
+        )
+    
+    def _clear_storage(self, file_path: str) -> None:
+        """
+        清空存储中的历史记录（活跃分段和归档分段），调用方需持有该文件的锁
+        
+        Args:
+            file_path: 历史记录文件路径
+        """
+        self.writer.close(file_path)
+        history_segments.remove_segments(file_path)
+        if os.path.exists(file_path):
+            with open(file_path, "w", encoding="utf-8"):
+                pass
+    
+    def _append_record(self, file_path: str, message_record: Dict[str, Any]) -> None:
+        """
+        追加一条消息记录，并同步更新内存缓冲和检索索引
+        
+        Args:
+            file_path: 历史记录文件路径
+            message_record: 消息记录
+        """
+        with history_segments.get_path_lock(file_path):
+            self._write_record(file_path, message_record)
+            
+            # 更新内存缓冲
+            entry = self.history_cache.get(self._cache_key(file_path))
+            if entry is not None:
+                entry.messages.append(message_record)
+                entry.total += 1
+            
+            # 更新检索索引
+            self.search_index.add(file_path, message_record)
+    
+    def save_message(self, character_id: str, role: str, content: str, is_multi_character: bool = False, speaker_character_id: str = None) -> Dict[str, Any]:
         """
         保存消息到历史记录
         
@@ -112,6 +482,9 @@ class HistoryManager:
             content: 消息内容
             is_multi_character: 是否为多角色模式
             speaker_character_id: 说话角色的ID（多角色模式下使用）
+            
+        Returns:
+            写入的消息记录（含预解析字段）
         """
         # 获取当前时间戳
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -125,24 +498,24 @@ class HistoryManager:
             actual_role = role
         
         # 创建消息记录
-        message_record = {
-            "timestamp": timestamp,
-            "role": actual_role,
-            "content": content
-        }
+        message_record = self._build_record(timestamp, actual_role, content)
         
         # 获取历史记录文件路径
         history_file = self._get_character_history_file(character_id)
         
-        # 写入历史记录文件
-        with open(history_file, "a", encoding="utf-8") as f:
-            f.write(json.dumps(message_record, ensure_ascii=False) + "\n")
+        # 写入历史记录文件（同时更新内存缓冲）
+        self._append_record(history_file, message_record)
+        
+        # 更新最后消息时间
+        if self.time_tracker is not None:
+            self.time_tracker.record_message(character_id, actual_role, timestamp)
         
-        # 更新内存缓存
-        if character_id in self.history_cache:
-            self.history_cache[character_id].append(message_record)
+        # 页面上显示的最后一句回复已变化
+        page_cache.invalidate(character_id, kind="last_sentence")
+        
+        return message_record
     
-    def save_message_to_file(self, file_path: str, role: str, content: str, is_multi_character: bool = False, speaker_character_id: str = None) -> None:
+    def save_message_to_file(self, file_path: str, role: str, content: str, is_multi_character: bool = False, speaker_character_id: str = None) -> Dict[str, Any]:
         """
         保存消息到指定文件
         
@@ -152,6 +525,9 @@ class HistoryManager:
             content: 消息内容
             is_multi_character: 是否为多角色模式
             speaker_character_id: 说话角色的ID（多角色模式下使用）
+            
+        Returns:
+            写入的消息记录（含预解析字段）
         """
         # 确保目录存在
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
@@ -168,15 +544,11 @@ class HistoryManager:
             actual_role = role
         
         # 创建消息记录
-        message_record = {
-            "timestamp": timestamp,
-            "role": actual_role,
-            "content": content
-        }
+        message_record = self._build_record(timestamp, actual_role, content)
         
         # 写入历史记录文件
-        with open(file_path, "a", encoding="utf-8") as f:
-            f.write(json.dumps(message_record, ensure_ascii=False) + "\n")
+        self._append_record(file_path, message_record)
+        return message_record
     
     def load_history_from_file(self, file_path: str, count: int = 10, max_cache_size: int = 100) -> List[Dict[str, Any]]:
         """
@@ -190,28 +562,16 @@ class HistoryManager:
         Returns:
             历史记录列表，按时间从旧到新排序
         """
-        # 如果文件不存在，返回空列表
-        if not os.path.exists(file_path):
-            return []
-        
-        # 读取历史记录
-        messages = []
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                for line in f:
-                    line = line.strip()
-                    if line:
-                        try:
-                            message = json.loads(line)
-                            messages.append(message)
-                        except json.JSONDecodeError:
-                            continue
+            if count <= 0:
+                return self._read_tail(file_path, 0)
+            entry = self._get_cache(file_path, max(max_cache_size, count))
+            with history_segments.get_path_lock(file_path):
+                messages = list(entry.messages)[-count:]
+            return [dict(message) for message in messages]
         except Exception as e:
             print(f"加载历史记录失败: {e}")
             return []
-        
-        # 返回最近的count条消息
-        return messages[-count:] if count > 0 and len(messages) > count else messages
     
     def load_history_paginated(self, character_id: str, page: int = 1, page_size: int = 20, max_cache_size: int = 200) -> Dict[str, Any]:
         """
@@ -226,76 +586,13 @@ class HistoryManager:
         Returns:
             包含历史记录和分页信息的字典
         """
-        # 确保缓存已初始化
-        if character_id not in self.history_cache:
-            self._initialize_cache(character_id, max_cache_size)
-        
-        # 从缓存中获取所有历史记录
-        all_messages = list(self.history_cache[character_id])
-        total_messages = len(all_messages)
-        
-        # 如果缓存中的消息不够，从文件中加载更多
-        if total_messages < page * page_size:
-            # 从文件中加载更多历史记录
-            history_file = self._get_character_history_file(character_id)
-            if os.path.exists(history_file):
-                try:
-                    with open(history_file, "r", encoding="utf-8") as f:
-                        file_messages = []
-                        for line in f:
-                            line = line.strip()
-                            if line:
-                                try:
-                                    message = json.loads(line)
-                                    file_messages.append(message)
-                                except json.JSONDecodeError:
-                                    continue
-                    
-                    # 更新缓存（保留最新的max_cache_size条消息）
-                    if len(file_messages) > max_cache_size:
-                        file_messages = file_messages[-max_cache_size:]
-                    
-                    self.history_cache[character_id] = collections.deque(file_messages, maxlen=max_cache_size)
-                    all_messages = list(self.history_cache[character_id])
-                    total_messages = len(all_messages)
-                    
-                except Exception as e:
-                    print(f"从文件加载历史记录失败: {e}")
-        
-        # 计算分页
-        total_pages = (total_messages + page_size - 1) // page_size if total_messages > 0 else 1
-        start_index = max(0, total_messages - page * page_size)
-        end_index = max(0, total_messages - (page - 1) * page_size)
-        
-        # 获取当前页的消息（从后往前取）
-        page_messages = all_messages[start_index:end_index]
-        
-        # 转换为API需要的格式
-        api_messages = []
-        for message in page_messages:
-            # 导入文本处理工具
-            from utils.text_utils import format_message_content_for_display
-            
-            # 格式化消息内容
-            sentences = format_message_content_for_display(message["content"], message["role"])
-            
-            api_messages.append({
-                "role": message["role"],
-                "content": message["content"],  # 保留原始内容
-                "sentences": sentences,  # 添加分割后的句子
-                "timestamp": message.get("timestamp", "")
-            })
-        
-        return {
-            "messages": api_messages,
-            "pagination": {
-                "current_page": page,
-                "page_size": page_size,
-                "total_messages": total_messages,
-                "total_pages": total_pages,
-                "has_more": page < total_pages
-            }
-        }
+        history_file = self._get_character_history_file(character_id)
+        try:
+            self._get_cache(history_file, max_cache_size)
+            return self._build_page(history_file, page, page_size)
+        except Exception as e:
+            print(f"从文件加载历史记录失败: {e}")
+            return self._empty_page(page_size)
     
     def load_history_from_file_paginated(self, file_path: str, page: int = 1, page_size: int = 20) -> Dict[str, Any]:
         """
@@ -309,80 +606,54 @@ class HistoryManager:
         Returns:
             包含历史记录和分页信息的字典
         """
-        # 如果文件不存在，返回空结果
-        if not os.path.exists(file_path):
-            return {
-                "messages": [],
-                "pagination": {
-                    "current_page": 1,
-                    "page_size": page_size,
-                    "total_messages": 0,
-                    "total_pages": 0,
-                    "has_more": False
-                }
-            }
-        
-        # 读取所有历史记录
-        all_messages = []
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                for line in f:
-                    line = line.strip()
-                    if line:
-                        try:
-                            message = json.loads(line)
-                            all_messages.append(message)
-                        except json.JSONDecodeError:
-                            continue
+            return self._build_page(file_path, page, page_size)
         except Exception as e:
             print(f"加载历史记录失败: {e}")
-            return {
-                "messages": [],
-                "pagination": {
-                    "current_page": 1,
-                    "page_size": page_size,
-                    "total_messages": 0,
-                    "total_pages": 0,
-                    "has_more": False
-                }
-            }
-        
-        total_messages = len(all_messages)
-        total_pages = (total_messages + page_size - 1) // page_size if total_messages > 0 else 1
-        
-        # 计算当前页的消息范围（从后往前取）
-        start_index = max(0, total_messages - page * page_size)
-        end_index = max(0, total_messages - (page - 1) * page_size)
-        
-        # 获取当前页的消息
-        page_messages = all_messages[start_index:end_index]
+            return self._empty_page(page_size)
+    
+    def search_history(self, character_id: str, query: str, page: int = 1, page_size: int = 20) -> Dict[str, Any]:
+        """
+        全文检索角色的历史记录
         
-        # 转换为API需要的格式
-        api_messages = []
-        for message in page_messages:
-            # 导入文本处理工具
-            from utils.text_utils import format_message_content_for_display
+        Args:
+            character_id: 角色ID
+            query: 查询语句，双引号包围的部分按短语匹配
+            page: 页码（从1开始）
+            page_size: 每页结果数量
             
-            # 格式化消息内容
-            sentences = format_message_content_for_display(message["content"], message["role"])
+        Returns:
+            包含检索结果和分页信息的字典
+        """
+        return self.search_history_file(self._get_character_history_file(character_id), query, page, page_size)
+    
+    def search_history_file(self, file_path: str, query: str, page: int = 1, page_size: int = 20) -> Dict[str, Any]:
+        """
+        全文检索指定历史记录文件
+        
+        Args:
+            file_path: 历史记录文件路径
+            query: 查询语句，双引号包围的部分按短语匹配
+            page: 页码（从1开始）
+            page_size: 每页结果数量
             
-            api_messages.append({
-                "role": message["role"],
-                "content": message["content"],  # 保留原始内容
-                "sentences": sentences,  # 添加分割后的句子
-                "timestamp": message.get("timestamp", "")
-            })
+        Returns:
+            包含检索结果和分页信息的字典
+        """
+        return self.search_index.search(file_path, query, page, page_size)
+    
+    def iter_all_messages(self, file_path: str) -> Iterator[Dict[str, Any]]:
+        """
+        按时间从旧到新遍历完整历史记录（包含所有归档分段，用于迁移到SQLite存储）
         
-        return {
-            "messages": api_messages,
-            "pagination": {
-                "current_page": page,
-                "page_size": page_size,
-                "total_messages": total_messages,
-                "total_pages": total_pages,
-                "has_more": page < total_pages
-            }
-        }
+        Args:
+            file_path: 历史记录文件路径
+            
+        Yields:
+            消息记录
+        """
+        yield from history_segments.iter_archived_messages(file_path)
+        yield from self._read_active_messages(file_path)
     
     def load_history(self, character_id: str, count: int = 10, max_cache_size: int = 100) -> List[Dict[str, Any]]:
         """
@@ -396,20 +667,22 @@ class HistoryManager:
         Returns:
             历史记录列表，按时间从旧到新排序
         """
-        # 确保缓存已初始化
-        if character_id not in self.history_cache:
-            self._initialize_cache(character_id, max_cache_size)
-        
-        # 从缓存中获取历史记录
-        messages = list(self.history_cache[character_id])
+        # 从内存缓冲中获取历史记录
+        history_file = self._get_character_history_file(character_id)
+        entry = self._get_cache(history_file, max(max_cache_size, count))
+        with history_segments.get_path_lock(history_file):
+            messages = list(entry.messages)
         
         # 转换为API需要的格式
         api_messages = []
         for message in messages[-count:] if count > 0 else messages:
-            api_messages.append({
+            api_message = {
                 "role": message["role"],
                 "content": message["content"]
-            })
+            }
+            if "parsed" in message:
+                api_message["parsed"] = message["parsed"]
+            api_messages.append(api_message)
         
         return api_messages
     
@@ -426,20 +699,96 @@ class HistoryManager:
         # 获取历史记录文件路径
         history_file = self._get_character_history_file(character_id)
         
-        # 如果文件不存在，返回True
-        if not os.path.exists(history_file):
-            return True
+        # 清空检索索引
+        self.search_index.drop(history_file)
         
-        # 清空文件
+        # 清空存储
         try:
-            with open(history_file, "w", encoding="utf-8") as f:
-                pass
+            with history_segments.get_path_lock(history_file):
+                self._clear_storage(history_file)
             
             # 清空缓存
-            if character_id in self.history_cache:
-                self.history_cache[character_id].clear()
+            entry = self.history_cache.get(self._cache_key(history_file))
+            if entry is not None:
+                entry.messages.clear()
+                entry.total = 0
+            
+            if self.time_tracker is not None:
+                self.time_tracker.forget(character_id)
+            
+            page_cache.invalidate(character_id, kind="last_sentence")
                 
             return True
         except Exception as e:
             print(f"清空历史记录失败: {e}")
-            return False
\ No newline at end of file
+            return False
+
+class SQLiteHistoryManager(HistoryManager):
+    """使用SQLite存储的历史记录管理器（内存缓冲、检索索引等逻辑与文件存储共用）"""
+    
+    def __init__(self, history_dir: str, store, time_tracker=None):
+        """
+        初始化历史记录管理器
+        
+        Args:
+            history_dir: 历史记录存储目录（仍用于生成日志键）
+            store: SQLiteStore实例
+            time_tracker: 可选的时间跟踪器
+        """
+        super().__init__(history_dir, time_tracker=time_tracker)
+        self.store = store
+    
+    def _read_active_messages(self, file_path: str) -> List[Dict[str, Any]]:
+        return self.store.history_range(history_key(file_path), 0)
+    
+    def _read_tail(self, file_path: str, count: int) -> List[Dict[str, Any]]:
+        return self.store.history_tail(history_key(file_path), count)
+    
+    def _read_range(self, file_path: str, start: int, end: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int]:
+        key = history_key(file_path)
+        total = self.store.history_count(key)
+        start, end = _normalize_range(start, end, total)
+        if start >= end:
+            return [], total
+        return self.store.history_range(key, start, end), total
+    
+    def _load_tail_with_total(self, file_path: str, count: int) -> Tuple[List[Dict[str, Any]], int]:
+        key = history_key(file_path)
+        return self.store.history_tail(key, count), self.store.history_count(key)
+    
+    def _write_record(self, file_path: str, message_record: Dict[str, Any]) -> None:
+        self.store.append_history(history_key(file_path), message_record)
+    
+    def _clear_storage(self, file_path: str) -> None:
+        self.store.clear_history(history_key(file_path))
+    
+    def iter_all_messages(self, file_path: str) -> Iterator[Dict[str, Any]]:
+        yield from self.store.iter_history(history_key(file_path))
+
+
+_shared_history_manager: Optional[HistoryManager] = None
+_shared_history_manager_lock = threading.Lock()
+
+
+def get_history_manager() -> HistoryManager:
+    """
+    获取进程内共享的历史记录管理器
+    
+    所有服务和路由共用同一个实例，保证角色、故事和多角色历史的内存缓冲与写入一致
+    
+    Returns:
+        历史记录管理器
+    """
+    global _shared_history_manager
+    if _shared_history_manager is None:
+        with _shared_history_manager_lock:
+            if _shared_history_manager is None:
+                # 延迟导入，避免与time_utils循环导入
+                from utils.time_utils import TimeTracker
+                history_dir = get_app_config()["history_dir"]
+                store = get_sqlite_store()
+                if store is not None:
+                    _shared_history_manager = SQLiteHistoryManager(history_dir, store, time_tracker=TimeTracker(history_dir))
+                else:
+                    _shared_history_manager = HistoryManager(history_dir, time_tracker=TimeTracker(history_dir))
+    return _shared_history_manager
@@ -0,0 +1,209 @@
+"""
+历史记录写入模块
+保持追加句柄常开、按文件串行化写入，并按可配置的持久化策略批量刷盘
+
+持久化策略（flush_policy）：
+    every_message  每条消息写入后立即flush
+    interval       后台线程每隔flush_interval_ms毫秒flush一次有未刷盘数据的文件
+    shutdown       只在关闭句柄或进程退出时flush
+fsync为True时，每次flush后额外调用os.fsync确保落盘
+"""
+import os
+import atexit
+import threading
+import collections
+from typing import Dict, Any, Optional, Set
+
+from utils import history_segments
+
+FLUSH_POLICIES = ("every_message", "interval", "shutdown")
+
+
+class HistoryWriter:
+    """历史记录追加写入器"""
+
+    def __init__(self, durability_config: Optional[Dict[str, Any]] = None):
+        """
+        初始化写入器
+
+        Args:
+            durability_config: 持久化配置，包含flush_policy、flush_interval_ms、fsync、max_open_files
+        """
+        durability_config = durability_config or {}
+        self.flush_policy = durability_config.get("flush_policy", "every_message")
+        if self.flush_policy not in FLUSH_POLICIES:
+            print(f"未知的历史记录刷盘策略 {self.flush_policy}，改用every_message")
+            self.flush_policy = "every_message"
+        self.flush_interval = max(1, durability_config.get("flush_interval_ms", 200)) / 1000.0
+        self.fsync = durability_config.get("fsync", False)
+        self.max_open_files = max(1, durability_config.get("max_open_files", 64))
+
+        # 按最近使用排序的打开句柄，超过上限时关闭最久未用的
+        self._handles: "collections.OrderedDict[str, Any]" = collections.OrderedDict()
+        self._dirty: Set[str] = set()
+        # 打开句柄的文件大小（字节，包含尚未刷盘的写入），供轮转判断使用而无需刷盘
+        self._sizes: Dict[str, int] = {}
+        self._handles_lock = threading.Lock()
+        self._closed = False
+
+        self._flusher = None
+        self._stop_event = threading.Event()
+        if self.flush_policy == "interval":
+            self._flusher = threading.Thread(target=self._flush_loop, name="HistoryWriterFlusher", daemon=True)
+            self._flusher.start()
+
+        atexit.register(self.close_all)
+
+    def _get_handle(self, file_path: str):
+        """获取（必要时打开）文件的追加句柄，调用方需持有该文件的锁"""
+        key = os.path.abspath(file_path)
+        with self._handles_lock:
+            handle = self._handles.get(key)
+            if handle is not None and not handle.closed:
+                self._handles.move_to_end(key)
+                return handle
+
+        handle = open(file_path, "a", encoding="utf-8")
+        with self._handles_lock:
+            self._handles[key] = handle
+            self._sizes[key] = os.path.getsize(file_path)
+            evicted = []
+            while len(self._handles) > self.max_open_files:
+                evicted.append(self._handles.popitem(last=False))
+        for evicted_key, evicted_handle in evicted:
+            # 被淘汰的句柄属于其他文件，需要持有其锁再关闭；
+            # 该文件正在被其他线程写入时放回，避免互相等待对方的锁
+            evicted_lock = history_segments.get_path_lock(evicted_key)
+            if evicted_lock.acquire(blocking=False):
+                try:
+                    self._close_handle(evicted_key, evicted_handle)
+                finally:
+                    evicted_lock.release()
+            else:
+                with self._handles_lock:
+                    self._handles[evicted_key] = evicted_handle
+                    self._handles.move_to_end(evicted_key, last=False)
+        return handle
+
+    def _sync(self, key: str, handle) -> None:
+        """flush并按配置fsync"""
+        handle.flush()
+        if self.fsync:
+            os.fsync(handle.fileno())
+        self._dirty.discard(key)
+
+    def _close_handle(self, key: str, handle) -> None:
+        self._sizes.pop(key, None)
+        try:
+            if not handle.closed:
+                self._sync(key, handle)
+                handle.close()
+        except Exception as e:
+            print(f"关闭历史记录文件失败 {key}: {e}")
+
+    def write(self, file_path: str, line: str) -> None:
+        """
+        追加一行到文件（同一文件的写入串行化）
+
+        Args:
+            file_path: 文件路径
+            line: 要写入的内容（应包含换行符）
+        """
+        key = os.path.abspath(file_path)
+        with history_segments.get_path_lock(file_path):
+            if self._closed:
+                # 进程退出后的写入直接走一次性句柄
+                with open(file_path, "a", encoding="utf-8") as f:
+                    f.write(line)
+                return
+            handle = self._get_handle(file_path)
+            handle.write(line)
+            self._sizes[key] = self._sizes.get(key, 0) + len(line.encode("utf-8"))
+            if self.flush_policy == "every_message":
+                self._sync(key, handle)
+            else:
+                self._dirty.add(key)
+
+    def size(self, file_path: str) -> Optional[int]:
+        """
+        获取文件当前大小（包含尚未刷盘的写入，不触发刷盘）
+
+        Args:
+            file_path: 文件路径
+
+        Returns:
+            字节数，文件没有打开的句柄时返回None
+        """
+        return self._sizes.get(os.path.abspath(file_path))
+
+    def flush(self, file_path: str) -> None:
+        """
+        刷盘指定文件（在从磁盘读取、轮转或清空前调用）
+
+        Args:
+            file_path: 文件路径
+        """
+        key = os.path.abspath(file_path)
+        if key not in self._dirty:
+            return
+        with history_segments.get_path_lock(file_path):
+            with self._handles_lock:
+                handle = self._handles.get(key)
+            if handle is not None and not handle.closed:
+                self._sync(key, handle)
+
+    def close(self, file_path: str) -> None:
+        """
+        刷盘并关闭指定文件的句柄（文件被截断或删除前调用）
+
+        Args:
+            file_path: 文件路径
+        """
+        key = os.path.abspath(file_path)
+        with history_segments.get_path_lock(file_path):
+            with self._handles_lock:
+                handle = self._handles.pop(key, None)
+            if handle is not None:
+                self._close_handle(key, handle)
+
+    def flush_all(self) -> None:
+        """刷盘所有有未写入数据的文件"""
+        for key in list(self._dirty):
+            self.flush(key)
+
+    def close_all(self) -> None:
+        """刷盘并关闭所有句柄（进程退出时调用）"""
+        self._stop_event.set()
+        with self._handles_lock:
+            keys = list(self._handles.keys())
+        for key in keys:
+            self.close(key)
+        self._closed = True
+
+    def _flush_loop(self) -> None:
+        """后台定时刷盘"""
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush_all()
+            except Exception as e:
+                print(f"历史记录定时刷盘失败: {e}")
+
+
+_shared_history_writer: Optional[HistoryWriter] = None
+_shared_history_writer_lock = threading.Lock()
+
+
+def get_history_writer() -> HistoryWriter:
+    """
+    获取进程内共享的历史记录写入器
+
+    Returns:
+        历史记录写入器
+    """
+    global _shared_history_writer
+    if _shared_history_writer is None:
+        with _shared_history_writer_lock:
+            if _shared_history_writer is None:
+                from config import get_app_config
+                _shared_history_writer = HistoryWriter(get_app_config().get("history_durability"))
+    return _shared_history_writer
@@ -0,0 +1,384 @@
+"""
+共享HTTP客户端
+导演/故事生成、语音合成、图像下载和精排API共用同一组连接池（每个线程一个requests.Session，挂载同一个HTTPAdapter）：
+
+    - 连接池：按主机复用keep-alive连接（pool_connections 个主机池，每个池最多 pool_maxsize 个连接）
+    - 重试：连接错误、超时和 429/5xx 响应按指数退避加随机抖动重试；响应带 Retry-After 时至少等待该时间，
+      超过 max_retry_after 时不再重试；其他 4xx 不重试
+    - 重试预算：统计窗口内的重试次数不超过请求数的 retry_budget_ratio（另有 retry_budget_min 次保底），
+      上游整体故障时不会因为重试把请求量放大数倍
+    - 熔断：按端点（主机+路径）统计连续失败，达到 breaker_failures 次后熔断，breaker_reset 秒内直接失败，
+      之后放行一次试探请求，成功则恢复
+
+统计信息（请求/重试/熔断次数和各主机连接池状态）见 get_http_client().get_stats()。
+"""
+import time
+import random
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Deque, Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import get_app_config
+
+# 可重试的响应状态码
+RETRYABLE_STATUS = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(requests.RequestException):
+    """端点已熔断，请求未发出"""
+
+
+class RetryBudget:
+    """滑动窗口内的重试预算"""
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 3, window: float = 10.0):
+        """
+        初始化重试预算
+
+        Args:
+            ratio: 重试次数与请求数的最大比例
+            min_retries: 窗口内无论请求数多少都允许的重试次数
+            window: 统计窗口（秒）
+        """
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._requests: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now: float) -> None:
+        for events in (self._requests, self._retries):
+            while events and now - events[0] > self.window:
+                events.popleft()
+
+    def record_request(self) -> None:
+        """记录一次请求（含重试）"""
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_retry(self) -> bool:
+        """
+        申请一次重试
+
+        Returns:
+            预算内返回True并计入重试次数，预算耗尽返回False
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            if len(self._retries) >= self.min_retries + self.ratio * len(self._requests):
+                return False
+            self._retries.append(now)
+            return True
+
+
+class CircuitBreaker:
+    """单个端点的熔断器（closed -> open -> half_open -> closed）"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        初始化熔断器
+
+        Args:
+            failure_threshold: 连续失败多少次后熔断
+            reset_timeout: 熔断后经过多少秒放行试探请求
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        判断是否放行请求
+
+        Returns:
+            是否放行（熔断期间返回False，半开状态只放行一个试探请求）
+        """
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """记录一次成功（恢复为closed）"""
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self) -> bool:
+        """
+        记录一次失败
+
+        Returns:
+            本次失败是否导致熔断
+        """
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    解析Retry-After响应头
+
+    Args:
+        value: 秒数或HTTP日期
+
+    Returns:
+        需要等待的秒数，无法解析时返回None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+class HttpClient:
+    """带连接池、退避重试、重试预算和熔断的HTTP客户端"""
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 16, max_retries: int = 2,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, max_retry_after: float = 30.0,
+                 retry_budget: Optional[RetryBudget] = None, breaker_failures: int = 5,
+                 breaker_reset: float = 30.0):
+        """
+        初始化HTTP客户端
+
+        Args:
+            pool_connections: 缓存的主机连接池数
+            pool_maxsize: 每个主机保持的最大连接数
+            max_retries: 默认的最多重试次数（不含首次请求）
+            backoff_base: 指数退避的基础等待时间（秒）
+            backoff_max: 单次退避的最长等待时间（秒）
+            max_retry_after: Retry-After超过该秒数时不再重试
+            retry_budget: 重试预算，为None时使用默认值
+            breaker_failures: 同一端点连续失败多少次后熔断
+            breaker_reset: 熔断后经过多少秒放行试探请求
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.retry_budget = retry_budget or RetryBudget()
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+
+        # 连接池（适配器）在所有线程间共享，Session按线程创建
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self._local = threading.local()
+
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "retries": 0, "failures": 0, "budget_exhausted": 0,
+                       "circuit_open": 0, "circuit_rejected": 0}
+
+    @classmethod
+    def from_config(cls) -> "HttpClient":
+        """按 APP_CONFIG["http_client"] 创建客户端"""
+        client_config = get_app_config().get("http_client") or {}
+        return cls(
+            pool_connections=int(client_config.get("pool_connections", 10)),
+            pool_maxsize=int(client_config.get("pool_maxsize", 16)),
+            max_retries=int(client_config.get("max_retries", 2)),
+            backoff_base=float(client_config.get("backoff_base", 0.5)),
+            backoff_max=float(client_config.get("backoff_max", 8.0)),
+            max_retry_after=float(client_config.get("max_retry_after", 30.0)),
+            retry_budget=RetryBudget(
+                ratio=float(client_config.get("retry_budget_ratio", 0.2)),
+                min_retries=int(client_config.get("retry_budget_min", 3)),
+                window=float(client_config.get("retry_budget_window", 10.0)),
+            ),
+            breaker_failures=int(client_config.get("breaker_failures", 5)),
+            breaker_reset=float(client_config.get("breaker_reset", 30.0)),
+        )
+
+    def _session(self) -> requests.Session:
+        # requests.Session不保证线程安全，每个线程使用自己的Session，挂载同一个适配器以共享连接池
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            self._local.session = session
+        return session
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def _breaker(self, endpoint: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                breaker = self._breakers[endpoint] = CircuitBreaker(self.breaker_failures, self.breaker_reset)
+            return breaker
+
+    def _backoff(self, attempt: int, retry_after: Optional[float], base: float) -> float:
+        delay = random.uniform(0, min(self.backoff_max, base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def request(self, method: str, url: str, retries: Optional[int] = None, backoff_base: Optional[float] = None,
+                endpoint: Optional[str] = None, timeout: Any = 30, **kwargs) -> requests.Response:
+        """
+        发送请求（失败时按退避策略重试）
+
+        Args:
+            method: HTTP方法
+            url: 请求地址
+            retries: 最多重试次数，为None时使用默认值
+            backoff_base: 指数退避的基础等待时间（秒），为None时使用默认值
+            endpoint: 熔断统计的端点名，为None时使用 主机+路径
+            timeout: 超时时间（秒）
+            **kwargs: 传给 requests.Session.request 的其他参数（headers、json、data、files、stream等）
+
+        Returns:
+            响应对象（重试用尽时返回最后一次可重试的错误响应，由调用方检查状态码）
+
+        Raises:
+            CircuitOpenError: 端点已熔断
+            requests.RequestException: 重试用尽后仍然连接失败或超时
+        """
+        if retries is None:
+            retries = self.max_retries
+        if backoff_base is None:
+            backoff_base = self.backoff_base
+        if endpoint is None:
+            parts = urlsplit(url)
+            endpoint = f"{parts.netloc}{parts.path}"
+
+        breaker = self._breaker(endpoint)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self._count("circuit_rejected")
+                raise CircuitOpenError(f"端点已熔断，{self.breaker_reset:.0f}秒内暂停请求: {endpoint}")
+
+            self._count("requests")
+            self.retry_budget.record_request()
+            response = None
+            retry_after = None
+            try:
+                response = self._session().request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error: Optional[Exception] = e
+            else:
+                if response.status_code not in RETRYABLE_STATUS:
+                    breaker.record_success()
+                    return response
+                error = None
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+
+            self._count("failures")
+            if breaker.record_failure():
+                self._count("circuit_open")
+                print(f"HTTP端点连续失败{breaker.failures}次，熔断{self.breaker_reset:.0f}秒: {endpoint}")
+
+            give_up = attempt >= retries or (retry_after is not None and retry_after > self.max_retry_after)
+            if not give_up and not self.retry_budget.try_retry():
+                self._count("budget_exhausted")
+                give_up = True
+            if give_up:
+                if error is not None:
+                    raise error
+                return response
+
+            delay = self._backoff(attempt, retry_after, backoff_base)
+            reason = f"HTTP {response.status_code}" if response is not None else type(error).__name__
+            print(f"HTTP请求失败({reason})，{delay:.2f}秒后第{attempt + 1}次重试: {endpoint}")
+            if response is not None:
+                response.close()
+            self._count("retries")
+            attempt += 1
+            time.sleep(delay)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """发送GET请求（参数同request）"""
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """发送POST请求（参数同request）"""
+        return self.request("POST", url, **kwargs)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取客户端统计
+
+        Returns:
+            请求/重试/失败/重试预算耗尽/熔断次数、非closed状态的端点和各主机连接池状态
+        """
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            breakers = list(self._breakers.items())
+        stats["breakers"] = {
+            endpoint: {"state": breaker.state, "failures": breaker.failures}
+            for endpoint, breaker in breakers if breaker.state != "closed"
+        }
+        stats["pools"] = self._pool_stats()
+        return stats
+
+    def _pool_stats(self) -> Dict[str, Dict[str, int]]:
+        pools = {}
+        try:
+            manager = self.adapter.poolmanager
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                pools[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                    "connections": pool.num_connections,
+                    "requests": pool.num_requests,
+                    "idle": pool.pool.qsize() if pool.pool is not None else 0,
+                }
+        except Exception as e:
+            print(f"获取连接池状态失败: {e}")
+        return pools
+
+
+_http_client: Optional[HttpClient] = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> HttpClient:
+    """
+    获取共享的HTTP客户端
+
+    Returns:
+        按配置创建的HTTP客户端
+    """
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = HttpClient.from_config()
+    return _http_client
@@ -1,11 +1,14 @@
 import json
 import os
+import re
 import logging
 from datetime import datetime
 import traceback
 import threading
 import concurrent.futures
-from .RAG import RAG
+from .RAG import RAG, MAX_BACKFILL_HITS
+from .text_utils import parse_assistant_message
+from .sqlite_store import get_sqlite_store
 import sys
 sys.path.append(r'utils\RAG')
 
@@ -13,6 +16,29 @@ class TimeoutError(Exception):
     """超时异常"""
     pass
 
+
+_NORMALIZE_RE = re.compile(r"[\W_]+")
+
+
+def normalize_memory_text(text: str) -> str:
+    """
+    归一化记忆文本（去除空白和标点、转小写），用于判断记忆是否与上下文中的消息相同
+
+    参数:
+        text: 文本
+
+    返回:
+        归一化后的文本
+    """
+    return _NORMALIZE_RE.sub("", text or "").lower()
+
+
+def _memory_doc_key(doc: str) -> str:
+    # 记忆文档格式为"说话者：内容"，只比较内容部分
+    head, sep, body = doc.partition("：")
+    return normalize_memory_text(body if sep and len(head) <= 32 else doc)
+
+
 class ChatHistoryVectorDB:
     def __init__(self, RAG_config: dict, model: str = None, character_name: str = "default", is_story: bool = False):
         """
@@ -49,21 +75,107 @@ class ChatHistoryVectorDB:
         os.makedirs(self.data_memory, exist_ok=True)    
         
         self.rag = RAG(RAG_config)
+        # 归一化文本 -> 文档ID列表（首次按文本排除时建立，之后随新增文档更新）
+        self._doc_key_index = None
+        # 加载代数：重新加载后递增，检索结果缓存据此判断记忆库是否已变化
+        self._generation = 0
+        
+    def _memory_owner(self) -> str:
+        """SQLite存储中记忆库的归属键"""
+        return f"story:{self.character_name}" if self.is_story else f"character:{self.character_name}"
+    
+    def index_version(self) -> tuple:
+        """
+        获取记忆库版本
         
-    def add_text(self, text: str):
+        返回:
+            (加载代数, 文档数)
+        """
+        return self._generation, len(self.rag.retriever.id_to_doc)
+    
+    def add_text(self, text: str) -> int:
         """
         添加单个文本到向量数据库
         
         参数:
             text: 要添加的文本
-            metadata: 可选的元数据字典
+            
+        返回:
+            新增文档的ID
         """
+        doc_id = len(self.rag.retriever.id_to_doc)
         self.rag.add(text)
+        if self._doc_key_index is not None:
+            self._doc_key_index.setdefault(_memory_doc_key(text), []).append(doc_id)
+        return doc_id
+    
+    def get_context_docs(self, context_messages: list) -> set:
+        """
+        获取已在当前上下文中的记忆文档（检索时排除）
+        
+        消息带有记忆文档ID时按ID定位，否则（如从历史文件加载的消息）按归一化文本匹配
+        
+        参数:
+            context_messages: 上下文中的消息列表，每项为 {"content": 纯文本, "memory_id": 记忆文档ID或None}
+            
+        返回:
+            记忆文档文本集合
+        """
+        id_to_doc = self.rag.retriever.id_to_doc
+        docs = set()
+        keys = set()
+        by_id = 0
+        for item in context_messages:
+            memory_id = item.get("memory_id")
+            if memory_id is not None and memory_id in id_to_doc:
+                docs.add(id_to_doc[memory_id])
+                by_id += 1
+                continue
+            key = normalize_memory_text(item.get("content"))
+            if key:
+                keys.add(key)
+        
+        by_text = 0
+        if keys:
+            if self._doc_key_index is None:
+                index = {}
+                for doc_id, doc in list(id_to_doc.items()):
+                    index.setdefault(_memory_doc_key(doc), []).append(doc_id)
+                self._doc_key_index = index
+            for key in keys:
+                for doc_id in self._doc_key_index.get(key, ()):
+                    docs.add(id_to_doc[doc_id])
+                    by_text += 1
+        
+        if docs:
+            self.logger.info(f"检索时排除上下文中已有的记忆: {len(docs)} 条（按ID {by_id} 条，按文本 {by_text} 条）")
+        return docs
     
-    def _perform_search(self, query: str, top_k: int = 5):
-        """执行实际的搜索操作"""
-        # 获取最相似的top_k个结果
-        top_indices = self.rag.req(query=query, top_k=top_k)
+    def _perform_search(self, query: str, top_k: int = 5, exclude_docs: set = None, cache=None):
+        """
+        执行实际的搜索操作（提供检索结果缓存时先查缓存）
+        
+        缓存保存的是未排除上下文文档的候选（多精排 MAX_BACKFILL_HITS 条作为余量），
+        每次请求按自己的排除集合过滤，余量不足以补满top_k时重新检索
+        """
+        exclude_docs = exclude_docs or set()
+        top_indices = None
+        if cache is not None:
+            version = self.index_version()
+            embedding = self.rag.embed_query(query)
+            candidates = cache.lookup(self._memory_owner(), version, query, embedding, top_k)
+            if candidates is not None:
+                top_indices = self._filter_candidates(candidates, exclude_docs, top_k)
+                if top_indices is not None:
+                    self.logger.info(f"记忆检索命中缓存: '{query}'")
+            else:
+                candidates = self.rag.req(query=query, top_k=top_k + MAX_BACKFILL_HITS, backfill=len(exclude_docs))
+                cache.store(self._memory_owner(), version, query, embedding, top_k, candidates)
+                top_indices = self._filter_candidates(candidates, exclude_docs, top_k)
+        
+        if top_indices is None:
+            # 获取最相似的top_k个结果
+            top_indices = self.rag.req(query=query, top_k=top_k, exclude_docs=exclude_docs)
         
         results = []
         for text in top_indices:
@@ -74,7 +186,25 @@ class ChatHistoryVectorDB:
         
         return results
     
-    def search(self, query: str, top_k: int = 5, timeout: int = 10):
+    @staticmethod
+    def _filter_candidates(candidates: list, exclude_docs: set, top_k: int):
+        """
+        从缓存的候选中排除上下文文档
+        
+        参数:
+            candidates: 未排除上下文文档的精排结果
+            exclude_docs: 本次请求要排除的文档
+            top_k: 需要的结果数
+            
+        返回:
+            前top_k条结果，排除后不足top_k条且候选之外可能还有文档时返回None
+        """
+        remaining = [text for text in candidates if text not in exclude_docs]
+        if len(remaining) < top_k and len(remaining) < len(candidates):
+            return None
+        return remaining[:top_k]
+    
+    def search(self, query: str, top_k: int = 5, timeout: int = 10, exclude_docs: set = None, cache=None):
         """
         搜索与查询文本最相似的文本（带超时，线程安全）
         
@@ -82,6 +212,8 @@ class ChatHistoryVectorDB:
             query: 查询文本
             top_k: 返回的最相似结果数量
             timeout: 超时时间（秒）
+            exclude_docs: 不参与精排的文档（如已在上下文中的对话），空出的名额由其他记忆补足
+            cache: 会话的检索结果缓存（见utils.retrieval_cache），为None时不使用缓存
             
         返回:
             包含相似结果和元数据的字典列表
@@ -95,7 +227,7 @@ class ChatHistoryVectorDB:
             # 使用 ThreadPoolExecutor 实现超时控制（线程安全）
             with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
                 # 提交搜索任务
-                future = executor.submit(self._perform_search, query, top_k)
+                future = executor.submit(self._perform_search, query, top_k, exclude_docs, cache)
                 
                 try:
                     # 等待结果，带超时
@@ -133,6 +265,14 @@ class ChatHistoryVectorDB:
         参数:
             file_path: 保存路径，如果为None则使用默认路径
         """
+        store = get_sqlite_store()
+        if store is not None and file_path is None:
+            # SQLite存储：只追加新增的记忆文本和向量
+            store.save_memory(self._memory_owner(), self.character_name, self.model,
+                              self.rag.save_to_file(self.data_memory))
+            self.logger.info(f"向量数据库已保存到SQLite: {self._memory_owner()}")
+            return
+        
         if file_path is None:
             file_path = self.data_memory
         rag_save = self.rag.save_to_file(file_path)
@@ -156,27 +296,38 @@ class ChatHistoryVectorDB:
             file_path: 加载路径，如果为None则使用默认路径
         """
         self.logger.info("加载向量数据库...")
-        if file_path is None:
-            file_path = os.path.join(self.data_memory, f"{self.character_name}_memory.json")
-        
-        if not os.path.exists(file_path):
-            self.logger.info(f"数据库文件不存在，将创建新的数据库: {file_path}")
-            return
+        data = None
+        store = get_sqlite_store()
+        if store is not None and file_path is None:
+            data = store.load_memory(self._memory_owner())
+            if data is None:
+                self.logger.info(f"SQLite中没有记忆数据，将创建新的数据库: {self._memory_owner()}")
+                return
+        else:
+            if file_path is None:
+                file_path = os.path.join(self.data_memory, f"{self.character_name}_memory.json")
+            
+            if not os.path.exists(file_path):
+                self.logger.info(f"数据库文件不存在，将创建新的数据库: {file_path}")
+                return
             
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            if data is None:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
                 
             self.character_name = data.get('character_name', self.character_name)
             self.model = data.get('model', self.model)
             self.logger.info(f"加载RAG缓存")
             self.rag.load_from_file(data.get('rag', None))
+            self._doc_key_index = None
+            self._generation += 1
             self.logger.info(f"向量数据库加载完成，角色: {self.character_name}")
         except Exception as e:
             self.logger.error(f"加载数据库失败: {e}")
             traceback.print_exc()
     
-    def add_chat_turn(self, user_message: str, assistant_message: str, timestamp: str = None):
+    def add_chat_turn(self, user_message: str, assistant_message: str, timestamp: str = None, assistant_content: str = None):
         """
         添加一轮对话到向量数据库（新格式：每条记录一个角色的话）
         
@@ -184,6 +335,10 @@ class ChatHistoryVectorDB:
             user_message: 用户消息
             assistant_message: 助手回复
             timestamp: 时间戳，如果为None则使用当前时间
+            assistant_content: 已解析的助手回复纯文本，提供时不再重复解析JSON
+            
+        返回:
+            [玩家消息的文档ID, 角色回复的文档ID]
         """
         if timestamp is None:
             timestamp = datetime.now().isoformat()
@@ -192,12 +347,8 @@ class ChatHistoryVectorDB:
         user_text = f"玩家：{user_message}"
         
         # 处理助手消息：如果是JSON格式，只取content部分
-        try:
-            import json
-            assistant_data = json.loads(assistant_message)
-            assistant_content = assistant_data.get('content', assistant_message)
-        except (json.JSONDecodeError, TypeError):
-            assistant_content = assistant_message
+        if assistant_content is None:
+            assistant_content = parse_assistant_message(assistant_message)["content"]
         
         # 获取角色名
         if self.is_story:
@@ -231,12 +382,12 @@ class ChatHistoryVectorDB:
         assistant_text = f"{character_name}：{assistant_content}"
         
         # 分别添加两条记录
-        self.add_text(user_text)
-        self.add_text(assistant_text)
+        doc_ids = [self.add_text(user_text), self.add_text(assistant_text)]
         
         self.logger.info(f"添加对话记录到向量数据库: 玩家={user_message[:30]}..., {character_name}={assistant_content[:30]}...")
+        return doc_ids
     
-    def add_single_message(self, speaker_name: str, message: str, timestamp: str = None):
+    def add_single_message(self, speaker_name: str, message: str, timestamp: str = None, content: str = None):
         """
         添加单条消息到向量数据库（用于多角色对话）
         
@@ -244,25 +395,26 @@ class ChatHistoryVectorDB:
             speaker_name: 说话者名称
             message: 消息内容
             timestamp: 时间戳，如果为None则使用当前时间
+            content: 已解析的消息纯文本，提供时不再重复解析JSON
+            
+        返回:
+            新增文档的ID
         """
         if timestamp is None:
             timestamp = datetime.now().isoformat()
         
         # 处理消息内容：如果是JSON格式，只取content部分
-        try:
-            import json
-            message_data = json.loads(message)
-            content = message_data.get('content', message)
-        except (json.JSONDecodeError, TypeError):
-            content = message
+        if content is None:
+            content = parse_assistant_message(message)["content"]
         
         # 格式化为记忆文本
         memory_text = f"{speaker_name}：{content}"
         
         # 添加到向量数据库
-        self.add_text(memory_text)
+        doc_id = self.add_text(memory_text)
         
         self.logger.info(f"添加单条消息到向量数据库: {speaker_name}={content[:30]}...")
+        return doc_id
     
     def initialize_database(self):
         """
@@ -271,7 +423,8 @@ class ChatHistoryVectorDB:
         self.load_from_file()
         self.logger.info(f"记忆数据库初始化完成，角色: {self.character_name}")
     
-    def get_relevant_memory(self, query: str, top_k: int = 5, timeout: int = 10, min_similarity: float = 0.3) -> str:
+    def get_relevant_memory(self, query: str, top_k: int = 5, timeout: int = 10, min_similarity: float = 0.3,
+                            context_messages: list = None, cache=None) -> str:
         """
         获取相关记忆并格式化为提示词
         
@@ -280,12 +433,15 @@ class ChatHistoryVectorDB:
             top_k: 返回的最相似结果数量
             timeout: 超时时间（秒）
             min_similarity: 最小相似度阈值
+            context_messages: 已在上下文中的消息（见get_context_docs），对应的记忆不再重复唤醒
+            cache: 会话的检索结果缓存
             
         返回:
             格式化的记忆提示词
         """
         try:
-            results = self.search(query, top_k, timeout)
+            exclude_docs = self.get_context_docs(context_messages) if context_messages else None
+            results = self.search(query, top_k, timeout, exclude_docs, cache)
             
             if not results:
                 return ""
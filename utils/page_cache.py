@@ -0,0 +1,97 @@
+"""
+页面渲染输入缓存
+/chat 页面每次打开都要读取场景文件（最后使用的背景）、遍历前端插件钩子、从历史记录中提取最后一句回复，
+这些输入只在历史记录或背景变化时才会改变。按 (输入类型, 角色ID) 缓存：
+
+    - 历史记录写入或清空：清除该角色的输入（最后一句回复）
+    - 背景切换：清除该角色的输入（背景地址）
+    - 其他进程的修改无法通知到本进程，缓存项超过 ttl 秒后重新计算
+"""
+import time
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config import get_app_config
+
+# (输入类型, 角色ID)
+PageKey = Tuple[str, Optional[str]]
+
+
+class PageInputCache:
+    """线程安全的页面渲染输入缓存"""
+
+    def __init__(self):
+        page_config = get_app_config().get("page_cache") or {}
+        self.enabled = bool(page_config.get("enabled", True))
+        self.ttl = float(page_config.get("ttl", 300))
+        self._lock = threading.Lock()
+        self._inputs: Dict[PageKey, Tuple[float, Any]] = {}
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, kind: str, builder: Callable[[], Any], character_id: Optional[str] = None) -> Any:
+        """
+        获取页面输入，未缓存或已过期时调用builder计算并缓存
+
+        Args:
+            kind: 输入类型（如 background_url、last_sentence、plugin_scripts）
+            builder: 计算输入的函数
+            character_id: 角色ID（与角色无关的输入为None）
+
+        Returns:
+            页面输入
+        """
+        if not self.enabled:
+            return builder()
+
+        key = (kind, character_id)
+        now = time.monotonic()
+        with self._lock:
+            item = self._inputs.get(key)
+            if item is not None and now - item[0] < self.ttl:
+                self._hits += 1
+                return item[1]
+            self._misses += 1
+
+        value = builder()
+        with self._lock:
+            self._inputs[key] = (now, value)
+        return value
+
+    def invalidate(self, character_id: Optional[str] = None, kind: Optional[str] = None) -> int:
+        """
+        清除缓存的页面输入
+
+        Args:
+            character_id: 只清除该角色的输入，为None时清除所有角色
+            kind: 只清除该类型的输入，为None时清除所有类型
+
+        Returns:
+            清除的条目数
+        """
+        with self._lock:
+            keys = [key for key in self._inputs
+                    if (character_id is None or key[1] == character_id) and (kind is None or key[0] == kind)]
+            for key in keys:
+                del self._inputs[key]
+        return len(keys)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取缓存统计
+
+        Returns:
+            缓存条目数、命中/未命中次数和命中率
+        """
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "entries": len(self._inputs),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 3) if total else 0.0,
+            }
+
+
+# 全局页面输入缓存实例
+page_cache = PageInputCache()
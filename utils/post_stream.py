@@ -0,0 +1,174 @@
+"""
+流式回复结束后的后续任务
+记忆写入、导演判断和选项生成互不依赖，在共享线程池中并发执行，哪个先完成就先把结果交给调用方发送给前端；
+每个任务有独立的超时时间，超时后不再等待（线程中的任务继续在后台执行完毕，结果被丢弃），不会让一个慢的接口拖住整个流。
+
+任务在提交时复制当前的contextvars上下文（submit_in_context），因此在线程中也能读取本次请求绑定的会话。
+"""
+import time
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from config import get_stream_config
+
+# (任务名, 可调用对象, 超时秒数)
+PostStreamTask = Tuple[str, Callable[[], Any], float]
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, Any]] = {}
+
+
+def get_post_stream_executor() -> ThreadPoolExecutor:
+    """
+    获取后续任务共享的线程池
+
+    Returns:
+        线程池（大小由 STREAM_CONFIG["post_task_workers"] 配置）
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                workers = max(1, int(get_stream_config().get("post_task_workers", 8)))
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="post-stream")
+    return _executor
+
+
+def submit_in_context(executor: ThreadPoolExecutor, func: Callable[[], Any]) -> Future:
+    """
+    在当前contextvars上下文的副本中提交任务
+
+    Args:
+        executor: 线程池
+        func: 可调用对象
+
+    Returns:
+        任务的Future
+    """
+    return executor.submit(contextvars.copy_context().run, func)
+
+
+def get_task_timeout(name: str, default: float = 10.0) -> float:
+    """
+    获取任务的超时时间
+
+    Args:
+        name: 任务名（memory/director/options）
+        default: 未配置时的超时秒数
+
+    Returns:
+        超时秒数
+    """
+    return float((get_stream_config().get("post_task_timeouts") or {}).get(name, default))
+
+
+def run_post_stream_tasks(tasks: List[PostStreamTask]) -> Iterator[Tuple[str, Any]]:
+    """
+    并发执行后续任务，按完成顺序产出结果（失败或超时的任务不产出）
+
+    Args:
+        tasks: (任务名, 可调用对象, 超时秒数) 列表
+
+    Yields:
+        (任务名, 返回值)
+    """
+    executor = get_post_stream_executor()
+    started = time.monotonic()
+    futures = {}
+    for name, func, timeout in tasks:
+        future = submit_in_context(executor, func)
+        futures[future] = (name, started + timeout)
+
+    pending = set(futures)
+    while pending:
+        deadline = min(futures[future][1] for future in pending)
+        done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        for future in done:
+            name = futures[future][0]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"后续任务失败({name}): {e}")
+                _record(name, "failed", started)
+                continue
+            _record(name, "completed", started)
+            yield name, result
+
+        now = time.monotonic()
+        for future in [future for future in pending if futures[future][1] <= now]:
+            name = futures[future][0]
+            print(f"后续任务超时({name})，不再等待")
+            _record(name, "timed_out", started)
+            pending.discard(future)
+
+
+async def run_post_stream_tasks_async(tasks: List[PostStreamTask]) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    run_post_stream_tasks 的异步版本：协程函数直接在事件循环上执行（超时时取消），普通函数在共享线程池中执行
+
+    Args:
+        tasks: (任务名, 可调用对象或协程函数, 超时秒数) 列表
+
+    Yields:
+        (任务名, 返回值)
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_post_stream_executor()
+    started = time.monotonic()
+
+    async def run(name: str, func: Callable[[], Any], timeout: float):
+        if asyncio.iscoroutinefunction(func):
+            awaitable = func()
+        else:
+            awaitable = loop.run_in_executor(executor, contextvars.copy_context().run, func)
+        try:
+            result = await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            print(f"后续任务超时({name})，不再等待")
+            _record(name, "timed_out", started)
+            return name, None, False
+        except Exception as e:
+            print(f"后续任务失败({name}): {e}")
+            _record(name, "failed", started)
+            return name, None, False
+        _record(name, "completed", started)
+        return name, result, True
+
+    for next_done in asyncio.as_completed([run(*task) for task in tasks]):
+        name, result, ok = await next_done
+        if ok:
+            yield name, result
+
+
+def get_post_stream_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    获取后续任务统计
+
+    Returns:
+        按任务名统计的完成/失败/超时次数和平均耗时（毫秒）
+    """
+    with _stats_lock:
+        stats = {}
+        for name, item in _stats.items():
+            finished = item["completed"] + item["failed"]
+            stats[name] = {
+                "completed": item["completed"],
+                "failed": item["failed"],
+                "timed_out": item["timed_out"],
+                "avg_ms": round(item["total_ms"] / finished, 1) if finished else 0.0,
+            }
+    return stats
+
+
+def _record(name: str, outcome: str, started: float) -> None:
+    elapsed_ms = (time.monotonic() - started) * 1000
+    with _stats_lock:
+        item = _stats.setdefault(name, {"completed": 0, "failed": 0, "timed_out": 0, "total_ms": 0.0})
+        item[outcome] += 1
+        if outcome != "timed_out":
+            item["total_ms"] += elapsed_ms
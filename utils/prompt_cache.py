@@ -0,0 +1,120 @@
+"""
+提示词片段缓存
+角色设定（含心情列表）、剧情引导和故事角色介绍在每轮对话中都相同，按 (片段类型, 角色, 故事, 章节, 偏移档位) 缓存拼接结果，
+每轮请求只计算记忆检索、角色详情和时间前缀等动态部分。
+
+失效时机：
+    - 角色重新加载、创建或删除：清除该角色的片段和所有剧情片段（剧情片段中包含其他角色的名字）
+    - 故事进度更新：键中包含章节索引和偏移档位，进度变化后自然使用新的键，无需清除
+    - 故事创建或删除：清除该故事的片段
+    - 配置保存：全部清除
+"""
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# 剧情引导的偏移阈值：<10 保持当前章节，10~30 暗示推进，>=30 制造突发事件
+OFFSET_THRESHOLDS = (10, 30)
+
+# (片段类型, 角色ID, 故事ID, 章节索引, 偏移档位)
+PromptKey = Tuple[str, Optional[str], Optional[str], Optional[int], Optional[int]]
+
+
+def offset_bucket(offset: int) -> int:
+    """
+    获取偏移值所在的档位（同一档位内剧情引导文本相同）
+
+    Args:
+        offset: 故事偏移值
+
+    Returns:
+        档位（0/1/2）
+    """
+    return sum(1 for threshold in OFFSET_THRESHOLDS if offset >= threshold)
+
+
+class PromptFragmentCache:
+    """线程安全的提示词片段缓存"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fragments: Dict[PromptKey, str] = {}
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, kind: str, builder: Callable[[], str], character_id: Optional[str] = None,
+            story_id: Optional[str] = None, chapter: Optional[int] = None,
+            bucket: Optional[int] = None) -> str:
+        """
+        获取提示词片段，未缓存时调用builder构建并缓存
+
+        Args:
+            kind: 片段类型
+            builder: 构建片段的函数
+            character_id: 角色ID
+            story_id: 故事ID
+            chapter: 章节索引
+            bucket: 偏移档位（见offset_bucket）
+
+        Returns:
+            提示词片段
+        """
+        key = (kind, character_id, story_id, chapter, bucket)
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._hits += 1
+                return fragment
+            self._misses += 1
+
+        # 在锁外构建（可能读取角色和故事文件），并发未命中时重复构建的结果相同
+        fragment = builder()
+        with self._lock:
+            self._fragments[key] = fragment
+        return fragment
+
+    def invalidate(self, character_id: Optional[str] = None, story_id: Optional[str] = None) -> int:
+        """
+        清除缓存的片段
+
+        Args:
+            character_id: 清除该角色的片段和所有剧情片段
+            story_id: 清除该故事的片段
+            （均为None时全部清除）
+
+        Returns:
+            清除的片段数
+        """
+        with self._lock:
+            if character_id is None and story_id is None:
+                count = len(self._fragments)
+                self._fragments.clear()
+                return count
+
+            stale = [
+                key for key in self._fragments
+                if (character_id is not None and (key[1] == character_id or key[2] is not None))
+                or (story_id is not None and key[2] == story_id)
+            ]
+            for key in stale:
+                del self._fragments[key]
+            return len(stale)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取缓存统计
+
+        Returns:
+            缓存片段数、命中/未命中次数和命中率
+        """
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "fragments": len(self._fragments),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 3) if total else 0.0,
+            }
+
+
+# 全局提示词片段缓存
+prompt_cache = PromptFragmentCache()
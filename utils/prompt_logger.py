@@ -25,7 +25,8 @@ class PromptLogger:
         log_dir = os.path.dirname(log_file) if os.path.dirname(log_file) else "."
         os.makedirs(log_dir, exist_ok=True)
     
-    def log_prompt(self, messages: List[Dict[str, str]], character_name: str = None, user_query: str = None):
+    def log_prompt(self, messages: List[Dict[str, str]], character_name: str = None, user_query: str = None,
+                   token_counts: Dict[str, Any] = None):
         """
         记录完整的提示词到日志文件
         
@@ -33,6 +34,7 @@ class PromptLogger:
             messages: 发送给模型的消息列表
             character_name: 角色名称
             user_query: 用户查询（原始请求）
+            token_counts: 按token预算组装时各部分的token估算
         """
         try:
             # 构建日志条目
@@ -48,6 +50,8 @@ class PromptLogger:
             # 计算总字符数
             total_chars = sum(len(msg.get("content", "")) for msg in messages)
             log_entry["total_characters"] = total_chars
+            if token_counts:
+                log_entry["token_counts"] = token_counts
             
             # 写入日志文件
             with open(self.log_file, "a", encoding="utf-8") as f:
@@ -0,0 +1,153 @@
+"""
+检索门控
+"嗯""好的""哈哈"这类低信息量的输入也会触发查询向量化、召回和一次精排API调用，白白增加首token延迟。
+在检索记忆和角色详情之前先用廉价的规则判断是否值得检索：
+
+    1. 含有"记得""什么""为什么"等回忆/提问线索时总是检索
+    2. 去掉语气字（嗯、哈、啊……）后整句只由应答词（好的、知道了、谢谢……）组成时跳过
+    3. 去掉语气字后剩余的字数少于 min_chars，或语气字占比达到 max_stopword_ratio 时跳过
+    4. 配置了本地分类器（"模块:函数"，输入文本返回需要检索的概率）时，概率低于 classifier_threshold 时跳过
+
+跳过检索的一轮不会引入新话题，因此沿用上一轮（同一角色/故事）检索到的记忆和角色详情。
+"""
+import re
+import threading
+from importlib import import_module
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config import get_memory_config
+
+# 回忆或提问线索：出现时总是检索
+_RECALL_HINT_RE = re.compile(r"记得|记不记得|忘了|以前|上次|之前|那次|什么|为什么|怎么|哪|谁|多少|几|吗|\?|？")
+# 应答词（整句只由应答词组成时视为应答）
+_ACK_RE = re.compile(r"(?:好的|好吧|好呀|好滴|可以|行吧|没问题|没事|知道了|知道|明白了|明白|了解|收到|谢谢|多谢|是的|对的|对啊|晚安|早安|拜拜|再见|okay|ok|yes|lol|hh+)+")
+# 语气字（只包含不承载内容的叹词，"好累""是你"中的"好""是"不能去掉）
+_FILLER_CHARS = set("嗯恩哦噢喔哈呵嘿嘻啊呀唔额呃诶欸哇")
+# 空白、标点和符号（保留中日韩字符、字母和数字）
+_NON_WORD_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def _normalize(query: str) -> str:
+    return _NON_WORD_RE.sub("", query or "").lower()
+
+
+class QueryGate:
+    """检索门控（规则和可选的本地分类器）"""
+
+    def __init__(self, enabled: bool = True, min_chars: int = 2, max_stopword_ratio: float = 0.7,
+                 classifier: Optional[str] = None, classifier_threshold: float = 0.5):
+        """
+        初始化检索门控
+
+        Args:
+            enabled: 是否启用（关闭时总是检索）
+            min_chars: 去掉语气字后至少需要的字数
+            max_stopword_ratio: 语气字占比达到该值时跳过
+            classifier: 本地分类器的导入路径（"模块:函数"），为空时不使用
+            classifier_threshold: 分类器给出的检索概率低于该值时跳过
+        """
+        self.enabled = enabled
+        self.min_chars = min_chars
+        self.max_stopword_ratio = max_stopword_ratio
+        self.classifier_threshold = classifier_threshold
+        self.classifier = self._load_classifier(classifier) if classifier else None
+        self._lock = threading.Lock()
+        self._stats: Dict[str, int] = {"retrieved": 0, "skipped": 0, "reused": 0}
+
+    @classmethod
+    def from_config(cls) -> "QueryGate":
+        """按 MEMORY_CONFIG["query_gate"] 创建检索门控"""
+        gate_config = get_memory_config().get("query_gate") or {}
+        return cls(
+            enabled=bool(gate_config.get("enabled", True)),
+            min_chars=int(gate_config.get("min_chars", 2)),
+            max_stopword_ratio=float(gate_config.get("max_stopword_ratio", 0.7)),
+            classifier=gate_config.get("classifier") or None,
+            classifier_threshold=float(gate_config.get("classifier_threshold", 0.5)),
+        )
+
+    @staticmethod
+    def _load_classifier(path: str) -> Optional[Callable[[str], float]]:
+        try:
+            module_name, _, func_name = path.partition(":")
+            return getattr(import_module(module_name), func_name or "predict")
+        except Exception as e:
+            print(f"加载检索门控分类器失败({path}): {e}")
+            return None
+
+    def check(self, query: str) -> Tuple[bool, str]:
+        """
+        判断查询是否需要检索
+
+        Args:
+            query: 用户输入
+
+        Returns:
+            (是否检索, 原因)，原因为 disabled/hint/empty/ack/short/stopwords/classifier/passed 之一
+        """
+        if not self.enabled:
+            return True, "disabled"
+
+        text = _normalize(query)
+        if not text:
+            return False, "empty"
+        if _RECALL_HINT_RE.search(query):
+            return True, "hint"
+
+        content = "".join(char for char in text if char not in _FILLER_CHARS)
+        if content and _ACK_RE.fullmatch(content):
+            return False, "ack"
+        if len(content) < self.min_chars:
+            return False, "short"
+        if 1 - len(content) / len(text) >= self.max_stopword_ratio:
+            return False, "stopwords"
+
+        if self.classifier is not None:
+            try:
+                if float(self.classifier(query)) < self.classifier_threshold:
+                    return False, "classifier"
+            except Exception as e:
+                print(f"检索门控分类器出错: {e}")
+        return True, "passed"
+
+    def record(self, outcome: str) -> None:
+        """
+        记录一次门控结果
+
+        Args:
+            outcome: retrieved（检索）/skipped（跳过）/reused（跳过并沿用上一轮的检索结果）
+        """
+        with self._lock:
+            self._stats[outcome] = self._stats.get(outcome, 0) + 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取门控统计
+
+        Returns:
+            检索/跳过/沿用次数和跳过率
+        """
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+        total = stats["retrieved"] + stats["skipped"] + stats["reused"]
+        stats["skip_rate"] = round((stats["skipped"] + stats["reused"]) / total, 3) if total else 0.0
+        return stats
+
+
+_query_gate: Optional[QueryGate] = None
+_query_gate_lock = threading.Lock()
+
+
+def get_query_gate() -> QueryGate:
+    """
+    获取共享的检索门控
+
+    Returns:
+        按配置创建的检索门控
+    """
+    global _query_gate
+    if _query_gate is None:
+        with _query_gate_lock:
+            if _query_gate is None:
+                _query_gate = QueryGate.from_config()
+    return _query_gate
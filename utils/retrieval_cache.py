@@ -0,0 +1,146 @@
+"""
+会话级检索结果缓存
+同一话题往往持续好几轮，连续几轮的查询召回和精排出来的记忆几乎相同。每个会话缓存最近几次检索的结果，
+键为 (记忆库, 记忆库版本, 归一化查询)，并保存查询向量：
+
+    - 归一化查询相同，或查询向量与缓存项的余弦相似度不低于 similarity_threshold 时命中
+    - 记忆库重新加载后（版本号变化）缓存项失效；记忆库只是追加了新文档且不超过 max_new_docs 条时仍然有效
+      （新增的文档是最近几轮对话，本来就在上下文窗口中，会被排除）
+
+命中时跳过召回和精排API调用（查询向量本身由召回模块缓存，命中判断和随后的召回共用一次嵌入）。
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import get_memory_config
+from utils.memory_utils import normalize_memory_text
+
+# (记忆库, 归一化查询)
+_CacheKey = Tuple[str, str]
+
+_stats_lock = threading.Lock()
+_stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "stale": 0}
+
+
+class RetrievalCache:
+    """单个会话的检索结果缓存"""
+
+    def __init__(self, max_entries: int = 8, similarity_threshold: float = 0.92, max_new_docs: int = 6):
+        """
+        初始化缓存
+
+        Args:
+            max_entries: 最多缓存的检索结果数（超出时淘汰最久未使用的）
+            similarity_threshold: 查询向量的余弦相似度不低于该值时视为同一查询
+            max_new_docs: 记忆库在缓存后最多新增多少条文档时缓存仍然有效
+        """
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.max_new_docs = max_new_docs
+        self._entries: "OrderedDict[_CacheKey, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls) -> Optional["RetrievalCache"]:
+        """
+        按 MEMORY_CONFIG["retrieval_cache"] 创建缓存
+
+        Returns:
+            检索结果缓存，未启用时返回None
+        """
+        cache_config = get_memory_config().get("retrieval_cache") or {}
+        if not cache_config.get("enabled", True):
+            return None
+        return cls(
+            max_entries=int(cache_config.get("max_entries", 8)),
+            similarity_threshold=float(cache_config.get("similarity_threshold", 0.92)),
+            max_new_docs=int(cache_config.get("max_new_docs", 6)),
+        )
+
+    def lookup(self, index: str, version: Tuple[int, int], query: str, embedding: Optional[np.ndarray],
+               top_k: int) -> Optional[List[str]]:
+        """
+        查找缓存的检索结果
+
+        Args:
+            index: 记忆库标识
+            version: 记忆库版本 (加载代数, 文档数)
+            query: 查询文本
+            embedding: 归一化的查询向量（没有向量召回时为None，只按查询文本匹配）
+            top_k: 需要的结果数
+
+        Returns:
+            缓存的检索结果（文档文本列表），未命中时返回None
+        """
+        key = (index, normalize_memory_text(query))
+        with self._lock:
+            # 清除记忆库已变化的缓存项
+            stale = [cache_key for cache_key, entry in self._entries.items()
+                     if cache_key[0] == index and not self._is_fresh(entry, version)]
+            for cache_key in stale:
+                del self._entries[cache_key]
+
+            entry = self._entries.get(key)
+            hit = "exact_hits" if entry is not None and entry["top_k"] >= top_k else None
+            if hit is None and embedding is not None:
+                for cache_key, candidate in reversed(self._entries.items()):
+                    if (cache_key[0] == index and candidate["top_k"] >= top_k
+                            and candidate["embedding"] is not None
+                            and float(np.dot(candidate["embedding"], embedding)) >= self.similarity_threshold):
+                        key, entry, hit = cache_key, candidate, "similar_hits"
+                        break
+            if hit is not None:
+                self._entries.move_to_end(key)
+                docs = list(entry["docs"])
+
+        _count(hit or "misses")
+        if stale:
+            _count("stale", len(stale))
+        return docs if hit is not None else None
+
+    def store(self, index: str, version: Tuple[int, int], query: str, embedding: Optional[np.ndarray],
+              top_k: int, docs: List[str]) -> None:
+        """
+        缓存检索结果
+
+        Args:
+            index: 记忆库标识
+            version: 记忆库版本 (加载代数, 文档数)
+            query: 查询文本
+            embedding: 归一化的查询向量
+            top_k: 检索的结果数
+            docs: 检索结果（文档文本列表，未排除上下文中的文档，由调用方按各自的排除集合过滤）
+        """
+        key = (index, normalize_memory_text(query))
+        with self._lock:
+            self._entries[key] = {"version": version, "embedding": embedding, "top_k": top_k, "docs": list(docs)}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _is_fresh(self, entry: Dict[str, Any], version: Tuple[int, int]) -> bool:
+        generation, doc_count = entry["version"]
+        return generation == version[0] and 0 <= version[1] - doc_count <= self.max_new_docs
+
+
+def _count(name: str, amount: int = 1) -> None:
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def get_retrieval_cache_stats() -> Dict[str, Any]:
+    """
+    获取检索结果缓存统计（所有会话合计）
+
+    Returns:
+        精确命中/相似命中/未命中次数、失效的缓存项数和命中率
+    """
+    with _stats_lock:
+        stats: Dict[str, Any] = dict(_stats)
+    hits = stats["exact_hits"] + stats["similar_hits"]
+    total = hits + stats["misses"]
+    stats["hit_rate"] = round(hits / total, 3) if total else 0.0
+    return stats
@@ -0,0 +1,140 @@
+"""
+检索截止时间
+记忆和角色详情检索（查询向量化、召回、精排）在发送对话请求之前完成，慢的时候会拖到 MEMORY_CONFIG["timeout"]（10秒）。
+这里让各路检索在共享线程池中并发执行，最多等待 deadline_ms 毫秒：到时已完成的结果进入提示词，
+未完成的检索在后台继续执行，结果写入会话的检索结果缓存（见utils.retrieval_cache），供下一轮使用。
+
+任务与回复结束后的后续任务一样通过 utils.post_stream.submit_in_context 提交。
+"""
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional
+
+from config import get_memory_config
+from utils.post_stream import submit_in_context
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats: Dict[str, Any] = {"runs": 0, "budget_hit": 0, "late": {}, "failed": 0, "total_wait_ms": 0.0, "prefetched": 0}
+
+
+def get_retrieval_executor() -> ThreadPoolExecutor:
+    """
+    获取检索任务共享的线程池
+
+    Returns:
+        线程池（大小由 MEMORY_CONFIG["deadline_workers"] 配置）
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                workers = max(1, int(get_memory_config().get("deadline_workers", 8)))
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="retrieval")
+    return _executor
+
+
+def get_retrieval_deadline() -> Optional[float]:
+    """
+    获取检索截止时间
+
+    Returns:
+        秒数，未配置（0）时返回None，表示等待所有检索完成
+    """
+    deadline_ms = int(get_memory_config().get("deadline_ms", 400))
+    return deadline_ms / 1000 if deadline_ms > 0 else None
+
+
+def run_with_deadline(tasks: Dict[str, Callable[[], Any]], deadline: Optional[float] = None) -> Dict[str, Any]:
+    """
+    并发执行检索任务，最多等待到截止时间
+
+    Args:
+        tasks: 任务名 -> 可调用对象
+        deadline: 最长等待秒数，为None时使用配置（get_retrieval_deadline）
+
+    Returns:
+        已按时完成的任务结果（任务名 -> 返回值），超时或失败的任务不在其中
+    """
+    if not tasks:
+        return {}
+    if deadline is None:
+        deadline = get_retrieval_deadline()
+
+    executor = get_retrieval_executor()
+    started = time.monotonic()
+    futures = {submit_in_context(executor, func): name for name, func in tasks.items()}
+    done, pending = wait(futures, timeout=deadline)
+    waited_ms = (time.monotonic() - started) * 1000
+
+    results = {}
+    failed = 0
+    for future in done:
+        name = futures[future]
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            print(f"检索任务失败({name}): {e}")
+            failed += 1
+
+    late = [futures[future] for future in pending]
+    if late:
+        print(f"检索超过截止时间({deadline * 1000:.0f}ms)，未完成的检索不再等待: {', '.join(late)}")
+
+    with _stats_lock:
+        _stats["runs"] += 1
+        _stats["failed"] += failed
+        _stats["total_wait_ms"] += waited_ms
+        if late:
+            _stats["budget_hit"] += 1
+            for name in late:
+                _stats["late"][name] = _stats["late"].get(name, 0) + 1
+    return results
+
+
+def run_in_background(tasks: Dict[str, Callable[[], Any]]) -> List[Future]:
+    """
+    在检索线程池中执行检索任务，不等待结果（用于预取：结果写入检索结果缓存）
+
+    Args:
+        tasks: 任务名 -> 可调用对象
+
+    Returns:
+        各任务的Future
+    """
+    def report(name: str, future: Future) -> None:
+        error = future.exception()
+        if error is not None:
+            print(f"预取检索失败({name}): {error}")
+
+    executor = get_retrieval_executor()
+    futures = []
+    for name, func in tasks.items():
+        future = submit_in_context(executor, func)
+        future.add_done_callback(lambda done, name=name: report(name, done))
+        futures.append(future)
+    with _stats_lock:
+        _stats["prefetched"] += 1
+    return futures
+
+
+def get_retrieval_deadline_stats() -> Dict[str, Any]:
+    """
+    获取检索截止时间统计
+
+    Returns:
+        检索次数、超过截止时间的次数和比例、各路检索超时次数、失败次数、平均等待时间（毫秒）和预取次数
+    """
+    with _stats_lock:
+        runs = _stats["runs"]
+        return {
+            "runs": runs,
+            "budget_hit": _stats["budget_hit"],
+            "budget_hit_rate": round(_stats["budget_hit"] / runs, 3) if runs else 0.0,
+            "late": dict(_stats["late"]),
+            "failed": _stats["failed"],
+            "avg_wait_ms": round(_stats["total_wait_ms"] / runs, 1) if runs else 0.0,
+            "prefetched": _stats["prefetched"],
+        }
@@ -0,0 +1,189 @@
+"""
+SQLite迁移工具
+将现有的文件存储（历史记录、记忆、故事进度、场景）一次性导入SQLite数据库，原文件保持不变
+
+用法（在项目根目录执行）：
+    python -m utils.sqlite_migrate [--db data/cabm.db] [--force]
+
+迁移完成后在.env中设置 STORAGE_BACKEND=sqlite 启用SQLite存储
+"""
+import os
+import sys
+import json
+import argparse
+from pathlib import Path
+
+import rtoml
+
+project_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(project_root))
+
+from config import get_app_config
+from utils.sqlite_store import SQLiteStore, history_key, scene_owner
+from utils.history_utils import HistoryManager
+from utils.text_utils import get_parsed_message
+
+_BATCH_SIZE = 1000
+
+
+def migrate_history(store: SQLiteStore, file_manager: HistoryManager, log_path: str, force: bool) -> int:
+    """
+    迁移单个历史记录文件（包含所有归档分段）
+
+    Args:
+        store: 目标存储
+        file_manager: 文件存储的历史记录管理器
+        log_path: 历史记录文件路径
+        force: 目标已有数据时是否覆盖
+
+    Returns:
+        迁移的消息数量
+    """
+    key = history_key(log_path)
+    if store.history_count(key):
+        if not force:
+            print(f"跳过历史记录（已存在）: {key}")
+            return 0
+        store.clear_history(key)
+
+    migrated = 0
+    batch = []
+    for record in file_manager.iter_all_messages(log_path):
+        if record.get("role") not in ("user", "system"):
+            get_parsed_message(record)
+        batch.append(record)
+        if len(batch) >= _BATCH_SIZE:
+            store.append_history_batch(key, batch)
+            migrated += len(batch)
+            batch = []
+    if batch:
+        store.append_history_batch(key, batch)
+        migrated += len(batch)
+    print(f"已迁移历史记录 {migrated} 条: {key}")
+    return migrated
+
+
+def migrate_memory(store: SQLiteStore, memory_file: Path, owner: str, force: bool) -> bool:
+    """
+    迁移单个记忆库JSON文件
+
+    Args:
+        store: 目标存储
+        memory_file: 记忆库JSON文件
+        owner: 记忆库归属键
+        force: 目标已有数据时是否覆盖
+
+    Returns:
+        是否完成迁移
+    """
+    if store.load_memory(owner) is not None and not force:
+        print(f"跳过记忆库（已存在）: {owner}")
+        return False
+    try:
+        with open(memory_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        print(f"读取记忆库失败 {memory_file}: {e}")
+        return False
+    store.save_memory(owner, data.get('character_name'), data.get('model'), data.get('rag'))
+    print(f"已迁移记忆库: {owner}")
+    return True
+
+
+def migrate_scenes(store: SQLiteStore, scene_file: Path, owner: str, force: bool) -> bool:
+    """
+    迁移单个场景JSON文件
+
+    Args:
+        store: 目标存储
+        scene_file: 场景JSON文件
+        owner: 场景归属键
+        force: 目标已有数据时是否覆盖
+
+    Returns:
+        是否完成迁移
+    """
+    if store.load_scenes(owner) is not None and not force:
+        print(f"跳过场景（已存在）: {owner}")
+        return False
+    try:
+        with open(scene_file, 'r', encoding='utf-8') as f:
+            scenes_data = json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        print(f"读取场景文件失败 {scene_file}: {e}")
+        return False
+    store.save_scenes(owner, scenes_data)
+    print(f"已迁移场景: {owner}")
+    return True
+
+
+def migrate_all(db_path: str, force: bool = False) -> None:
+    """
+    迁移全部文件存储数据到SQLite
+
+    Args:
+        db_path: 数据库文件路径
+        force: 目标已有数据时是否覆盖
+    """
+    store = SQLiteStore(db_path)
+    app_config = get_app_config()
+    history_dir = Path(app_config["history_dir"])
+    file_manager = HistoryManager(str(history_dir))
+
+    # 角色历史记录与记忆
+    for log_path in sorted(history_dir.glob("*_history.log")):
+        migrate_history(store, file_manager, str(log_path), force)
+    memory_dir = Path("data/memory")
+    if memory_dir.exists():
+        for character_dir in sorted(p for p in memory_dir.iterdir() if p.is_dir()):
+            memory_file = character_dir / f"{character_dir.name}_memory.json"
+            if memory_file.exists():
+                migrate_memory(store, memory_file, f"character:{character_dir.name}", force)
+
+    # 角色场景
+    scenes_dir = Path("data/scenes")
+    if scenes_dir.exists():
+        for scene_file in sorted(scenes_dir.glob("*.json")):
+            migrate_scenes(store, scene_file, scene_owner(character_id=scene_file.stem), force)
+
+    # 故事：历史记录、记忆、进度、场景
+    saves_dir = Path("data/saves")
+    if saves_dir.exists():
+        for story_dir in sorted(p for p in saves_dir.iterdir() if p.is_dir()):
+            story_id = story_dir.name
+            log_path = story_dir / "history.log"
+            if log_path.exists():
+                migrate_history(store, file_manager, str(log_path), force)
+            memory_file = story_dir / f"{story_id}_memory.json"
+            if memory_file.exists():
+                migrate_memory(store, memory_file, f"story:{story_id}", force)
+            scene_file = story_dir / "scenes.json"
+            if scene_file.exists():
+                migrate_scenes(store, scene_file, scene_owner(story_id=story_id), force)
+            story_file = story_dir / "story.toml"
+            if story_file.exists():
+                if store.load_story_progress(story_id) is not None and not force:
+                    print(f"跳过故事进度（已存在）: {story_id}")
+                    continue
+                try:
+                    with open(story_file, 'r', encoding='utf-8') as f:
+                        progress = rtoml.load(f).get('progress', {})
+                    store.save_story_progress(story_id, progress.get('current', 0), progress.get('offset', 0))
+                    print(f"已迁移故事进度: {story_id}")
+                except Exception as e:
+                    print(f"读取故事文件失败 {story_file}: {e}")
+
+    print(f"迁移完成: {db_path}")
+    print("在.env中设置 STORAGE_BACKEND=sqlite 以启用SQLite存储")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="将文件存储迁移到SQLite")
+    parser.add_argument("--db", default=None, help="数据库文件路径（默认使用配置中的sqlite_path）")
+    parser.add_argument("--force", action="store_true", help="覆盖数据库中已存在的数据")
+    args = parser.parse_args()
+
+    # 日志键是相对于项目根目录的路径，需与应用运行时一致
+    os.chdir(project_root)
+    storage_config = get_app_config().get("storage") or {}
+    migrate_all(args.db or storage_config.get("sqlite_path", "data/cabm.db"), force=args.force)
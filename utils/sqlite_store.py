@@ -0,0 +1,493 @@
+"""
+SQLite存储后端
+以单个WAL模式的SQLite数据库保存历史记录、记忆元数据、故事进度和场景使用记录，
+替代逐文件整体重写/整体扫描的文件存储。默认仍使用文件存储，
+在APP_CONFIG["storage"]["backend"]设置为"sqlite"时启用
+
+    history          每条消息一行，(log_key, seq) 为主键，追加在事务中完成
+    memory_meta      每个记忆库一行：角色名、模型、更新时间以及非逐条的RAG数据
+    memory_docs      记忆文本，每条一行
+    memory_rows      与记忆文本逐条对齐的召回数据（如向量），每条一行
+    story_progress   故事进度（章节、偏移）
+    scene_state      场景状态（最后使用的背景）
+    scene_backgrounds 背景使用次数与印象
+"""
+import os
+import json
+import sqlite3
+import threading
+import contextlib
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Iterator
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    log_key TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    timestamp TEXT,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    parsed TEXT,
+    PRIMARY KEY (log_key, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_history_role ON history (log_key, role, seq);
+
+CREATE TABLE IF NOT EXISTS memory_meta (
+    owner TEXT PRIMARY KEY,
+    character_name TEXT,
+    model TEXT,
+    last_updated TEXT,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS memory_docs (
+    owner TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    doc_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (owner, position)
+);
+CREATE TABLE IF NOT EXISTS memory_rows (
+    owner TEXT NOT NULL,
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (owner, name, position)
+);
+
+CREATE TABLE IF NOT EXISTS story_progress (
+    story_id TEXT PRIMARY KEY,
+    current_chapter INTEGER NOT NULL DEFAULT 0,
+    chapter_offset INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS scene_state (
+    owner TEXT PRIMARY KEY,
+    last_background TEXT
+);
+CREATE TABLE IF NOT EXISTS scene_backgrounds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner TEXT NOT NULL,
+    background_id TEXT NOT NULL,
+    usage_count INTEGER NOT NULL DEFAULT 0,
+    impression TEXT NOT NULL DEFAULT 'None',
+    UNIQUE (owner, background_id)
+);
+"""
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+_BATCH_SIZE = 1000
+
+
+def history_key(file_path: str) -> str:
+    """
+    将历史记录文件路径转换为数据库中的日志键（相对于工作目录，统一使用/分隔）
+
+    Args:
+        file_path: 历史记录文件路径
+
+    Returns:
+        日志键，如 data/history/<id>_history.log
+    """
+    return os.path.relpath(os.path.abspath(file_path)).replace(os.sep, "/")
+
+
+def scene_owner(character_id: str = None, story_id: str = None) -> str:
+    """获取场景数据的归属键"""
+    if story_id:
+        return f"story:{story_id}"
+    if character_id:
+        return f"character:{character_id}"
+    raise ValueError("必须提供character_id或story_id")
+
+
+class SQLiteStore:
+    """SQLite存储（每个线程一个连接，写事务在进程内串行化）"""
+
+    def __init__(self, db_path: str):
+        """
+        初始化存储并创建表结构
+
+        Args:
+            db_path: 数据库文件路径
+        """
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """获取当前线程的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """写事务（BEGIN IMMEDIATE，异常时回滚）"""
+        conn = self._connect()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _query(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        return self._connect().execute(sql, params).fetchall()
+
+    # ------------------------------------------------------------------
+    # 历史记录
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _row_to_record(row: sqlite3.Row) -> Dict[str, Any]:
+        record = {"timestamp": row["timestamp"], "role": row["role"], "content": row["content"]}
+        if row["parsed"]:
+            record["parsed"] = json.loads(row["parsed"])
+        return record
+
+    @staticmethod
+    def _record_params(log_key: str, seq: int, record: Dict[str, Any]) -> tuple:
+        parsed = record.get("parsed")
+        return (
+            log_key, seq, record.get("timestamp"), record.get("role", ""), record.get("content", ""),
+            json.dumps(parsed, ensure_ascii=False) if parsed is not None else None
+        )
+
+    def append_history(self, log_key: str, record: Dict[str, Any]) -> int:
+        """
+        追加一条消息（事务内分配序号）
+
+        Args:
+            log_key: 日志键
+            record: 消息记录
+
+        Returns:
+            消息序号（从0开始）
+        """
+        with self.transaction() as conn:
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM history WHERE log_key = ?", (log_key,)
+            ).fetchone()[0]
+            conn.execute(
+                "INSERT INTO history (log_key, seq, timestamp, role, content, parsed) VALUES (?, ?, ?, ?, ?, ?)",
+                self._record_params(log_key, seq, record)
+            )
+        return seq
+
+    def append_history_batch(self, log_key: str, records: List[Dict[str, Any]]) -> None:
+        """在一个事务中批量追加消息（用于迁移）"""
+        with self.transaction() as conn:
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM history WHERE log_key = ?", (log_key,)
+            ).fetchone()[0]
+            conn.executemany(
+                "INSERT INTO history (log_key, seq, timestamp, role, content, parsed) VALUES (?, ?, ?, ?, ?, ?)",
+                [self._record_params(log_key, seq + i, record) for i, record in enumerate(records)]
+            )
+
+    def history_count(self, log_key: str) -> int:
+        """获取消息总数（序号连续，取最大序号即可走主键索引）"""
+        return self._query("SELECT COALESCE(MAX(seq) + 1, 0) FROM history WHERE log_key = ?", (log_key,))[0][0]
+
+    def history_range(self, log_key: str, start: int, end: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        按序号读取[start, end)范围内的消息
+
+        Args:
+            log_key: 日志键
+            start: 起始序号
+            end: 结束序号，None表示到末尾
+
+        Returns:
+            消息列表，按时间从旧到新排序
+        """
+        if end is None:
+            rows = self._query(
+                "SELECT * FROM history WHERE log_key = ? AND seq >= ? ORDER BY seq", (log_key, start)
+            )
+        else:
+            rows = self._query(
+                "SELECT * FROM history WHERE log_key = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                (log_key, start, end)
+            )
+        return [self._row_to_record(row) for row in rows]
+
+    def history_tail(self, log_key: str, count: int) -> List[Dict[str, Any]]:
+        """
+        读取最近的count条消息
+
+        Args:
+            log_key: 日志键
+            count: 消息数量，小于等于0表示全部
+
+        Returns:
+            消息列表，按时间从旧到新排序
+        """
+        if count <= 0:
+            return self.history_range(log_key, 0)
+        rows = self._query(
+            "SELECT * FROM history WHERE log_key = ? ORDER BY seq DESC LIMIT ?", (log_key, count)
+        )
+        return [self._row_to_record(row) for row in reversed(rows)]
+
+    def iter_history(self, log_key: str) -> Iterator[Dict[str, Any]]:
+        """按时间从旧到新分批遍历全部消息"""
+        start = 0
+        while True:
+            batch = self.history_range(log_key, start, start + _BATCH_SIZE)
+            yield from batch
+            if len(batch) < _BATCH_SIZE:
+                return
+            start += _BATCH_SIZE
+
+    def last_history_timestamp(self, log_key: str, role: Optional[str] = None) -> Optional[str]:
+        """
+        获取最后一条消息（可按角色过滤）的时间戳
+
+        Args:
+            log_key: 日志键
+            role: 消息角色，None表示不过滤
+
+        Returns:
+            时间戳字符串，没有消息时返回None
+        """
+        if role is None:
+            rows = self._query(
+                "SELECT timestamp FROM history WHERE log_key = ? ORDER BY seq DESC LIMIT 1", (log_key,)
+            )
+        else:
+            rows = self._query(
+                "SELECT timestamp FROM history WHERE log_key = ? AND role = ? ORDER BY seq DESC LIMIT 1",
+                (log_key, role)
+            )
+        return rows[0][0] if rows else None
+
+    def clear_history(self, log_key: str) -> None:
+        """删除日志的全部消息"""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM history WHERE log_key = ?", (log_key,))
+
+    # ------------------------------------------------------------------
+    # 记忆
+    # ------------------------------------------------------------------
+    def save_memory(self, owner: str, character_name: str, model: Optional[str], rag_data: Optional[Dict[str, Any]]) -> None:
+        """
+        保存记忆库（只追加新增的记忆文本和逐条数据）
+
+        Args:
+            owner: 记忆库归属键
+            character_name: 角色名称或故事ID
+            model: 嵌入模型
+            rag_data: RAG.save_to_file()返回的数据
+        """
+        rag_data = dict(rag_data or {})
+        retriever = dict(rag_data.pop("retriever", None) or {})
+        id_to_doc = retriever.pop("id_to_doc", {}) or {}
+        doc_ids = sorted(int(doc_id) for doc_id in id_to_doc)
+
+        # 与记忆文本逐条对齐的列表按行保存，其余数据整体保存
+        row_data = {}
+        blobs = {}
+        for name, payload in retriever.items():
+            if isinstance(payload, list) and len(payload) == len(doc_ids):
+                row_data[name] = payload
+            else:
+                blobs[name] = payload
+        extra = json.dumps({"rag": rag_data, "retriever": blobs}, ensure_ascii=False)
+
+        with self.transaction() as conn:
+            stored = conn.execute("SELECT COUNT(*) FROM memory_docs WHERE owner = ?", (owner,)).fetchone()[0]
+            if stored > len(doc_ids):
+                # 记忆库被重建，整体替换
+                conn.execute("DELETE FROM memory_docs WHERE owner = ?", (owner,))
+                conn.execute("DELETE FROM memory_rows WHERE owner = ?", (owner,))
+                stored = 0
+            conn.executemany(
+                "INSERT INTO memory_docs (owner, position, doc_id, text) VALUES (?, ?, ?, ?)",
+                [
+                    (owner, position, doc_id, id_to_doc.get(doc_id, id_to_doc.get(str(doc_id), "")))
+                    for position, doc_id in enumerate(doc_ids[stored:], start=stored)
+                ]
+            )
+            for name, payload in row_data.items():
+                stored_rows = conn.execute(
+                    "SELECT COUNT(*) FROM memory_rows WHERE owner = ? AND name = ?", (owner, name)
+                ).fetchone()[0]
+                if stored_rows > len(payload):
+                    conn.execute("DELETE FROM memory_rows WHERE owner = ? AND name = ?", (owner, name))
+                    stored_rows = 0
+                conn.executemany(
+                    "INSERT INTO memory_rows (owner, name, position, data) VALUES (?, ?, ?, ?)",
+                    [
+                        (owner, name, position, json.dumps(item))
+                        for position, item in enumerate(payload[stored_rows:], start=stored_rows)
+                    ]
+                )
+            conn.execute(
+                "INSERT INTO memory_meta (owner, character_name, model, last_updated, extra) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(owner) DO UPDATE SET character_name = excluded.character_name, model = excluded.model, "
+                "last_updated = excluded.last_updated, extra = excluded.extra",
+                (owner, character_name, model, datetime.now().isoformat(), extra)
+            )
+
+    def load_memory(self, owner: str) -> Optional[Dict[str, Any]]:
+        """
+        加载记忆库，返回与记忆JSON文件相同结构的数据
+
+        Args:
+            owner: 记忆库归属键
+
+        Returns:
+            {"character_name", "model", "last_updated", "rag"}，不存在时返回None
+        """
+        meta_rows = self._query("SELECT * FROM memory_meta WHERE owner = ?", (owner,))
+        if not meta_rows:
+            return None
+        meta = meta_rows[0]
+        extra = json.loads(meta["extra"] or "{}")
+        retriever = dict(extra.get("retriever", {}))
+        retriever["id_to_doc"] = {
+            row["doc_id"]: row["text"]
+            for row in self._query("SELECT doc_id, text FROM memory_docs WHERE owner = ? ORDER BY position", (owner,))
+        }
+        for row in self._query(
+            "SELECT name, data FROM memory_rows WHERE owner = ? ORDER BY name, position", (owner,)
+        ):
+            retriever.setdefault(row["name"], []).append(json.loads(row["data"]))
+        rag = dict(extra.get("rag", {}))
+        rag["retriever"] = retriever
+        return {
+            "character_name": meta["character_name"],
+            "model": meta["model"],
+            "last_updated": meta["last_updated"],
+            "rag": rag,
+        }
+
+    # ------------------------------------------------------------------
+    # 故事进度
+    # ------------------------------------------------------------------
+    def save_story_progress(self, story_id: str, current: int, offset: int) -> None:
+        """保存故事进度"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO story_progress (story_id, current_chapter, chapter_offset, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(story_id) DO UPDATE SET current_chapter = excluded.current_chapter, "
+                "chapter_offset = excluded.chapter_offset, updated_at = excluded.updated_at",
+                (story_id, current, offset, datetime.now().strftime(TIMESTAMP_FORMAT))
+            )
+
+    def load_story_progress(self, story_id: str) -> Optional[Dict[str, int]]:
+        """
+        加载故事进度
+
+        Args:
+            story_id: 故事ID
+
+        Returns:
+            {"current", "offset"}，没有记录时返回None
+        """
+        rows = self._query(
+            "SELECT current_chapter, chapter_offset FROM story_progress WHERE story_id = ?", (story_id,)
+        )
+        if not rows:
+            return None
+        return {"current": rows[0]["current_chapter"], "offset": rows[0]["chapter_offset"]}
+
+    # ------------------------------------------------------------------
+    # 场景
+    # ------------------------------------------------------------------
+    def load_scenes(self, owner: str) -> Optional[Dict[str, Any]]:
+        """
+        加载场景数据，返回与场景JSON文件相同结构的数据
+
+        Args:
+            owner: 场景归属键
+
+        Returns:
+            {"last_background", "backgrounds"}，没有记录时返回None
+        """
+        state = self._query("SELECT last_background FROM scene_state WHERE owner = ?", (owner,))
+        if not state:
+            return None
+        backgrounds = [
+            {"id": row["background_id"], "usage_count": row["usage_count"], "impression": row["impression"]}
+            for row in self._query(
+                "SELECT background_id, usage_count, impression FROM scene_backgrounds WHERE owner = ? ORDER BY id",
+                (owner,)
+            )
+        ]
+        return {"last_background": state[0]["last_background"], "backgrounds": backgrounds}
+
+    def save_scenes(self, owner: str, scenes_data: Dict[str, Any]) -> None:
+        """整体替换场景数据"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO scene_state (owner, last_background) VALUES (?, ?) "
+                "ON CONFLICT(owner) DO UPDATE SET last_background = excluded.last_background",
+                (owner, scenes_data.get("last_background"))
+            )
+            conn.execute("DELETE FROM scene_backgrounds WHERE owner = ?", (owner,))
+            conn.executemany(
+                "INSERT INTO scene_backgrounds (owner, background_id, usage_count, impression) VALUES (?, ?, ?, ?)",
+                [
+                    (owner, bg["id"], bg.get("usage_count", 0), bg.get("impression", "None"))
+                    for bg in scenes_data.get("backgrounds", [])
+                ]
+            )
+
+    def record_background_usage(self, owner: str, background_id: str) -> None:
+        """记录一次背景使用（更新最后背景并累加使用次数）"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO scene_state (owner, last_background) VALUES (?, ?) "
+                "ON CONFLICT(owner) DO UPDATE SET last_background = excluded.last_background",
+                (owner, background_id)
+            )
+            conn.execute(
+                "INSERT INTO scene_backgrounds (owner, background_id, usage_count) VALUES (?, ?, 1) "
+                "ON CONFLICT(owner, background_id) DO UPDATE SET usage_count = usage_count + 1",
+                (owner, background_id)
+            )
+
+    def set_background_impression(self, owner: str, background_id: str, impression: str) -> None:
+        """更新背景印象（不存在时创建使用次数为0的记录）"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO scene_backgrounds (owner, background_id, usage_count, impression) VALUES (?, ?, 0, ?) "
+                "ON CONFLICT(owner, background_id) DO UPDATE SET impression = excluded.impression",
+                (owner, background_id, impression)
+            )
+
+
+_shared_sqlite_store: Optional[SQLiteStore] = None
+_shared_sqlite_store_lock = threading.Lock()
+
+
+def get_sqlite_store() -> Optional[SQLiteStore]:
+    """
+    获取进程内共享的SQLite存储
+
+    Returns:
+        配置为sqlite后端时返回存储实例，否则返回None（使用文件存储）
+    """
+    global _shared_sqlite_store
+    if _shared_sqlite_store is None:
+        from config import get_app_config
+        storage_config = get_app_config().get("storage") or {}
+        if storage_config.get("backend", "file") != "sqlite":
+            return None
+        with _shared_sqlite_store_lock:
+            if _shared_sqlite_store is None:
+                _shared_sqlite_store = SQLiteStore(storage_config.get("sqlite_path", "data/cabm.db"))
+    return _shared_sqlite_store
@@ -0,0 +1,197 @@
+"""
+SSE输出工具
+将模型逐token产出的content增量合并成较少的SSE帧，减少小块写入和前端重排
+
+    - content增量累积到 max_delay_ms 毫秒或 max_chars 个字符后合并成一帧
+    - 第一段content立即发送，不增加首字延迟
+    - mood等其他事件立即发送（发送前先冲刷已累积的content，保证顺序）
+    - content字符串结束时立即冲刷（之后模型输出note等字段期间不再积压content）；
+      每个上游数据块都检查累积时间，不只在收到content增量时检查
+
+用法（在项目根目录执行，对比开启/关闭合并时的帧数、字节数、首帧时间和吞吐）：
+    python -m utils.sse_utils [--tokens 400] [--interval-ms 15]
+"""
+import json
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from utils.stream_parser import CONTENT_END
+
+
+def sse_frame(payload: Dict[str, Any]) -> str:
+    """
+    构造一条SSE数据帧
+
+    Args:
+        payload: 帧数据
+
+    Returns:
+        "data: {...}\\n\\n" 格式的字符串
+    """
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+class SSEFrameCoalescer:
+    """content增量的SSE帧合并器"""
+
+    def __init__(self, max_delay_ms: int = 40, max_chars: int = 24,
+                 event_names: Optional[Dict[str, str]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        初始化合并器
+
+        Args:
+            max_delay_ms: content最长累积时间（毫秒），0表示不按时间合并
+            max_chars: content最多累积字符数，0表示不按字符数合并
+            event_names: 字段名到SSE事件键的映射，如 {"content": "characterContent"}
+            clock: 单调时钟（秒）
+        """
+        self.max_delay = max(0, max_delay_ms) / 1000.0
+        self.max_chars = max(0, max_chars)
+        self.enabled = bool(self.max_delay or self.max_chars)
+        self.event_names = event_names or {}
+        self._clock = clock
+        self._pending: List[str] = []
+        self._pending_chars = 0
+        self._last_flush = 0.0
+        self._sent_content = False
+        self.frames = 0
+        self.deltas = 0
+
+    @classmethod
+    def from_config(cls, event_names: Optional[Dict[str, str]] = None) -> "SSEFrameCoalescer":
+        """
+        按流式输出配置创建合并器
+
+        Args:
+            event_names: 字段名到SSE事件键的映射
+
+        Returns:
+            合并器实例
+        """
+        from config import get_stream_config
+        stream_config = get_stream_config()
+        return cls(
+            max_delay_ms=stream_config.get("coalesce_ms", 0),
+            max_chars=stream_config.get("coalesce_chars", 0),
+            event_names=event_names
+        )
+
+    def push(self, field: str, value: Any) -> List[str]:
+        """
+        加入一个事件
+
+        Args:
+            field: 字段名（content为增量，CONTENT_END只冲刷累积的content，其余为立即发送的事件）
+            value: 字段值
+
+        Returns:
+            需要立即发送的SSE帧列表
+        """
+        if field == CONTENT_END:
+            return self.flush()
+        if field != "content":
+            frames = self.flush()
+            frames.append(self._frame(field, value))
+            return frames
+
+        self.deltas += 1
+        if not self.enabled or not self._sent_content:
+            # 关闭合并时逐个发送；第一段content立即发送以保证首字延迟
+            self._sent_content = True
+            frames = self.flush()
+            frames.append(self._frame("content", value))
+            return frames
+
+        self._pending.append(value)
+        self._pending_chars += len(value)
+        if self.max_chars and self._pending_chars >= self.max_chars:
+            return self.flush()
+        return self._flush_if_due()
+
+    def push_events(self, events: Iterable[Tuple[str, Any]]) -> List[str]:
+        """
+        加入解析器产出的一组事件（每个上游数据块调用一次，没有事件时也检查累积时间）
+
+        Args:
+            events: (字段名, 值) 列表
+
+        Returns:
+            需要立即发送的SSE帧列表
+        """
+        frames: List[str] = []
+        for field, value in events:
+            frames.extend(self.push(field, value))
+        frames.extend(self._flush_if_due())
+        return frames
+
+    def _flush_if_due(self) -> List[str]:
+        """累积的content超过 max_delay 时冲刷"""
+        if self._pending and self.max_delay and self._clock() - self._last_flush >= self.max_delay:
+            return self.flush()
+        return []
+
+    def flush(self) -> List[str]:
+        """
+        冲刷已累积的content
+
+        Returns:
+            需要发送的SSE帧列表（没有累积内容时为空）
+        """
+        if not self._pending:
+            return []
+        content = "".join(self._pending)
+        self._pending = []
+        self._pending_chars = 0
+        return [self._frame("content", content)]
+
+    def _frame(self, field: str, value: Any) -> str:
+        self.frames += 1
+        self._last_flush = self._clock()
+        return sse_frame({self.event_names.get(field, field): value})
+
+
+def _benchmark(tokens: int, interval_ms: float) -> None:
+    """模拟逐token输出，对比开启/关闭合并时的帧数、字节数、首帧时间和吞吐"""
+    from utils.stream_parser import ReplyStreamParser
+
+    words = ["你好", "，", "今天", "天气", "不错", "呢", "。", "我们", "去", "公园", "散步", "吧", "～"]
+    content = "".join(words[i % len(words)] for i in range(tokens))
+    reply = json.dumps({"mood": 2, "content": content, "note": ""}, ensure_ascii=False)
+    # 每个token约2个字符
+    chunks = [reply[i:i + 2] for i in range(0, len(reply), 2)]
+
+    def run(max_delay_ms: int, max_chars: int) -> Tuple[int, int, float, float]:
+        parser = ReplyStreamParser()
+        coalescer = SSEFrameCoalescer(max_delay_ms, max_chars)
+        sent_bytes = 0
+        first_frame = None
+        start = time.perf_counter()
+        for chunk in chunks:
+            if interval_ms:
+                time.sleep(interval_ms / 1000.0)
+            for frame in coalescer.push_events(parser.feed(chunk)):
+                sent_bytes += len(frame.encode("utf-8"))
+                if first_frame is None and '"content"' in frame:
+                    first_frame = time.perf_counter() - start
+        for frame in coalescer.push_events(parser.close()) + coalescer.flush():
+            sent_bytes += len(frame.encode("utf-8"))
+        elapsed = time.perf_counter() - start
+        return coalescer.frames, sent_bytes, (first_frame or 0.0) * 1000, elapsed
+
+    print(f"模拟 {len(chunks)} 个token，间隔 {interval_ms}ms")
+    for label, settings in (("关闭合并", (0, 0)), ("开启合并", (40, 24))):
+        frames, sent_bytes, first_ms, elapsed = run(*settings)
+        throughput = len(chunks) / elapsed if elapsed else float("inf")
+        print(f"{label}: 帧数={frames} 字节数={sent_bytes} 首帧={first_ms:.1f}ms "
+              f"总耗时={elapsed * 1000:.1f}ms 吞吐={throughput:.0f} token/s")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="SSE帧合并基准测试")
+    parser.add_argument("--tokens", type=int, default=400, help="模拟的token数")
+    parser.add_argument("--interval-ms", type=float, default=15, help="token间隔（毫秒），0表示测CPU吞吐")
+    args = parser.parse_args()
+    _benchmark(args.tokens, args.interval_ms)
@@ -0,0 +1,395 @@
+"""
+状态存储模块
+会话上下文、当前角色和故事进度的键值存储接口，用于多进程/多主机部署时在各个工作进程之间共享状态
+
+    - MemoryStateStore: 进程内存储（默认，单进程部署）
+    - RemoteStateStore: 通过HTTP访问的网络键值存储
+    - CachedStateStore: 带版本校验的本地缓存，热数据在校验间隔内直接命中本地，过期后用条件请求（If-None-Match）校验
+    - StateStoreServer: 本地替身服务器，可用于测试和单机多进程部署
+
+每个键保存一个JSON值和递增的版本号，写入时可指定期望版本，版本不一致时抛出 StateVersionConflict。
+
+启动本地替身服务器（在项目根目录执行）：
+    python -m utils.state_store [--host 127.0.0.1] [--port 6390]
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import quote, unquote
+
+import requests
+
+
+class StateVersionConflict(Exception):
+    """写入时版本不一致"""
+
+    def __init__(self, key: str, version: int):
+        super().__init__(f"状态版本冲突: {key} (当前版本 {version})")
+        self.key = key
+        self.version = version
+
+
+class StateStore:
+    """状态存储接口"""
+
+    # 是否在多个进程之间共享（进程内存储为False，调用方可跳过同步）
+    shared = False
+
+    def get(self, key: str) -> Tuple[Any, int]:
+        """
+        读取值
+
+        Args:
+            key: 键
+
+        Returns:
+            (值, 版本号)，键不存在时为 (None, 0)
+        """
+        raise NotImplementedError
+
+    def get_if_changed(self, key: str, version: int) -> Optional[Tuple[Any, int]]:
+        """
+        版本变化时读取值
+
+        Args:
+            key: 键
+            version: 调用方已有的版本号
+
+        Returns:
+            版本未变化时返回None，否则返回 (值, 版本号)
+        """
+        value, current = self.get(key)
+        return None if current == version else (value, current)
+
+    def set(self, key: str, value: Any, expected_version: Optional[int] = None) -> int:
+        """
+        写入值
+
+        Args:
+            key: 键
+            value: 可JSON序列化的值
+            expected_version: 期望的当前版本号，为None时不检查
+
+        Returns:
+            写入后的版本号
+
+        Raises:
+            StateVersionConflict: 当前版本与期望版本不一致时
+        """
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        """
+        删除键
+
+        Args:
+            key: 键
+        """
+        raise NotImplementedError
+
+
+class MemoryStateStore(StateStore):
+    """进程内状态存储"""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[Any, int]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[Any, int]:
+        with self._lock:
+            return self._data.get(key, (None, 0))
+
+    def set(self, key: str, value: Any, expected_version: Optional[int] = None) -> int:
+        with self._lock:
+            current = self._data.get(key, (None, 0))[1]
+            if expected_version is not None and expected_version != current:
+                raise StateVersionConflict(key, current)
+            self._data[key] = (value, current + 1)
+            return current + 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class RemoteStateStore(StateStore):
+    """通过HTTP访问的网络键值存储（协议见 StateStoreServer）"""
+
+    shared = True
+
+    def __init__(self, base_url: str, timeout: float = 2.0):
+        """
+        初始化远程存储
+
+        Args:
+            base_url: 服务地址，如 http://127.0.0.1:6390
+            timeout: 请求超时（秒）
+        """
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self, key: str) -> Tuple[Any, int]:
+        return self._fetch(key, None)
+
+    def get_if_changed(self, key: str, version: int) -> Optional[Tuple[Any, int]]:
+        return self._fetch(key, version)
+
+    def set(self, key: str, value: Any, expected_version: Optional[int] = None) -> int:
+        response = self._session().put(
+            self._url(key),
+            json={"value": value, "expected_version": expected_version},
+            timeout=self.timeout
+        )
+        if response.status_code == 409:
+            raise StateVersionConflict(key, response.json().get("version", 0))
+        response.raise_for_status()
+        return response.json()["version"]
+
+    def delete(self, key: str) -> None:
+        response = self._session().delete(self._url(key), timeout=self.timeout)
+        if response.status_code != 404:
+            response.raise_for_status()
+
+    def _fetch(self, key: str, version: Optional[int]):
+        headers = {"If-None-Match": f'"{version}"'} if version is not None else {}
+        response = self._session().get(self._url(key), headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            return None
+        if response.status_code == 404:
+            return None if version == 0 else (None, 0)
+        response.raise_for_status()
+        data = response.json()
+        return data.get("value"), data.get("version", 0)
+
+    def _url(self, key: str) -> str:
+        return f"{self.base_url}/kv/{quote(key, safe='')}"
+
+    def _session(self) -> requests.Session:
+        # requests.Session不保证线程安全，每个线程使用自己的连接池
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+
+class CachedStateStore(StateStore):
+    """带版本校验的本地缓存"""
+
+    def __init__(self, backend: StateStore, check_interval: float = 1.0, max_entries: int = 1024):
+        """
+        初始化缓存
+
+        Args:
+            backend: 被缓存的存储
+            check_interval: 缓存项在该秒数内直接命中，超过后向后端校验版本
+            max_entries: 最多缓存的键数量（LRU淘汰）
+        """
+        self.backend = backend
+        self.shared = backend.shared
+        self.check_interval = check_interval
+        self.max_entries = max_entries
+        # 键 -> [值, 版本号, 上次校验时间]
+        self._cache: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0}
+
+    def get(self, key: str) -> Tuple[Any, int]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                if now - entry[2] < self.check_interval:
+                    self.stats["hits"] += 1
+                    return entry[0], entry[1]
+
+        if entry is not None:
+            changed = self.backend.get_if_changed(key, entry[1])
+            if changed is None:
+                with self._lock:
+                    entry[2] = now
+                    self.stats["revalidated"] += 1
+                return entry[0], entry[1]
+            value, version = changed
+        else:
+            value, version = self.backend.get(key)
+
+        with self._lock:
+            self.stats["misses"] += 1
+            self._put(key, value, version, now)
+        return value, version
+
+    def set(self, key: str, value: Any, expected_version: Optional[int] = None) -> int:
+        try:
+            version = self.backend.set(key, value, expected_version)
+        except StateVersionConflict:
+            with self._lock:
+                self._cache.pop(key, None)
+            raise
+        with self._lock:
+            self._put(key, value, version, time.monotonic())
+        return version
+
+    def delete(self, key: str) -> None:
+        self.backend.delete(key)
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def _put(self, key: str, value: Any, version: int, checked_at: float) -> None:
+        self._cache[key] = [value, version, checked_at]
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+
+class _StateRequestHandler(BaseHTTPRequestHandler):
+    """StateStoreServer的请求处理"""
+
+    store: MemoryStateStore = None
+
+    def do_GET(self):
+        key = self._key()
+        if key is None:
+            return
+        value, version = self.store.get(key)
+        if version == 0:
+            self._reply(404, {"error": "not found"})
+        elif self.headers.get("If-None-Match") == f'"{version}"':
+            self._reply(304, None, version)
+        else:
+            self._reply(200, {"value": value, "version": version}, version)
+
+    def do_PUT(self):
+        key = self._key()
+        if key is None:
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._reply(400, {"error": "invalid json"})
+            return
+        try:
+            version = self.store.set(key, body.get("value"), body.get("expected_version"))
+        except StateVersionConflict as e:
+            self._reply(409, {"error": str(e), "version": e.version})
+            return
+        self._reply(200, {"version": version}, version)
+
+    def do_DELETE(self):
+        key = self._key()
+        if key is None:
+            return
+        self.store.delete(key)
+        self._reply(204, None)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _key(self) -> Optional[str]:
+        if not self.path.startswith("/kv/"):
+            self._reply(404, {"error": "not found"})
+            return None
+        return unquote(self.path[len("/kv/"):])
+
+    def _reply(self, status: int, data: Optional[Dict[str, Any]], version: Optional[int] = None) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8") if data is not None else b""
+        self.send_response(status)
+        if version is not None:
+            self.send_header("ETag", f'"{version}"')
+        if body:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+
+class StateStoreServer:
+    """
+    本地替身键值服务器（进程内存储 + HTTP接口）
+
+    协议：
+        GET    /kv/<key>  -> 200 {"value", "version"}（带ETag），If-None-Match命中时304，不存在时404
+        PUT    /kv/<key>  {"value", "expected_version"} -> 200 {"version"}，版本冲突时409
+        DELETE /kv/<key>  -> 204
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6390, store: Optional[MemoryStateStore] = None):
+        """
+        初始化服务器
+
+        Args:
+            host: 监听地址
+            port: 监听端口，0表示随机端口
+            store: 底层存储，为None时新建
+        """
+        handler = type("StateRequestHandler", (_StateRequestHandler,), {"store": store or MemoryStateStore()})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """服务地址"""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StateStoreServer":
+        """在后台线程中启动服务"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """停止服务"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+_shared_state_store: Optional[StateStore] = None
+_shared_state_store_lock = threading.Lock()
+
+
+def get_state_store() -> StateStore:
+    """
+    获取进程内共享的状态存储
+
+    Returns:
+        配置为remote时返回带缓存的远程存储，否则返回进程内存储
+    """
+    global _shared_state_store
+    if _shared_state_store is None:
+        from config import get_app_config
+        store_config = get_app_config().get("state_store") or {}
+        with _shared_state_store_lock:
+            if _shared_state_store is None:
+                if store_config.get("backend", "memory") == "remote":
+                    _shared_state_store = CachedStateStore(
+                        RemoteStateStore(store_config.get("url", "http://127.0.0.1:6390"), store_config.get("timeout", 2.0)),
+                        check_interval=store_config.get("cache_check_interval", 1.0)
+                    )
+                else:
+                    _shared_state_store = MemoryStateStore()
+    return _shared_state_store
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="本地状态存储替身服务器")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=6390, help="监听端口")
+    args = parser.parse_args()
+
+    server = StateStoreServer(args.host, args.port)
+    print(f"状态存储服务已启动: {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
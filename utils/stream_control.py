@@ -0,0 +1,214 @@
+"""
+流式输出控制模块
+登记正在进行的模型流式输出，支持客户端断开或主动取消时关闭上游流，并统计被取消的token数
+"""
+import time
+import uuid
+import threading
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+# 取消原因
+CANCEL_DISCONNECT = "disconnect"  # 客户端断开连接
+CANCEL_REQUEST = "cancel"         # 通过 /api/chat/cancel 主动取消
+
+
+class StreamHandle:
+    """一次流式输出的控制句柄"""
+
+    def __init__(self, registry: "StreamRegistry", kind: str, session_id: Optional[str] = None):
+        """
+        初始化句柄
+
+        Args:
+            registry: 所属登记表
+            kind: 流类型（chat/story/multi_character）
+            session_id: 发起该流的会话ID
+        """
+        self.stream_id = uuid.uuid4().hex
+        self.kind = kind
+        self.session_id = session_id
+        self.started_at = time.time()
+        self.tokens = 0
+        self.chars = 0
+        self.cancel_reason: Optional[str] = None
+        self.upstream_finished = False
+        self._registry = registry
+        self._cancel_event = threading.Event()
+        self._upstreams: List[Iterator[str]] = []
+        self._closed = False
+
+    @property
+    def cancelled(self) -> bool:
+        """是否已被取消"""
+        return self._cancel_event.is_set()
+
+    def cancel(self, reason: str = CANCEL_REQUEST) -> None:
+        """
+        标记取消（可从其他线程调用，流在收到下一个token时停止）
+
+        Args:
+            reason: 取消原因
+        """
+        if not self._cancel_event.is_set():
+            self.cancel_reason = reason
+            self._cancel_event.set()
+
+    def relay(self, upstream: Iterable[str]) -> Iterator[str]:
+        """
+        转发上游token，被取消时停止读取并关闭上游流
+
+        Args:
+            upstream: 模型输出的token迭代器
+
+        Yields:
+            上游token
+        """
+        upstream = iter(upstream)
+        self._upstreams.append(upstream)
+        self.upstream_finished = False
+        try:
+            for chunk in upstream:
+                if self.cancelled:
+                    return
+                if chunk is not None:
+                    self.tokens += 1
+                    self.chars += len(chunk)
+                yield chunk
+                if self.cancelled:
+                    return
+            self.upstream_finished = True
+        finally:
+            self._close_upstream(upstream)
+
+    async def relay_async(self, upstream: AsyncIterator[str]) -> AsyncIterator[str]:
+        """
+        转发异步上游token，被取消时停止读取并关闭上游流
+
+        Args:
+            upstream: 模型输出的异步token迭代器
+
+        Yields:
+            上游token
+        """
+        self.upstream_finished = False
+        try:
+            async for chunk in upstream:
+                if self.cancelled:
+                    return
+                if chunk is not None:
+                    self.tokens += 1
+                    self.chars += len(chunk)
+                yield chunk
+                if self.cancelled:
+                    return
+            self.upstream_finished = True
+        finally:
+            aclose = getattr(upstream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def close(self) -> None:
+        """结束流式输出：关闭仍未结束的上游流并更新统计"""
+        if self._closed:
+            return
+        self._closed = True
+        for upstream in self._upstreams:
+            self._close_upstream(upstream)
+        self._registry._finish(self)
+
+    def _close_upstream(self, upstream: Iterator[str]) -> None:
+        close = getattr(upstream, "close", None)
+        if close is None:
+            return
+        try:
+            close()
+        except ValueError:
+            # 生成器正在其他线程中执行，由其自行在下一个token处停止
+            pass
+        except Exception as e:
+            print(f"关闭上游流失败: {e}")
+
+
+class StreamRegistry:
+    """正在进行的流式输出登记表（进程内共享）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active: Dict[str, StreamHandle] = {}
+        self._stats = {
+            "started": 0,
+            "completed": 0,
+            "cancelled": {CANCEL_DISCONNECT: 0, CANCEL_REQUEST: 0},
+            "tokens": 0,
+            "cancelled_tokens": 0,
+        }
+
+    def open(self, kind: str, session_id: Optional[str] = None) -> StreamHandle:
+        """
+        登记一次新的流式输出
+
+        Args:
+            kind: 流类型（chat/story/multi_character）
+            session_id: 发起该流的会话ID（取消时只允许同一会话取消）
+
+        Returns:
+            控制句柄
+        """
+        handle = StreamHandle(self, kind, session_id)
+        with self._lock:
+            self._active[handle.stream_id] = handle
+            self._stats["started"] += 1
+        return handle
+
+    def cancel(self, session_id: str, stream_id: Optional[str] = None, reason: str = CANCEL_REQUEST) -> int:
+        """
+        取消某个会话的流式输出（其他会话的流不受影响）
+
+        Args:
+            session_id: 发起取消的会话ID
+            stream_id: 要取消的流ID，为None时取消该会话所有正在进行的流
+            reason: 取消原因
+
+        Returns:
+            被取消的流数量
+        """
+        with self._lock:
+            if stream_id is None:
+                handles = [handle for handle in self._active.values() if handle.session_id == session_id]
+            else:
+                handle = self._active.get(stream_id)
+                handles = [handle] if handle and handle.session_id == session_id else []
+        for handle in handles:
+            handle.cancel(reason)
+        return len(handles)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取统计信息
+
+        Returns:
+            已开始/已完成/已取消（按原因）的流数量、转发的token总数、取消时已消耗的token数和正在进行的流数量
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cancelled"] = dict(self._stats["cancelled"])
+            stats["active"] = len(self._active)
+        return stats
+
+    def _finish(self, handle: StreamHandle) -> None:
+        with self._lock:
+            self._active.pop(handle.stream_id, None)
+            self._stats["tokens"] += handle.tokens
+            if handle.cancelled and not handle.upstream_finished:
+                reason = handle.cancel_reason or CANCEL_REQUEST
+                self._stats["cancelled"][reason] = self._stats["cancelled"].get(reason, 0) + 1
+                self._stats["cancelled_tokens"] += handle.tokens
+                cancelled_tokens = self._stats["cancelled_tokens"]
+            else:
+                self._stats["completed"] += 1
+                return
+        print(f"流式输出已取消({reason}): {handle.kind} 已接收 {handle.tokens} 个token，累计取消 {cancelled_tokens} 个token")
+
+
+# 全局流式输出登记表
+stream_registry = StreamRegistry()
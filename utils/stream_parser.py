@@ -0,0 +1,281 @@
+"""
+流式回复解析模块
+增量解析模型按 {mood, content, note} 格式输出的JSON回复
+
+每个数据块只被扫描一次（O(块长度)），不会对累积的完整回复重复做正则匹配：
+    - mood 在值完整后立即产出（支持字符串和数字）
+    - content 以增量形式产出，正确处理 \\" \\\\ \\n \\uXXXX 等转义（转义序列可跨块），
+      字符串结束时产出 (CONTENT_END, None)，供SSE合并器立即冲刷累积的content
+    - 回复外层包裹 ```json 代码块时跳过围栏；回复不是JSON对象时按纯文本逐块产出
+"""
+import re
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+# 解析状态
+_START = 0          # 等待对象开始
+_FENCE = 1          # 跳过```json围栏，直到遇到{
+_EXPECT_KEY = 2     # 等待键（或对象结束）
+_KEY = 3            # 读取键
+_EXPECT_COLON = 4   # 等待冒号
+_EXPECT_VALUE = 5   # 等待值
+_STRING = 6         # 读取字符串值
+_SCALAR = 7         # 读取数字/true/false/null
+_NESTED = 8         # 跳过嵌套的对象或数组
+_AFTER_VALUE = 9    # 等待逗号或对象结束
+_DONE = 10          # 对象已结束，忽略后续内容
+_PLAIN = 11         # 非JSON回复，按纯文本产出
+
+_SIMPLE_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+_STRING_RUN = re.compile(r'[^"\\]+')
+_WHITESPACE = " \t\r\n"
+
+# 以增量形式产出的字段与值完整后产出的字段
+STREAMED_FIELDS = ("content",)
+EMITTED_FIELDS = ("mood",)
+# 增量字段的字符串结束事件（之后模型还会输出note等其他字段，不再有content增量）
+CONTENT_END = "content_end"
+
+
+class ReplyStreamParser:
+    """{mood, content, note} 回复的增量解析器（状态机）"""
+
+    def __init__(self):
+        self.state = _START
+        self.fields: Dict[str, Any] = {}
+        self._chunks: List[str] = []
+        self._key: List[str] = []
+        self._value: List[str] = []
+        self._current_key: Optional[str] = None
+        self._escape = False
+        self._unicode: Optional[str] = None
+        self._high_surrogate: Optional[int] = None
+        self._nested_depth = 0
+        self._nested_in_string = False
+        self._nested_escape = False
+        self._pending: List[str] = []
+        self._streaming = False
+        self._plain: List[str] = []
+
+    @property
+    def text(self) -> str:
+        """已接收的完整原始回复"""
+        return "".join(self._chunks)
+
+    @property
+    def mood(self) -> Any:
+        """已解析的mood（未完成时为None）"""
+        return self.fields.get("mood")
+
+    @property
+    def content(self) -> str:
+        """已解析的content（包含尚未结束的部分）"""
+        if self.state == _PLAIN:
+            return "".join(self._plain)
+        if self.state == _STRING and self._current_key == "content":
+            return "".join(self._value)
+        value = self.fields.get("content", "")
+        return value if isinstance(value, str) else str(value)
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """
+        解析一个数据块
+
+        Args:
+            chunk: 模型流式输出的文本块
+
+        Returns:
+            本块产生的事件列表，如 [("mood", 3), ("content", "你好")]
+        """
+        events: List[Tuple[str, Any]] = []
+        if not chunk:
+            return events
+        self._chunks.append(chunk)
+
+        i = 0
+        length = len(chunk)
+        while i < length:
+            state = self.state
+            ch = chunk[i]
+
+            if state == _STRING:
+                if self._unicode is not None:
+                    self._unicode += ch
+                    if len(self._unicode) == 4:
+                        self._append_code_point(self._unicode)
+                        self._unicode = None
+                elif self._escape:
+                    self._escape = False
+                    if ch == 'u':
+                        self._unicode = ""
+                    else:
+                        self._append_char(_SIMPLE_ESCAPES.get(ch, ch))
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._finish_value("".join(self._value), events)
+                    self.state = _AFTER_VALUE
+                else:
+                    # 一次性复制不含引号和反斜杠的连续片段
+                    run = _STRING_RUN.match(chunk, i)
+                    self._append_char(run.group(0))
+                    i = run.end()
+                    continue
+                i += 1
+                continue
+
+            if state == _PLAIN:
+                events.append(("content", chunk[i:]))
+                self._plain.append(chunk[i:])
+                break
+
+            if state == _START:
+                if ch in _WHITESPACE:
+                    pass
+                elif ch == '{':
+                    self.state = _EXPECT_KEY
+                elif ch == '`':
+                    self.state = _FENCE
+                else:
+                    self.state = _PLAIN
+                    continue
+            elif state == _FENCE:
+                if ch == '{':
+                    self.state = _EXPECT_KEY
+            elif state == _EXPECT_KEY:
+                if ch == '"':
+                    self._key = []
+                    self.state = _KEY
+                elif ch == '}':
+                    self.state = _DONE
+            elif state == _KEY:
+                if self._escape:
+                    self._escape = False
+                    self._key.append(_SIMPLE_ESCAPES.get(ch, ch))
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._current_key = "".join(self._key)
+                    self.state = _EXPECT_COLON
+                else:
+                    self._key.append(ch)
+            elif state == _EXPECT_COLON:
+                if ch == ':':
+                    self.state = _EXPECT_VALUE
+            elif state == _EXPECT_VALUE:
+                if ch in _WHITESPACE:
+                    pass
+                elif ch == '"':
+                    self._value = []
+                    # 重复出现的键只以第一次为准
+                    self._streaming = self._current_key in STREAMED_FIELDS and self._current_key not in self.fields
+                    self.state = _STRING
+                elif ch in '{[':
+                    self._nested_depth = 1
+                    self._nested_in_string = False
+                    self._nested_escape = False
+                    self.state = _NESTED
+                else:
+                    self._value = [ch]
+                    self.state = _SCALAR
+            elif state == _SCALAR:
+                if ch == ',' or ch == '}' or ch in _WHITESPACE:
+                    self._finish_scalar(events)
+                    self.state = _EXPECT_KEY if ch == ',' else (_DONE if ch == '}' else _AFTER_VALUE)
+                else:
+                    self._value.append(ch)
+            elif state == _NESTED:
+                self._skip_nested(ch)
+            elif state == _AFTER_VALUE:
+                if ch == ',':
+                    self.state = _EXPECT_KEY
+                elif ch == '}':
+                    self.state = _DONE
+            elif state == _DONE:
+                break
+            i += 1
+
+        self._flush_pending(events)
+        return events
+
+    def close(self) -> List[Tuple[str, Any]]:
+        """
+        流结束时收尾（补全被截断的数字值等）
+
+        Returns:
+            收尾产生的事件列表
+        """
+        events: List[Tuple[str, Any]] = []
+        if self.state == _SCALAR:
+            self._finish_scalar(events)
+            self.state = _DONE
+        self._flush_pending(events)
+        return events
+
+    def _append_char(self, text: str) -> None:
+        if self._high_surrogate is not None:
+            # 高位代理后没有紧跟低位代理，按原样保留
+            text = chr(self._high_surrogate) + text
+            self._high_surrogate = None
+        self._value.append(text)
+        if self._streaming:
+            self._pending.append(text)
+
+    def _append_code_point(self, hex_digits: str) -> None:
+        try:
+            code = int(hex_digits, 16)
+        except ValueError:
+            self._append_char("\\u" + hex_digits)
+            return
+        if 0xD800 <= code < 0xDC00:
+            self._high_surrogate = code
+            return
+        if 0xDC00 <= code < 0xE000 and self._high_surrogate is not None:
+            combined = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+            self._high_surrogate = None
+            self._append_char(chr(combined))
+            return
+        self._append_char(chr(code))
+
+    def _skip_nested(self, ch: str) -> None:
+        if self._nested_in_string:
+            if self._nested_escape:
+                self._nested_escape = False
+            elif ch == '\\':
+                self._nested_escape = True
+            elif ch == '"':
+                self._nested_in_string = False
+        elif ch == '"':
+            self._nested_in_string = True
+        elif ch in '{[':
+            self._nested_depth += 1
+        elif ch in '}]':
+            self._nested_depth -= 1
+            if self._nested_depth == 0:
+                self.state = _AFTER_VALUE
+
+    def _finish_scalar(self, events: List[Tuple[str, Any]]) -> None:
+        raw = "".join(self._value).strip()
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            value = raw
+        self._finish_value(value, events)
+
+    def _finish_value(self, value: Any, events: List[Tuple[str, Any]]) -> None:
+        self._flush_pending(events)
+        if self._streaming:
+            events.append((CONTENT_END, None))
+        key = self._current_key
+        if key is not None and key not in self.fields:
+            self.fields[key] = value
+            if key in EMITTED_FIELDS:
+                events.append((key, value))
+        self._current_key = None
+        self._value = []
+        self._streaming = False
+
+    def _flush_pending(self, events: List[Tuple[str, Any]]) -> None:
+        if self._pending:
+            events.append(("content", "".join(self._pending)))
+            self._pending = []
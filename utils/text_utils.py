@@ -4,7 +4,7 @@
 """
 import re
 import json
-from typing import List, Optional
+from typing import List, Optional, Dict, Any
 
 
 def parse_assistant_text(raw: str) -> str:
@@ -58,12 +58,12 @@ def extract_last_sentence(text: str) -> str:
     return m.group(1).strip() if m else text
 
 
-def split_into_sentences(text: str) -> List[str]:
+def split_plain_sentences(text: str) -> List[str]:
     """
-    将文本按照标点符号分割成句子
+    将已解析的纯文本按照标点符号分割成句子
     
     Args:
-        text: 输入文本
+        text: 纯文本（不再尝试JSON解析）
         
     Returns:
         句子列表
@@ -71,9 +71,6 @@ def split_into_sentences(text: str) -> List[str]:
     if not text:
         return []
     
-    # 先解析助手回复文本
-    text = parse_assistant_text(text)
-    
     # 清理文本
     text = re.sub(r"\s+", " ", text).strip()
     if not text:
@@ -99,6 +96,75 @@ def split_into_sentences(text: str) -> List[str]:
     return cleaned_sentences
 
 
+def split_into_sentences(text: str) -> List[str]:
+    """
+    将文本按照标点符号分割成句子
+    
+    Args:
+        text: 输入文本
+        
+    Returns:
+        句子列表
+    """
+    if not text:
+        return []
+    
+    # 先解析助手回复文本
+    return split_plain_sentences(parse_assistant_text(text))
+
+
+def parse_assistant_message(raw: str) -> Dict[str, Any]:
+    """
+    一次性解析助手回复，得到表情、纯文本和分句结果
+    
+    Args:
+        raw: 原始回复文本（通常为JSON字符串）
+        
+    Returns:
+        {"mood": 表情或None, "content": 纯文本, "sentences": 句子列表}
+    """
+    mood = None
+    content = None
+    try:
+        obj = json.loads(raw)
+        if isinstance(obj, dict):
+            mood = obj.get('mood')
+            if 'content' in obj:
+                content = obj['content']
+            elif 'text' in obj:
+                content = obj['text']
+        elif isinstance(obj, str):
+            content = obj
+    except Exception:
+        pass
+    if content is None:
+        content = str(raw)
+    elif not isinstance(content, str):
+        content = str(content)
+    return {
+        "mood": mood,
+        "content": content,
+        "sentences": split_plain_sentences(content)
+    }
+
+
+def get_parsed_message(record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    获取历史记录中预解析的字段，旧记录没有时解析一次并回填到记录中
+    
+    Args:
+        record: 历史记录（包含role和content）
+        
+    Returns:
+        {"mood": 表情或None, "content": 纯文本, "sentences": 句子列表}
+    """
+    parsed = record.get("parsed")
+    if parsed is None:
+        parsed = parse_assistant_message(record.get("content", ""))
+        record["parsed"] = parsed
+    return parsed
+
+
 def get_last_assistant_sentence_for_character(character_id: str) -> str:
     """
     获取指定角色的最后一句助手回复
@@ -4,10 +4,17 @@
 """
 import os
 import json
+import threading
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Optional
 from pathlib import Path
 
+from utils.history_utils import iter_lines_reversed
+from utils import history_segments
+from utils.sqlite_store import get_sqlite_store, history_key
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
 class TimeTracker:
     """时间跟踪器"""
     
@@ -19,6 +26,9 @@ class TimeTracker:
             history_dir: 历史记录存储目录
         """
         self.history_dir = history_dir
+        # 各角色最后一条assistant消息时间的内存缓存（None表示没有记录）
+        self._last_message_times: Dict[str, Optional[datetime]] = {}
+        self._lock = threading.Lock()
     
     def _get_character_history_file(self, character_id: str) -> str:
         """
@@ -32,9 +42,39 @@ class TimeTracker:
         """
         return os.path.join(self.history_dir, f"{character_id}_history.log")
     
-    def get_last_message_time(self, character_id: str) -> Optional[datetime]:
+    def record_message(self, character_id: str, role: str, timestamp: str) -> None:
         """
-        获取角色最后一条消息的时间
+        记录新写入的消息时间（由HistoryManager在写入时调用）
+        
+        Args:
+            character_id: 角色ID
+            role: 消息角色
+            timestamp: 消息时间戳字符串
+        """
+        if role != "assistant":
+            return
+        try:
+            message_time = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            self._last_message_times[character_id] = message_time
+    
+    def forget(self, character_id: str) -> None:
+        """
+        清除角色的最后消息时间缓存（历史记录被清空时调用）
+        
+        Args:
+            character_id: 角色ID
+        """
+        with self._lock:
+            self._last_message_times.pop(character_id, None)
+    
+    def _read_last_message_time(self, character_id: str) -> Optional[datetime]:
+        """
+        从历史记录文件尾部倒序查找最后一条assistant消息的时间
+        
+        活跃分段中没有assistant消息时（例如刚轮转过），再从最新的归档分段向前查找
         
         Args:
             character_id: 角色ID
@@ -44,36 +84,69 @@ class TimeTracker:
         """
         history_file = self._get_character_history_file(character_id)
         
-        if not os.path.exists(history_file):
+        def find_in(messages):
+            for message in messages:
+                # 检查role是否为assistant
+                if message.get("role") == "assistant":
+                    timestamp_str = message.get("timestamp")
+                    if timestamp_str:
+                        try:
+                            return datetime.strptime(timestamp_str, TIMESTAMP_FORMAT)
+                        except ValueError:
+                            continue
             return None
         
+        def parse_lines(lines):
+            for line in lines:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+        
         try:
-            # 读取文件最后一行
-            with open(history_file, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-                if not lines:
-                    return None
-                
-                # 从最后一行开始查找
-                for line in reversed(lines):
-                    line = line.strip()
-                    if line:
-                        try:
-                            message = json.loads(line)
-                            # 检查role是否为assistant
-                            if message.get("role") == "assistant":
-                                timestamp_str = message.get("timestamp")
-                                if timestamp_str:
-                                    return datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-                        except (json.JSONDecodeError, ValueError):
-                            continue
-                
-                return None 
-            
+            store = get_sqlite_store()
+            if store is not None:
+                timestamp_str = store.last_history_timestamp(history_key(history_file), "assistant")
+                return datetime.strptime(timestamp_str, TIMESTAMP_FORMAT) if timestamp_str else None
+            if os.path.exists(history_file):
+                last_time = find_in(parse_lines(iter_lines_reversed(history_file)))
+                if last_time is not None:
+                    return last_time
+            for segment in reversed(history_segments.list_segments(history_file)):
+                segment_messages = history_segments.read_segment_messages(history_file, segment)
+                last_time = find_in(reversed(segment_messages))
+                if last_time is not None:
+                    return last_time
+            return None
         except Exception as e:
             print(f"读取最后消息时间失败: {e}")
             return None
     
+    def get_last_message_time(self, character_id: str) -> Optional[datetime]:
+        """
+        获取角色最后一条消息的时间
+        
+        优先使用内存缓存，冷启动时从文件尾部倒序读取一次
+        
+        Args:
+            character_id: 角色ID
+            
+        Returns:
+            最后一条消息的时间，如果没有历史记录则返回None
+        """
+        with self._lock:
+            if character_id in self._last_message_times:
+                return self._last_message_times[character_id]
+        
+        last_time = self._read_last_message_time(character_id)
+        
+        with self._lock:
+            # 读取期间可能已有新消息写入，以较新的为准
+            cached = self._last_message_times.get(character_id)
+            if cached is None or (last_time is not None and last_time > cached):
+                self._last_message_times[character_id] = last_time
+            return self._last_message_times[character_id]
+    
     def format_time_elapsed(self, last_time: Optional[datetime], current_time: datetime) -> str:
         """
         格式化时间间隔
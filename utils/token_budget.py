@@ -0,0 +1,237 @@
+"""
+上下文token预算
+用本地近似估算token数（不依赖分词器），按优先级把系统提示词、最近的对话、剧情引导、记忆、角色详情和时间前缀装入固定的token预算，
+并报告每部分最终使用的token数，使提示词长度（以及首token延迟和费用）保持稳定
+
+消息排列（见layout_messages）：静态的系统提示词在最前且每轮逐字节相同，随后是对话历史，
+每轮变化的上下文作为一条system消息放在最后一条用户消息之前，使服务端的提示词前缀缓存可以命中
+
+估算规则（对常见的BPE分词器偏保守）：
+    - 中日韩字符和全角标点：每个字符约1个token
+    - 其他字符（拉丁字母、数字、空格、半角标点）：每4个字符约1个token
+    - 每条消息另加4个token的格式开销
+"""
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import get_app_config
+
+# 中日韩统一表意文字、假名、谚文、全角符号
+_CJK_RE = re.compile("[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+CHARS_PER_LATIN_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    估算文本的token数
+
+    Args:
+        text: 文本
+
+    Returns:
+        估算的token数
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + CHARS_PER_LATIN_TOKEN - 1) // CHARS_PER_LATIN_TOKEN
+
+
+def estimate_message_tokens(message: Dict[str, Any]) -> int:
+    """
+    估算一条消息的token数（内容加格式开销）
+
+    Args:
+        message: {"role", "content"} 格式的消息
+
+    Returns:
+        估算的token数
+    """
+    return estimate_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    截断文本使其不超过给定的token数（尽量保留完整的行）
+
+    Args:
+        text: 文本
+        max_tokens: 最大token数
+
+    Returns:
+        截断后的文本
+    """
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    kept = []
+    used = 0
+    for line in text.split("\n"):
+        # 换行符按1个字符计入
+        cost = estimate_tokens(line + "\n")
+        if used + cost <= max_tokens:
+            kept.append(line)
+            used += cost
+            continue
+        # 放不下整行：第一行按字符截断，否则在行边界结束
+        if not kept:
+            kept.append(_truncate_chars(line, max_tokens - used))
+        break
+    return "\n".join(kept).rstrip()
+
+
+def _truncate_chars(text: str, max_tokens: int) -> str:
+    budget = max_tokens * CHARS_PER_LATIN_TOKEN
+    for index, char in enumerate(text):
+        budget -= CHARS_PER_LATIN_TOKEN if _CJK_RE.match(char) else 1
+        if budget < 0:
+            return text[:index]
+    return text
+
+
+def layout_messages(base_prompt: str, turns: List[Dict[str, Any]], context: str) -> List[Dict[str, Any]]:
+    """
+    按稳定前缀排列消息
+
+    Args:
+        base_prompt: 静态系统提示词（角色设定和格式要求）
+        turns: 对话消息（不含system消息，按时间顺序）
+        context: 每轮变化的上下文（剧情引导、时间前缀、记忆、角色详情），为空时不添加
+
+    Returns:
+        [静态系统提示词, 对话历史..., 上下文, 最后一条用户消息]
+    """
+    messages = [{"role": "system", "content": base_prompt}] + list(turns)
+    if context:
+        index = len(messages) - 1 if len(messages) > 1 and messages[-1].get("role") == "user" else len(messages)
+        messages.insert(index, {"role": "system", "content": context})
+    return messages
+
+
+class ContextAssembler:
+    """按优先级在token预算内组装发送给模型的消息"""
+
+    # 上下文各部分的装入优先级（最近的对话在这些部分之前装入）
+    SECTION_PRIORITY = ("guidance", "memory", "details", "time")
+
+    def __init__(self, max_tokens: int = 3000, history_max_ratio: float = 0.6,
+                 min_history_messages: int = 2, min_section_tokens: int = 32):
+        """
+        初始化组装器
+
+        Args:
+            max_tokens: 输入上下文的token预算（不含模型回复）
+            history_max_ratio: 最近的对话最多占用系统提示词之外剩余预算的比例，为记忆和角色详情留出空间
+            min_history_messages: 无论预算如何都保留的最近消息数（至少包含本轮用户消息）
+            min_section_tokens: 剩余预算少于该值时不再截断装入上下文部分，直接丢弃
+        """
+        self.max_tokens = max_tokens
+        self.history_max_ratio = history_max_ratio
+        self.min_history_messages = min_history_messages
+        self.min_section_tokens = min_section_tokens
+
+    @classmethod
+    def from_config(cls) -> "ContextAssembler":
+        """按 APP_CONFIG["context_budget"] 创建组装器"""
+        budget_config = get_app_config().get("context_budget") or {}
+        return cls(
+            max_tokens=int(budget_config.get("max_tokens", 3000)),
+            history_max_ratio=float(budget_config.get("history_max_ratio", 0.6)),
+            min_history_messages=int(budget_config.get("min_history_messages", 2)),
+        )
+
+    def select_history(self, base_prompt: str, turns: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        选出装入预算的最近对话（与assemble的选择一致，可在检索记忆前确定上下文中有哪些对话）
+
+        Args:
+            base_prompt: 基础系统提示词
+            turns: 对话消息（不含system消息，按时间顺序）
+
+        Returns:
+            装入的最近对话（按时间顺序）
+        """
+        remaining = self.max_tokens - estimate_tokens(base_prompt) - MESSAGE_OVERHEAD_TOKENS
+        history_cap = int(max(0, remaining) * self.history_max_ratio)
+        kept: List[Dict[str, Any]] = []
+        history_tokens = 0
+        # 从最新一条往前装入
+        for message in reversed(turns):
+            cost = estimate_message_tokens(message)
+            if len(kept) >= self.min_history_messages and history_tokens + cost > history_cap:
+                break
+            kept.append(message)
+            history_tokens += cost
+        kept.reverse()
+        return kept
+
+    def assemble(self, base_prompt: str, turns: List[Dict[str, Any]],
+                 sections: Dict[str, str]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        组装消息列表
+
+        装入顺序：系统提示词（总是保留）→ 最近的对话（从新到旧）→ 剧情引导 → 记忆 → 角色详情 → 时间前缀；
+        上下文部分放不下时按行截断，剩余预算太少时丢弃。装入的部分按 sections 的顺序合并为一条上下文消息（见layout_messages）。
+
+        Args:
+            base_prompt: 静态系统提示词
+            turns: 对话消息（不含system消息，按时间顺序）
+            sections: 上下文部分（guidance/time/memory/details，值为空时跳过）
+
+        Returns:
+            (以系统提示词开头的消息列表, 各部分token数报告)
+        """
+        report: Dict[str, Any] = {"budget": self.max_tokens}
+        system_tokens = estimate_tokens(base_prompt) + MESSAGE_OVERHEAD_TOKENS
+        report["system"] = system_tokens
+        remaining = self.max_tokens - system_tokens
+
+        kept = self.select_history(base_prompt, turns)
+        history_tokens = sum(estimate_message_tokens(message) for message in kept)
+        remaining -= history_tokens
+        report["history"] = history_tokens
+        report["history_messages"] = len(kept)
+        report["history_dropped"] = len(turns) - len(kept)
+
+        # 上下文部分：按优先级装入（先预留上下文消息的格式开销）
+        fitted: Dict[str, str] = {}
+        truncated = []
+        dropped = []
+        if any(sections.values()):
+            remaining -= MESSAGE_OVERHEAD_TOKENS
+        for name in self.SECTION_PRIORITY:
+            text = sections.get(name)
+            if not text:
+                continue
+            # 与前文之间的空行分隔
+            cost = estimate_tokens(text) + 1
+            if cost <= remaining:
+                fitted[name] = text
+            elif remaining - 1 >= self.min_section_tokens:
+                fitted[name] = truncate_to_tokens(text, remaining - 1)
+                truncated.append(name)
+            else:
+                dropped.append(name)
+                continue
+            section_tokens = estimate_tokens(fitted[name]) + 1
+            report[name] = section_tokens
+            remaining -= section_tokens
+
+        if fitted:
+            report["context"] = MESSAGE_OVERHEAD_TOKENS
+        elif any(sections.values()):
+            remaining += MESSAGE_OVERHEAD_TOKENS
+        context = "\n\n".join(fitted[name] for name in sections if name in fitted)
+        messages = layout_messages(base_prompt, kept, context)
+
+        report["total"] = self.max_tokens - remaining
+        if truncated:
+            report["truncated"] = truncated
+        if dropped:
+            report["dropped"] = dropped
+        return messages, report
@@ -0,0 +1,84 @@
+"""
+对话用量统计
+从API响应的usage中读取输入/输出token数和命中服务端提示词缓存的token数，打印日志并按来源累计，
+用于确认稳定的提示词前缀（静态系统提示词在前、每轮变化的上下文在后）是否真正命中了缓存。
+
+兼容的字段：
+    - OpenAI 格式：usage.prompt_tokens_details.cached_tokens
+    - DeepSeek 格式：usage.prompt_cache_hit_tokens
+"""
+import threading
+from typing import Any, Dict, Optional
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, int]] = {}
+
+
+def _field(obj: Any, name: str) -> Any:
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def extract_usage(usage: Any) -> Optional[Dict[str, int]]:
+    """
+    从usage对象或字典中读取token数
+
+    Args:
+        usage: API响应中的usage（openai SDK对象或字典）
+
+    Returns:
+        {"prompt_tokens", "completion_tokens", "cached_tokens"}，usage为空时返回None
+    """
+    if usage is None:
+        return None
+    cached = _field(_field(usage, "prompt_tokens_details"), "cached_tokens")
+    if cached is None:
+        cached = _field(usage, "prompt_cache_hit_tokens")
+    return {
+        "prompt_tokens": int(_field(usage, "prompt_tokens") or 0),
+        "completion_tokens": int(_field(usage, "completion_tokens") or 0),
+        "cached_tokens": int(cached or 0),
+    }
+
+
+def record_usage(source: str, usage: Any) -> Optional[Dict[str, int]]:
+    """
+    记录一次请求的用量
+
+    Args:
+        source: 请求来源（如 chat、multi_character）
+        usage: API响应中的usage
+
+    Returns:
+        读取到的token数，usage为空时返回None
+    """
+    counts = extract_usage(usage)
+    if counts is None:
+        return None
+    with _stats_lock:
+        item = _stats.setdefault(source, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0})
+        item["requests"] += 1
+        for key, value in counts.items():
+            item[key] += value
+    print(f"对话用量({source}): 输入{counts['prompt_tokens']}（缓存命中{counts['cached_tokens']}），输出{counts['completion_tokens']}")
+    return counts
+
+
+def get_usage_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    获取用量统计
+
+    Returns:
+        按来源统计的请求数、token数和缓存命中率（缓存命中token数/输入token数）
+    """
+    with _stats_lock:
+        stats = {}
+        for source, item in _stats.items():
+            stats[source] = dict(item)
+            stats[source]["cache_hit_rate"] = (
+                round(item["cached_tokens"] / item["prompt_tokens"], 3) if item["prompt_tokens"] else 0.0
+            )
+    return stats